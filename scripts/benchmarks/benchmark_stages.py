@@ -0,0 +1,139 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Script to time every dataset generation stage on synthetic corpora of increasing size:
+reports scenes/sec, input MB/sec and peak RSS of each stage, and compares them with a previous report
+"""
+import argparse
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+
+import yaml
+
+from generate_synthetic_data import generate
+
+
+with open('config.yml', 'r') as f:
+    keys = yaml.load(f, Loader=yaml.FullLoader)
+
+SCRIPTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# stage name, script, config keys of the inputs whose size is used for MB/sec
+STAGES = [
+    ('generate_glove_file', 'joint_codraw_iclevr/generate_glove_file.py', ['glove_source']),
+    ('extract_objects', 'codraw_dataset_generation/codraw_add_data_to_raw.py', ['codraw_scenes']),
+    ('codraw_create_h5', 'codraw_dataset_generation/codraw_raw_to_hdf5.py', ['codraw_scenes', 'codraw_images']),
+    ('codraw_object_detection', 'codraw_dataset_generation/codraw_object_detection.py',
+     ['codraw_scenes', 'codraw_images']),
+    ('iclevr_objects', 'iclevr_dataset_generation/iclevr_add_data_to_raw.py', []),
+    ('iclevr_create_h5', 'iclevr_dataset_generation/iclevr_raw_to_hdf5.py', ['iclevr_data_source']),
+    ('iclevr_object_detection', 'iclevr_dataset_generation/iclevr_object_detection.py', ['iclevr_data_source']),
+]
+# caches kept across runs by the stages; removed before every benchmark unless --warm is given
+CACHE_KEYS = ['codraw_text_cache', 'image_cache']
+
+
+def input_size(root, input_keys):
+    num_bytes = 0
+    for key in input_keys:
+        path = os.path.join(root, keys[key])
+        if os.path.isfile(path):
+            num_bytes += os.path.getsize(path)
+            continue
+        for folder, _, files in os.walk(path):
+            num_bytes += sum(os.path.getsize(os.path.join(folder, name)) for name in files)
+    return num_bytes
+
+
+def run_stage(root, script, args):
+    # run a stage in its own process; wait4 returns the resource usage of that process only
+    command = [sys.executable, os.path.join(SCRIPTS_PATH, script)] + args
+    start = time.time()
+    process = subprocess.Popen(command, cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    _, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    if process.returncode != 0:
+        raise RuntimeError('{} failed:\n{}'.format(script, stderr.decode(errors='replace')))
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return elapsed, peak_rss
+
+
+def benchmark(scale, work_dir, stages, stage_args, warm=False, workers=1):
+    root = os.path.join(work_dir, 'scenes_{}'.format(scale))
+    if not os.path.exists(os.path.join(root, 'config.yml')):
+        print('Generating {} synthetic scenes in {}'.format(scale, root))
+        generate(root, scale, workers=workers)
+    if not warm:
+        for key in CACHE_KEYS:
+            if os.path.isdir(os.path.join(root, keys[key])):
+                shutil.rmtree(os.path.join(root, keys[key]))
+            elif os.path.exists(os.path.join(root, keys[key])):
+                os.remove(os.path.join(root, keys[key]))
+
+    results = {}
+    print('{:<26} {:>10} {:>12} {:>10} {:>14}'.format('stage ({} scenes)'.format(scale), 'time (s)', 'scenes/s',
+                                                     'MB/s', 'peak RSS (MB)'))
+    for name, script, input_keys in STAGES:
+        if name not in stages:
+            continue
+        elapsed, peak_rss = run_stage(root, script, stage_args.get(name, []))
+        results[name] = {'seconds': elapsed, 'scenes_per_second': scale / elapsed,
+                         'mb_per_second': input_size(root, input_keys) / 2 ** 20 / elapsed,
+                         'peak_rss_mb': peak_rss / 2 ** 20}
+        print('{:<26} {:>10.2f} {:>12.1f} {:>10.1f} {:>14.1f}'.format(
+            name, elapsed, results[name]['scenes_per_second'], results[name]['mb_per_second'],
+            results[name]['peak_rss_mb']))
+    return results
+
+
+def compare(report, previous):
+    # ratios of the current to the previous run: >1 is faster (or more memory) now
+    print('{:<26} {:>8} {:>12} {:>12}'.format('stage', 'scenes', 'speedup', 'RSS ratio'))
+    for scale, results in report['scales'].items():
+        for name, result in results.items():
+            before = previous['scales'].get(scale, {}).get(name)
+            if before is None:
+                continue
+            print('{:<26} {:>8} {:>12.2f} {:>12.2f}'.format(name, scale, before['seconds'] / result['seconds'],
+                                                            result['peak_rss_mb'] / before['peak_rss_mb']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000, 50000],
+                        help='numbers of synthetic scenes of each dataset')
+    parser.add_argument('--work-dir', default='benchmark-data', help='folder of the generated corpora')
+    parser.add_argument('--stages', nargs='+', default=[name for name, _, _ in STAGES],
+                        choices=[name for name, _, _ in STAGES])
+    parser.add_argument('--stage-args', nargs='+', default=[], metavar='STAGE=ARGS',
+                        help='extra command line arguments of a stage, e.g. codraw_create_h5="--workers 4"')
+    parser.add_argument('--warm', action='store_true', help='keep the caches of previous runs')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes generating the corpora')
+    parser.add_argument('--report', default='benchmark_report.json', help='JSON file the results are written to')
+    parser.add_argument('--compare', default=None, help='JSON report of a previous run to compare with')
+    args = parser.parse_args()
+
+    stage_args = {}
+    for item in args.stage_args:
+        name, arguments = item.split('=', 1)
+        stage_args[name] = shlex.split(arguments)
+
+    report = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'stage_args': stage_args, 'warm': args.warm,
+              'scales': {}}
+    for scale in args.scales:
+        report['scales'][str(scale)] = benchmark(scale, args.work_dir, args.stages, stage_args, args.warm,
+                                                 args.workers)
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            compare(report, json.load(f))
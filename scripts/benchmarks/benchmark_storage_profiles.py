@@ -0,0 +1,103 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Script to compare the HDF5 storage profiles of config.yml on a generated dataset file:
+rewrites the file with every profile and reports file size and read throughput
+"""
+import argparse
+import os
+import sys
+import time
+
+import h5py
+import numpy as np
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.storage import dataset_options, load_storage_profile  # noqa: E402
+
+
+with open('config.yml', 'r') as f:
+    keys = yaml.load(f, Loader=yaml.FullLoader)
+
+
+def rewrite_with_profile(source_path, output_path, storage_profile):
+    # copy every dataset of the source file, applying the chunking and compression of the profile; the attributes
+    # (e.g. the encodings of the compact schema) are kept
+    with h5py.File(source_path, 'r') as source, h5py.File(output_path, 'w') as output:
+        output.attrs.update(source.attrs)
+
+        def copy(name, obj):
+            if isinstance(obj, h5py.Group):
+                output.require_group(name).attrs.update(obj.attrs)
+                return
+            resizable = obj.maxshape[:1] == (None,)
+            options = dataset_options(storage_profile, name.split('/')[-1], obj.shape, resizable=resizable)
+            if resizable:
+                options.setdefault('chunks', True)
+                options['maxshape'] = obj.maxshape
+            output.create_dataset(name, data=obj[()], dtype=obj.dtype, **options).attrs.update(obj.attrs)
+
+        source.visititems(copy)
+
+
+def read_samples(path, order):
+    # read every sample (group, or row of the packed layout) in the given order; returns bytes read
+    num_bytes = 0
+    with h5py.File(path, 'r') as h5:
+        if h5.attrs.get('layout') == 'packed':
+            num_rows = len(order)
+            datasets = [h5[name] for name in h5 if isinstance(h5[name], h5py.Dataset) and
+                        h5[name].ndim > 0 and h5[name].shape[0] == num_rows]
+            for i in order:
+                for dataset in datasets:
+                    num_bytes += np.asarray(dataset[i]).nbytes
+        else:
+            groups = [name for name in h5 if isinstance(h5[name], h5py.Group)]
+            for i in order:
+                for dataset in h5[groups[i]].values():
+                    num_bytes += np.asarray(dataset[()]).nbytes
+    return num_bytes
+
+
+def num_samples(path):
+    with h5py.File(path, 'r') as h5:
+        if h5.attrs.get('layout') == 'packed':
+            # images, or their rows of the frames table with deduplicated frames
+            return h5['images' if 'images' in h5 else 'image_ids'].shape[0]
+        return sum(1 for name in h5 if isinstance(h5[name], h5py.Group))
+
+
+def benchmark(source_path, profiles, output_dir):
+    basename = os.path.splitext(os.path.basename(source_path))[0]
+    n = num_samples(source_path)
+    orders = {'sequential': np.arange(n), 'random': np.random.RandomState(0).permutation(n)}
+
+    print('{:<12} {:>12} {:>18} {:>18}'.format('profile', 'size (MB)', 'sequential (MB/s)', 'random (MB/s)'))
+    for name in profiles:
+        try:
+            storage_profile = load_storage_profile(keys, name)
+            output_path = os.path.join(output_dir, '{}.{}.h5'.format(basename, name))
+            rewrite_with_profile(source_path, output_path, storage_profile)
+        except ImportError as e:
+            print('{:<12} skipped: {}'.format(name, e))
+            continue
+
+        throughput = {}
+        for order_name, order in orders.items():
+            start = time.time()
+            num_bytes = read_samples(output_path, order)
+            throughput[order_name] = num_bytes / 2 ** 20 / max(time.time() - start, 1e-9)
+        size = os.path.getsize(output_path) / 2 ** 20
+        print('{:<12} {:>12.1f} {:>18.1f} {:>18.1f}'.format(name, size, throughput['sequential'], throughput['random']))
+        os.remove(output_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source', help='HDF5 file written by one of the dataset builders')
+    parser.add_argument('--profiles', nargs='+', default=sorted(keys['hdf5_storage_profiles']))
+    parser.add_argument('--output-dir', default='.', help='folder for the temporary rewritten files')
+    args = parser.parse_args()
+
+    benchmark(args.source, args.profiles, args.output_dir)
@@ -0,0 +1,218 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Script to generate a synthetic CoDraw and i-CLEVR corpus, laid out as in config.yml, for profiling the dataset scripts
+"""
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+import yaml
+
+
+with open('config.yml', 'r') as f:
+    keys = yaml.load(f, Loader=yaml.FullLoader)
+
+CODRAW_SIZE = (500, 400)
+ICLEVR_SIZE = (320, 240)
+NUM_CODRAW_OBJECTS = 58
+CODRAW_POSES = 4
+
+WORDS = ['the', 'a', 'girl', 'boy', 'tree', 'sun', 'cloud', 'dog', 'cat', 'ball', 'hat', 'glasses', 'table', 'grill',
+         'left', 'right', 'top', 'bottom', 'corner', 'middle', 'small', 'medium', 'large', 'facing', 'holding',
+         'sitting', 'standing', 'next', 'to', 'on', 'of', 'is', 'in', 'and', 'with', 'her', 'his', 'arms', 'up',
+         'angry', 'happy', 'sad', 'kicking', 'pine', 'apple', 'slide', 'swing', 'bear', 'owl', 'rocket', ',', '.']
+TYPOS = {'the': 'teh', 'small': 'smal', 'right': 'rigth', 'left': 'lfet', 'large': 'larg', 'tree': 'tre'}
+CHITCHAT = ['hi', 'done', 'ok', 'alright', 'okay', 'thanks', 'bye', 'hello']
+DRAWER_REPLIES = ['what color?', 'which side?', 'is it big or small?', 'got it', 'next?', 'where is the sun?']
+COLORS = ['gray', 'red', 'blue', 'green', 'brown', 'purple', 'cyan', 'yellow']
+SHAPES = ['cube', 'sphere', 'cylinder']
+
+
+def output_path(root, key):
+    return os.path.join(root, keys[key])
+
+
+def codraw_pngs():
+    # clip-art png names: a few poses per object, mapped to the object names
+    return ['{}_{}s'.format(o, p) for o in range(NUM_CODRAW_OBJECTS) for p in range(CODRAW_POSES)]
+
+
+def make_message(rng, spell_check):
+    words = [WORDS[i] for i in rng.randint(0, len(WORDS), rng.randint(3, 15))]
+    typos = [i for i, w in enumerate(words) if w in TYPOS and rng.rand() < 0.3]
+    message = ' '.join(TYPOS[w] if i in typos else w for i, w in enumerate(words))
+    if typos and message not in spell_check:
+        # offsets of the flagged tokens in the message, as returned by Bing Spell Check API
+        flagged, offset = [], 0
+        for i, w in enumerate(words):
+            token = TYPOS[w] if i in typos else w
+            if i in typos:
+                flagged.append({'offset': offset, 'token': token, 'type': 'UnknownToken',
+                                'suggestions': [{'suggestion': w, 'score': 0.9}]})
+            offset += len(token) + 1
+        spell_check[message] = {'_type': 'SpellCheck', 'flaggedTokens': flagged}
+    return message
+
+
+def codraw_scene(scene_index, seed, spell_check):
+    # scene json: turns add clip-art objects; the first turn may have no drawing yet
+    rng = np.random.RandomState(seed + scene_index)
+    pngs = codraw_pngs()
+    present = []
+    dialog = []
+    for t in range(rng.randint(3, 11)):
+        if rng.rand() < 0.7 or not present:
+            present.append([pngs[rng.randint(len(pngs))], rng.randint(0, 500), rng.randint(0, 400),
+                            rng.randint(0, 3), rng.randint(0, 2)])
+        if t == 0 and rng.rand() < 0.3:
+            abs_d = ''
+        else:
+            fields = [str(len(present))]
+            for local_id, (png, x, y, z, flip) in enumerate(present):
+                # objects dragged outside of the canvas have huge coordinates
+                x = x if rng.rand() > 0.01 else 100000
+                object_id = int(png.split('_')[0])
+                fields += ['{}.png'.format(png), str(local_id), str(object_id // 10), str(object_id % 10),
+                           str(x), str(y), str(z), str(flip)]
+            abs_d = ','.join(fields) + ','
+        msg_t = CHITCHAT[rng.randint(len(CHITCHAT))] if rng.rand() < 0.05 else make_message(rng, spell_check)
+        msg_d = CHITCHAT[rng.randint(len(CHITCHAT))] if rng.rand() < 0.5 else \
+            DRAWER_REPLIES[rng.randint(len(DRAWER_REPLIES))]
+        dialog.append({'abs_t': '', 'abs_d': abs_d, 'msg_t': msg_t, 'msg_d': msg_d})
+    return {'image_id': scene_index, 'dialog': dialog}
+
+
+def draw_frame(rng, size, shapes):
+    # flat background with one filled shape per object, so frames compress like rendered scenes
+    image = np.full((size[1], size[0], 3), 200, dtype=np.uint8)
+    image[size[1] * 2 // 3:] = (60, 160, 60)
+    for x, y, radius, color in shapes:
+        cv2.circle(image, (int(x), int(y)), int(radius), color, -1)
+    return image
+
+
+def write_codraw_images(scene, images_path, seed):
+    rng = np.random.RandomState(seed + scene['image_id'])
+    idx = 0
+    for turn in scene['dialog']:
+        if turn['abs_d'] == '':
+            continue
+        fields = turn['abs_d'].split(',')
+        shapes = [(int(fields[i + 4]) % CODRAW_SIZE[0], int(fields[i + 5]), 10 + 10 * int(fields[i + 6]),
+                   tuple(int(c) for c in rng.randint(0, 255, 3))) for i in range(1, 1 + 8 * int(fields[0]), 8)]
+        cv2.imwrite(os.path.join(images_path, 'Scene{}_{}.png'.format(scene['image_id'], idx)),
+                    draw_frame(rng, CODRAW_SIZE, shapes))
+        idx += 1
+
+
+def iclevr_scene(scene_index, seed):
+    rng = np.random.RandomState(seed + 10 ** 7 + scene_index)
+    combinations = [(shape, color) for shape in SHAPES for color in COLORS]
+    chosen = rng.choice(len(combinations), 5, replace=False)
+    objects = [{'shape': combinations[c][0], 'color': combinations[c][1],
+                'pixel_coords': [int(rng.randint(20, 300)), int(rng.randint(20, 220)), float(rng.rand() * 15)]}
+               for c in chosen]
+    return {'objects': objects}
+
+
+def write_iclevr_scene(args, root, seed):
+    scene_index, split = args
+    data_path = output_path(root, 'iclevr_data_source')
+    scene = iclevr_scene(scene_index, seed)
+    name = 'CLEVR_{}_{:06d}'.format(split, scene_index)
+    with open(os.path.join(data_path, 'scenes', name + '.json'), 'w') as f:
+        json.dump(scene, f)
+    with open(os.path.join(data_path, 'text', name + '.txt'), 'w') as f:
+        for obj in scene['objects']:
+            position = 'in the center' if obj['pixel_coords'][0] < 160 else 'on the right'
+            f.write('add a {} {} {}\n'.format(obj['color'], obj['shape'], position))
+    rng = np.random.RandomState(seed + 2 * 10 ** 7 + scene_index)
+    shapes = []
+    for t, obj in enumerate(scene['objects']):
+        shapes.append((obj['pixel_coords'][0], obj['pixel_coords'][1], 15,
+                       tuple(int(c) for c in rng.randint(0, 255, 3))))
+        cv2.imwrite(os.path.join(data_path, 'images', '{}_{}.png'.format(name, t)),
+                    draw_frame(rng, ICLEVR_SIZE, shapes))
+
+
+def write_codraw_scene(args, root, seed):
+    scene_index, split = args
+    spell_check = {}
+    scene = codraw_scene(scene_index, seed, spell_check)
+    with open(os.path.join(output_path(root, 'codraw_scenes'), '{}_{:05d}.json'.format(split, scene_index)), 'w') as f:
+        json.dump(scene, f)
+    write_codraw_images(scene, output_path(root, 'codraw_images'), seed)
+    return spell_check
+
+
+def split_of(scene_index):
+    return ['train', 'train', 'train', 'train', 'train', 'train', 'train', 'train', 'val', 'test'][scene_index % 10]
+
+
+def generate(root, num_scenes, seed=0, workers=1):
+    for key in ['codraw_images', 'codraw_scenes']:
+        os.makedirs(output_path(root, key), exist_ok=True)
+    for folder in ['scenes', 'text', 'images']:
+        os.makedirs(os.path.join(output_path(root, 'iclevr_data_source'), folder), exist_ok=True)
+    for key in ['codraw_hdf5_folder', 'iclevr_hdf5_folder', 'glove_output', 'glove_source']:
+        os.makedirs(os.path.dirname(output_path(root, key)) or '.', exist_ok=True)
+    shutil.copy('config.yml', os.path.join(root, 'config.yml'))
+
+    # shared CoDraw files: background, object names, png to object mapping
+    background = draw_frame(np.random.RandomState(seed), CODRAW_SIZE, [])
+    cv2.imwrite(output_path(root, 'codraw_background'), background)
+    with open(output_path(root, 'codraw_objects_source'), 'w') as f:
+        for o in range(NUM_CODRAW_OBJECTS):
+            f.write('OBJECT{}\t{}\n'.format(o, 100 + o))
+    with open(output_path(root, 'codraw_png_to_object'), 'w') as f:
+        for png in codraw_pngs():
+            f.write('{}\tobject{}\n'.format(png, png.split('_')[0]))
+    cv2.imwrite(output_path(root, 'iclevr_background'), draw_frame(np.random.RandomState(seed), ICLEVR_SIZE, []))
+
+    # scenes and frames of both datasets
+    jobs = [(i, split_of(i)) for i in range(num_scenes)]
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    map_jobs = functools.partial(pool.imap, chunksize=16) if pool is not None else map
+    spell_check = {}
+    for scene_spell_check in tqdm(map_jobs(functools.partial(write_codraw_scene, root=root, seed=seed), jobs),
+                                  total=num_scenes):
+        spell_check.update(scene_spell_check)
+    for _ in tqdm(map_jobs(functools.partial(write_iclevr_scene, root=root, seed=seed), jobs), total=num_scenes):
+        pass
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # spelling corrections, vocabularies and a GloVe file covering them
+    with open(output_path(root, 'codraw_spell_check'), 'wb') as f:
+        pickle.dump(spell_check, f)
+    codraw_vocab = sorted(set(WORDS + CHITCHAT + ' '.join(DRAWER_REPLIES).replace('?', ' ?').split()))
+    iclevr_vocab = sorted(set(['add', 'a', 'in', 'the', 'center', 'on', 'right'] + COLORS + SHAPES))
+    for key, vocab in [('codraw_vocab', codraw_vocab), ('iclevr_vocab', iclevr_vocab)]:
+        with open(output_path(root, key), 'w') as f:
+            for word in vocab:
+                f.write('{} {}\n'.format(word, 1))
+    rng = np.random.RandomState(seed)
+    glove_words = sorted(set(codraw_vocab + iclevr_vocab + ['unk'])) + ['word{}'.format(i) for i in range(10000)]
+    with open(output_path(root, 'glove_source'), 'w') as f:
+        for word in glove_words:
+            f.write('{} {}\n'.format(word, ' '.join('{:.5f}'.format(x) for x in rng.uniform(-1, 1, 300))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_dir', help='root folder of the synthetic corpus; config.yml is copied there')
+    parser.add_argument('--scenes', type=int, default=1000, help='number of scenes of each dataset')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of processes writing scenes')
+    args = parser.parse_args()
+
+    generate(args.output_dir, args.scenes, args.seed, args.workers)
@@ -10,6 +10,9 @@ import numpy as np
 from tqdm import tqdm
 import yaml
 
+from codraw_text import convert_spell_check
+from codraw_utils import parse_abs_d, png_object_ids, save_extracted_coords
+
 
 with open('config.yml', 'r') as f:
     keys = yaml.load(f, Loader=yaml.FullLoader)
@@ -27,7 +30,6 @@ def extract_object_names():
 
 def extract_objects():
     json_path = keys['codraw_scenes']
-    extracted_objects_file = open(keys['codraw_extracted_coordinates'], 'w')
 
     # load object names
     with open(keys['codraw_objects'], 'r') as f:
@@ -38,8 +40,12 @@ def extract_objects():
         for l in f:
             splits = l.split('\t')
             PNG_MAPPING[splits[0]] = splits[1].strip()
+    png_names, png_objects = png_object_ids(PNG_MAPPING, OBJECTS)
 
-    # loop through scene jsons and extract object information
+    # loop through scene jsons and collect the clip-art strings of all turns with a drawing
+    scene_ids = []
+    turn_ids = []
+    abs_d = []
     for scene_json in tqdm(sorted(glob('{}/*.json'.format(json_path)))):
         with open(scene_json, 'r') as f:
             scene = json.load(f)
@@ -51,46 +57,31 @@ def extract_objects():
                     continue
 
                 turn_id += 1
-                bow = np.zeros((len(OBJECTS)), dtype=int)
-                x_coords = np.ones((len(OBJECTS)), dtype=int) * -1
-                y_coords = np.ones((len(OBJECTS)), dtype=int) * -1
-                z_coords = np.ones((len(OBJECTS)), dtype=int) * -1
-
-                dialog = dialog['abs_d'].split(',')
-
-                idx = 1
-                for _ in range(int(dialog[0])):
-                    png_filename = dialog[idx][:-4]
-                    x = float(dialog[idx + 4])
-                    y = float(dialog[idx + 5])
-                    z = float(dialog[idx + 6])
-
-                    if abs(x) > 1000 or abs(y) > 1000 or abs(z) > 1000:
-                        idx = idx + 8
-                        continue
-
-                    index = OBJECTS.index(PNG_MAPPING[png_filename])
-                    bow[index] = 1
-                    x_coords[index] = x
-                    y_coords[index] = y
-                    z_coords[index] = z
-
-                    idx = idx + 8
-
-                meta_data = []
-                for e in range(len(OBJECTS)):
-                    object_meta = str.join(',',
-                                           [str(bow[e]),
-                                            str(x_coords[e]),
-                                            str(y_coords[e]),
-                                            str(z_coords[e])])
-                    meta_data.append(object_meta)
-
-                extracted_objects_file.write('Scene{}_{}\t{}\n'.format(scene_id,
-                                                                       turn_id,
-                                                                       str.join(' ', meta_data)))
+                scene_ids.append(scene_id)
+                turn_ids.append(turn_id)
+                abs_d.append(dialog['abs_d'])
+
+    # parse all turns at once and drop objects placed outside of the scene
+    clipart = parse_abs_d(abs_d, png_names, png_objects)
+    outliers = (np.abs(clipart['x']) > 1000) | (np.abs(clipart['y']) > 1000) | (np.abs(clipart['z']) > 1000)
+    kept = clipart[~outliers]
+
+    # an object drawn twice in a turn keeps its last position
+    object_keys = kept['turn'].astype(np.int64) * len(OBJECTS) + kept['object_id']
+    _, last = np.unique(object_keys[::-1], return_index=True)
+    kept = kept[::-1][last]
+
+    # bow and x, y, z coordinates of every object; coordinates are -1 for objects not in the scene
+    objects = np.full((len(abs_d), len(OBJECTS), 4), -1, dtype=np.int16)
+    objects[:, :, 0] = 0
+    objects[kept['turn'], kept['object_id']] = np.stack(
+        [np.ones(len(kept)), kept['x'], kept['y'], kept['z']], axis=1).astype(np.int16)
+
+    save_extracted_coords(keys['codraw_extracted_coordinates'], scene_ids, turn_ids, objects, clipart)
 
 
 if __name__ == '__main__':
     extract_object_names()
     extract_objects()
+    # flat table of the spelling corrections obtained via Bing Spell Check API
+    convert_spell_check(keys['codraw_spell_check'], keys['codraw_spell_check_table'])
@@ -3,9 +3,10 @@
 """
 Script to parse and read CoDraw data and save it in HDF5 format for Object Detector & Localizer
 """
+import argparse
 from glob import glob
-import json
 import os
+import sys
 
 import cv2
 import h5py
@@ -13,88 +14,297 @@ import numpy as np
 from tqdm import tqdm
 import yaml
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from codraw_utils import ExtractedCoords, scene_image_files  # noqa: E402
+from utils.frame_table import FrameTable  # noqa: E402
+from utils.image_loader import ImageCache, ImageLoader, size_suffix  # noqa: E402
+from utils.instrumentation import load_json, report  # noqa: E402
+from utils.manifest import BuildManifest  # noqa: E402
+from utils.packed_writer import PackedWriter  # noqa: E402
+from utils.partitions import merge_partitions, partition_of, partition_path, write_partition_log  # noqa: E402
+from utils.schema import SCHEMAS  # noqa: E402
+from utils.storage import create_dataset, load_storage_profile  # noqa: E402
+
 
 with open('config.yml', 'r') as f:
     keys = yaml.load(f, Loader=yaml.FullLoader)
 
 
-def create_object_detection_dataset():
+def read_scene(scene_file, scene, extracted_coords):
+    # objects and coordinates of every turn of a loaded scene json with an image, and the image files
+    images_path = keys['codraw_images']
+
+    # identify if scene belongs to train / val / test
+    split = scene_file.split('/')[-1].split('_')[0]
+    scene_id = scene['image_id']
+
+    # loop over turns in a single scene
+    idx = 0
+    turns = []
+    image_files = []
+    for i in range(len(scene['dialog'])):
+        turn = scene['dialog'][i]
+
+        bow, coords = extracted_coords[scene_id, idx]
+
+        # if there is no image for current turn: merge with next turn
+        if turn['abs_d'] == '':
+            continue
+
+        turns.append((bow, coords))
+        image_files.append(os.path.join(images_path, 'Scene{}_{}.png'.format(scene_id, idx)))
+        idx += 1
+
+    return (split, scene_id, turns), image_files
+
+
+def read_scenes(scene_files, extracted_coords):
+    # yield the objects and coordinates of every turn with an image, together with the image files
+    for scene_file in scene_files:
+        scene = load_json(scene_file)
+        yield read_scene(scene_file, scene, extracted_coords)
+
+
+def write_sample(ex, image, bow, coords, scene_id, storage_profile, image_id=None):
+    # with an image_id (row of the frames table of the file), the image is not stored in the group
+    if image_id is None:
+        create_dataset(ex, 'image', image, storage_profile)
+    else:
+        create_dataset(ex, 'image_id', image_id, storage_profile)
+    create_dataset(ex, 'objects', np.array(bow), storage_profile)
+    create_dataset(ex, 'coords', np.array(coords), storage_profile)
+    create_dataset(ex, 'scene_id', scene_id, storage_profile)
+
+
+class SampleWriter:
+    """Writes the samples of read scenes to the train / val / test files, one group per turn or packed.
+
+    The samples get the coordinates of output resolution ``size_index`` (the images are already resized).
+    ``scene_groups`` holds the split and group names written for every scene in the groups layout.
+    With ``dedup``, every file stores its distinct images once in a FrameTable, and the samples hold the
+    ``image_id`` row of it instead of their ``image``.
+    """
+
+    def __init__(self, h5_files, layout, storage_profile, size_index=0, dedup=False):
+        self.h5_files = h5_files
+        self.layout = layout
+        self.storage_profile = storage_profile
+        self.size_index = size_index
+        self.counters = {'train': -1, 'val': -1, 'test': -1}
+        self.scene_groups = []
+        self.packed_writers = {}
+        if layout == 'packed':
+            self.packed_writers = {split: PackedWriter(h5, storage_profile) for split, h5 in h5_files.items()}
+        self.frame_tables = {}
+        if dedup:
+            self.frame_tables = {split: FrameTable(h5, storage_profile) for split, h5 in h5_files.items()}
+
+    def write(self, scene_data, images):
+        split, scene_id, turns = scene_data
+        turns = [(bow, coords[self.size_index]) for bow, coords in turns]
+        image_ids = self.frame_tables[split].add(images) if self.frame_tables else [None] * len(images)
+        # packed layout: row i of every dataset holds the sample of group i of the groups layout
+        if self.layout == 'packed':
+            packed = self.packed_writers[split]
+            if self.frame_tables:
+                packed.append('image_ids', image_ids)
+            else:
+                packed.append('images', images)
+            packed.append('objects', [bow for bow, _ in turns])
+            packed.append('coords', [coords for _, coords in turns])
+            packed.append('scene_id', [scene_id] * len(turns))
+            return
+
+        names = []
+        for (bow, coords), image, image_id in zip(turns, images, image_ids):
+            self.counters[split] += 1
+            names.append(str(self.counters[split]))
+            ex = self.h5_files[split].create_group(names[-1])
+            write_sample(ex, image, bow, coords, scene_id, self.storage_profile, image_id)
+        self.scene_groups.append((split, names))
+
+    def close(self):
+        for packed in self.packed_writers.values():
+            packed.close()
+        for frame_table in self.frame_tables.values():
+            frame_table.close()
+
+
+def write_h5(h5_files, scene_jobs, num_scenes, layout, storage_profile, image_loader, dedup=False):
+    # start saving data into hdf5; loop over all scenes while the loader decodes their images.
+    # h5_files holds the files of every output resolution of the loader
+    sample_writers = [SampleWriter(files, layout, storage_profile, k, dedup) for k, files in enumerate(h5_files)]
+    for scene_data, images in tqdm(image_loader.imap(scene_jobs), total=num_scenes):
+        with report.timer('hdf5_write'):
+            for sample_writer, size_images in zip(sample_writers, images):
+                sample_writer.write(scene_data, size_images)
+    with report.timer('hdf5_write'):
+        for sample_writer in sample_writers:
+            sample_writer.close()
+    return sample_writers[0].scene_groups
+
+
+def update_h5(manifest, h5_files, scene_files, extracted_coords, storage_profile, image_loader):
+    # fingerprint every scene; only the scenes whose inputs changed are read again
+    images_path = keys['codraw_images']
+    fingerprints = {scene_file: manifest.fingerprint(scene_file, scene_image_files(scene_file, images_path))
+                    for scene_file in scene_files}
+    changed = [scene_file for scene_file in scene_files
+               if not manifest.is_current(scene_file, fingerprints[scene_file], h5_files)]
+    scene_jobs = dict(zip(changed, read_scenes(changed, extracted_coords)))
+
+    # number the groups as a full build would: one group per turn with an image
+    counters = {'train': 0, 'val': 0, 'test': 0}
+    group_names = {}
+    for scene_file in scene_files:
+        split = scene_file.split('/')[-1].split('_')[0]
+        if scene_file in scene_jobs:
+            num_groups = len(scene_jobs[scene_file][0][2])
+        else:
+            num_groups = manifest.num_groups(scene_file)
+        group_names[scene_file] = [str(counters[split] + i) for i in range(num_groups)]
+        counters[split] += num_groups
+    manifest.reorganize(h5_files, {scene_file: group_names[scene_file] for scene_file in scene_files
+                                   if scene_file not in scene_jobs})
+
+    # add the changed scenes' data to hdf5; incremental builds write a single resolution
+    jobs = (((scene_file, scene_jobs[scene_file][0]), scene_jobs[scene_file][1]) for scene_file in changed)
+    for (scene_file, (split, scene_id, turns)), (images,) in tqdm(image_loader.imap(jobs), total=len(changed)):
+        with report.timer('hdf5_write'):
+            for name, (bow, coords), image in zip(group_names[scene_file], turns, images):
+                write_sample(h5_files[split].create_group(name), image, bow, coords[0], scene_id, storage_profile)
+            manifest.record(scene_file, fingerprints[scene_file], split, group_names[scene_file], h5_files)
+    manifest.save(h5_files)
+
+
+def create_object_detection_dataset(layout='groups', storage_profile=None, incremental=False, report_path=None,
+                                    num_partitions=1, partition=None, image_sizes=None, image_cache=False, schema=None,
+                                    dedup_frames=False):
     # load required keys
+    image_sizes = image_sizes or [keys['image_size']]
+    options = {'layout': layout, 'storage_profile': storage_profile, 'incremental': incremental,
+               'num_partitions': num_partitions, 'partition': partition, 'image_sizes': image_sizes,
+               'image_cache': image_cache, 'schema': schema, 'dedup_frames': dedup_frames}
+    storage_profile = load_storage_profile(keys, storage_profile, schema)
     scenes_path = keys['codraw_scenes']
-    images_path = keys['codraw_images']
     background_img = cv2.imread(keys['codraw_background'])
     h5_path = keys['codraw_hdf5_folder']
     codraw_extracted_coords = keys['codraw_extracted_coordinates']
 
-    # set height, width, scaling parameters
+    # set height, width, scaling parameters of every output resolution
     h, w, _ = background_img.shape
-    scale_x = 128. / w
-    scale_y = 128. / h
-    scaling_ratio = np.array([scale_x, scale_y, 1])
-
-    # create hdf5 files for train, val, test
-    h5_train = h5py.File(os.path.join(h5_path, 'codraw_obj_train.h5'), 'w')
-    h5_val = h5py.File(os.path.join(h5_path, 'codraw_obj_val.h5'), 'w')
-    h5_test = h5py.File(os.path.join(h5_path, 'codraw_obj_test.h5'), 'w')
-
-    # set objects and bow (bag of words) dicts for each image
-    bow_dim = 0
-    GT_BOW = {}
-    GT_OBJECTS = {}
-    with open(codraw_extracted_coords, 'r') as f:
-        for line in f:
-            splits = line.split('\t')
-            image = splits[0]
-            split_coords = lambda x: [int(c) for c in x.split(',')]
-            bow = np.array([split_coords(b) for b in splits[1].split()])
-            bow_dim = len(bow)
-            GT_BOW[image] = bow[:, 0]
-            scaling = scaling_ratio * np.expand_dims(bow[:, 0], axis=1).repeat(3, 1)
-            GT_OBJECTS[image] = (bow[:, 1:] * scaling).astype(int)
-
-    # start saving data into hdf5; loop over all scenes
-    c_train = -1
-    c_val = -1
-    c_test = -1
-    for scene_file in tqdm(sorted(glob('{}/*json'.format(scenes_path)))):
-        # identify if scene belongs to train / val / test
-        split = scene_file.split('/')[-1].split('_')[0]
+    scaling_ratios = [np.array([image_size / w, image_size / h, 1]) for image_size in image_sizes]
 
-        with open(scene_file, 'r') as f:
-            scene = json.load(f)
-        scene_id = scene['image_id']
+    # incremental builds keep the groups of unchanged scenes from the previous build
+    file_mode = 'w'
+    suffixes = [size_suffix(image_size, keys['image_size']) for image_size in image_sizes]
+    if partition is not None and (incremental or layout != 'groups'):
+        raise ValueError('Partitioned builds are only supported for full builds with the groups layout')
+    if incremental and len(image_sizes) > 1:
+        raise ValueError('Incremental builds write one resolution at a time')
+    if dedup_frames and (incremental or partition is not None):
+        raise ValueError('Deduplicated frames are only written by full, unpartitioned HDF5 builds')
+    if incremental:
+        if layout != 'groups':
+            raise ValueError('Incremental builds are only supported for the groups layout')
+        manifest = BuildManifest(os.path.join(h5_path, 'codraw_obj{}_manifest.json'.format(suffixes[0])),
+                                 [keys['codraw_background'], codraw_extracted_coords],
+                                 options={'storage_profile': storage_profile, 'image_size': image_sizes[0],
+                                          'layout': layout, 'dedup_frames': dedup_frames})
+        file_mode = manifest.file_mode
 
-        # loop over turns in a single scene
-        idx = 0
-        for i in range(len(scene['dialog'])):
-            turn = scene['dialog'][i]
+    # create hdf5 files for train, val, test of every resolution; a partitioned build writes partial files,
+    # see merge_h5
+    h5_files = []
+    for suffix in suffixes:
+        h5_paths = {split: os.path.join(h5_path, 'codraw_obj_{}{}.h5'.format(split, suffix))
+                    for split in ('train', 'val', 'test')}
+        if partition is not None:
+            h5_paths = {split: partition_path(path, partition, num_partitions) for split, path in h5_paths.items()}
+        report.track_outputs(h5_paths.values(), file_mode)
+        h5_train = h5py.File(h5_paths['train'], file_mode)
+        h5_val = h5py.File(h5_paths['val'], file_mode)
+        h5_test = h5py.File(h5_paths['test'], file_mode)
+        h5_files.append({'train': h5_train, 'val': h5_val, 'test': h5_test})
 
-            bow = GT_BOW['Scene{}_{}'.format(scene_id, idx)]
-            coords = GT_OBJECTS['Scene{}_{}'.format(scene_id, idx)]
+    # set objects and bow (bag of words) for each image
+    extracted_coords = ExtractedCoords(codraw_extracted_coords, scaling_ratios)
+    image_loader = ImageLoader(image_sizes, ImageCache(keys['image_cache']) if image_cache else None)
 
-            # if there is no image for current turn: merge with next turn
-            if turn['abs_d'] == '':
-                continue
+    scene_files = sorted(glob('{}/*json'.format(scenes_path)))
+    if partition is not None:
+        scene_files = [f for f in scene_files if partition_of(f, num_partitions) == partition]
+    if incremental:
+        update_h5(manifest, h5_files[0], scene_files, extracted_coords, storage_profile, image_loader)
+    else:
+        scene_groups = write_h5(h5_files, read_scenes(scene_files, extracted_coords), len(scene_files), layout,
+                                storage_profile, image_loader, dedup_frames)
+        if partition is not None:
+            write_partition_log(partition_path(os.path.join(h5_path, 'codraw_obj_scenes.json'), partition,
+                                               num_partitions), scene_files, scene_groups)
 
-            image = cv2.imread(os.path.join(images_path, 'Scene{}_{}.png'.format(scene_id, idx)))
-            image = cv2.resize(image, (128, 128))
-            idx += 1
+    for files in h5_files:
+        for h5 in files.values():
+            h5.close()
+    report.write(report_path or os.path.join(h5_path, 'codraw_obj_report.json'), 'codraw_object_detection', options)
 
-            if split == 'train':
-                c_train += 1
-                ex = h5_train.create_group(str(c_train))
-            elif split == 'val':
-                c_val += 1
-                ex = h5_val.create_group(str(c_val))
-            elif split == 'test':
-                c_test += 1
-                ex = h5_test.create_group(str(c_test))
 
-            ex.create_dataset('image', data=image)
-            ex.create_dataset('objects', data=np.array(bow))
-            ex.create_dataset('coords', data=np.array(coords))
-            ex.create_dataset('scene_id', data=scene_id)
+def merge_h5(num_partitions, link=False, report_path=None, image_sizes=None):
+    # combine the partial files of a partitioned build; groups are numbered in the order of the sorted scenes
+    image_sizes = image_sizes or [keys['image_size']]
+    h5_path = keys['codraw_hdf5_folder']
+    scene_files = sorted(glob('{}/*json'.format(keys['codraw_scenes'])))
+    # the partition logs are the same for every resolution
+    for image_size in image_sizes:
+        suffix = size_suffix(image_size, keys['image_size'])
+        h5_paths = {split: os.path.join(h5_path, 'codraw_obj_{}{}.h5'.format(split, suffix))
+                    for split in ('train', 'val', 'test')}
+        report.track_outputs(h5_paths.values())
+        with report.timer('hdf5_write'):
+            merge_partitions(h5_paths, os.path.join(h5_path, 'codraw_obj_scenes.json'), num_partitions, scene_files,
+                             link=link)
+    report.write(report_path or os.path.join(h5_path, 'codraw_obj_report.json'), 'codraw_object_detection',
+                 {'num_partitions': num_partitions, 'merge': True, 'link': link, 'image_sizes': image_sizes})
 
 
 if __name__ == '__main__':
-    create_object_detection_dataset()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--layout', choices=['groups', 'packed'], default='groups',
+                        help='one HDF5 group per sample (groups) or one contiguous dataset per field (packed)')
+    parser.add_argument('--storage-profile', default=None,
+                        help='HDF5 chunking/compression profile from config.yml (default: hdf5_storage_profile)')
+    parser.add_argument('--schema', choices=SCHEMAS, default=None,
+                        help='dtypes of the HDF5 datasets: default, or compact (bit-packed objects, narrowest exact '
+                             'coordinate type, integer scene ids) (default: schema of the storage profile)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only process scenes whose inputs changed since the last (possibly interrupted) build')
+    parser.add_argument('--report', default=None,
+                        help='JSON run report with the time per stage, bytes read and written and peak memory '
+                             '(default: codraw_obj_report.json in the HDF5 folder)')
+    parser.add_argument('--num-partitions', type=int, default=1,
+                        help='number of independent jobs of a partitioned build')
+    parser.add_argument('--partition', type=int, default=None,
+                        help='build the partial files of the scenes of this partition (0 to num-partitions - 1)')
+    parser.add_argument('--merge', action='store_true',
+                        help='combine the partial files of all partitions into the final files')
+    parser.add_argument('--merge-links', action='store_true',
+                        help='merge with external links to the partial files instead of copying their groups')
+    parser.add_argument('--dedup-frames', action='store_true',
+                        help='store identical images once per file, in a `frames` table referenced by the '
+                             '`image_id` of the samples, and report the deduplication ratio')
+    parser.add_argument('--image-sizes', type=int, nargs='+', default=None,
+                        help='sides of the square output images, all resized from a single decode of every image '
+                             '(default: image_size from config.yml)')
+    parser.add_argument('--image-cache', action='store_true',
+                        help='keep the resized images in image_cache (config.yml), one uncompressed file per image '
+                             'and size, and read them instead of decoding the images again in later builds')
+    args = parser.parse_args()
+
+    if args.merge:
+        merge_h5(args.num_partitions, link=args.merge_links, report_path=args.report, image_sizes=args.image_sizes)
+    else:
+        create_object_detection_dataset(layout=args.layout, storage_profile=args.storage_profile,
+                                        incremental=args.incremental, report_path=args.report,
+                                        num_partitions=args.num_partitions, partition=args.partition,
+                                        image_sizes=args.image_sizes, image_cache=args.image_cache,
+                                        schema=args.schema, dedup_frames=args.dedup_frames)
@@ -3,185 +3,515 @@
 """
 Script to parse and read raw CoDraw data and save it in HDF5 format for GeNeVA-GAN
 """
+import argparse
+import functools
 from glob import glob
-import json
+import multiprocessing
 import os
-import pickle
-import string
+import sys
 
 import cv2
 import h5py
-import nltk
 import numpy as np
 from tqdm import tqdm
 import yaml
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from codraw_object_detection import read_scene, SampleWriter  # noqa: E402
+from codraw_text import normalize_messages  # noqa: E402
+from codraw_utils import ExtractedCoords, scene_image_files  # noqa: E402
+from utils.frame_table import FrameTable  # noqa: E402
+from utils.image_loader import ImageCache, ImageLoader, size_suffix  # noqa: E402
+from utils.instrumentation import instrumented_map, load_json, report  # noqa: E402
+from utils.manifest import BuildManifest  # noqa: E402
+from utils.packed_writer import PackedWriter  # noqa: E402
+from utils.partitions import merge_partitions, partition_of, partition_path, write_partition_log  # noqa: E402
+from utils.sample_index import INDEX, write_index  # noqa: E402
+from utils.schema import SCHEMAS  # noqa: E402
+from utils.shard_writer import ShardWriter  # noqa: E402
+from utils.storage import create_dataset, load_storage_profile  # noqa: E402
+from utils.token_ids import Vocabulary, vocab_path  # noqa: E402
+
 
 with open('config.yml', 'r') as f:
     keys = yaml.load(f, Loader=yaml.FullLoader)
 
-
-def replace_at_offset(msg, tok, offset, tok_replace):
-    before = msg[:offset]
-    after = msg[offset:]
-    after = after.replace(tok, tok_replace, 1)
-    return before + after
+# per-process data shared by all scenes; filled in by load_scene_context
+scene_context = {}
 
 
-def create_h5():
-    # load required keys
-    scenes_path = keys['codraw_scenes']
-    images_path = keys['codraw_images']
+def load_scene_context(normalized_text=None, image_sizes=(128,)):
+    # load everything needed to process a single scene; runs once per process
+    if scene_context:
+        return
     background_img = cv2.imread(keys['codraw_background'])
-    h5_path = keys['codraw_hdf5_folder']
-    spell_check = keys['codraw_spell_check']
     codraw_extracted_coords = keys['codraw_extracted_coordinates']
 
-    # set height, width, scaling parameters
+    # set height, width, scaling parameters of every output resolution
     h, w, _ = background_img.shape
-    scale_x = 128. / w
-    scale_y = 128. / h
-    scaling_ratio = np.array([scale_x, scale_y, 1])
-    background_img = cv2.resize(background_img, (128, 128))
-
-    # load spelling corrections - obtained via Bing Spell Check API
-    with open(spell_check, 'rb') as f:
-        spell_check = pickle.load(f)
-
-    # create hdf5 files for train, val, test
-    h5_train = h5py.File(os.path.join(h5_path, 'codraw_train.h5'), 'w')
-    h5_val = h5py.File(os.path.join(h5_path, 'codraw_val.h5'), 'w')
-    h5_test = h5py.File(os.path.join(h5_path, 'codraw_test.h5'), 'w')
-    h5_train.create_dataset('background', data=background_img)
-    h5_val.create_dataset('background', data=background_img)
-    h5_test.create_dataset('background', data=background_img)
-
-    # set objects and bow (bag of words) dicts for each image
-    bow_dim = 0
-    GT_BOW = {}
-    GT_OBJECTS = {}
-    with open(codraw_extracted_coords, 'r') as f:
-        for line in f:
-            splits = line.split('\t')
-            image = splits[0]
-            split_coords = lambda x: [int(c) for c in x.split(',')]
-            bow = np.array([split_coords(b) for b in splits[1].split()])
-            bow_dim = len(bow)
-            GT_BOW[image] = bow[:, 0]
-            scaling = scaling_ratio * np.expand_dims(bow[:, 0], axis=1).repeat(3, 1)
-            GT_OBJECTS[image] = (bow[:, 1:] * scaling).astype(int)
-
-    # mark purely chitchat turns to be removed
-    chitchat = ['hi', 'done', 'ok', 'alright', 'okay', 'thanks', 'bye', 'hello']
-
-    # start saving data into hdf5; loop over all scenes
-    c_train = 0
-    c_val = 0
-    c_test = 0
-    for scene_file in tqdm(sorted(glob('{}/*json'.format(scenes_path)))):
-        # identify if scene belongs to train / val / test
-        split = scene_file.split('/')[-1].split('_')[0]
+    scaling_ratios = [np.array([image_size / w, image_size / h, 1]) for image_size in image_sizes]
+
+    # set objects and bow (bag of words) for each image
+    extracted_coords = ExtractedCoords(codraw_extracted_coords, scaling_ratios)
+
+    scene_context.update(background_img=background_img, extracted_coords=extracted_coords,
+                         normalized_text=normalized_text)
+
+
+def process_scene(scene_file, scene=None):
+    # parse a single scene json: normalize its messages and collect the image files of the kept turns
+    images_path = keys['codraw_images']
+    extracted_coords = scene_context['extracted_coords']
+    normalized_text = scene_context['normalized_text']
+
+    # identify if scene belongs to train / val / test
+    split = scene_file.split('/')[-1].split('_')[0]
+
+    image_files = []
+    utterences = []
+    objects = []
+    coordinates = []
+
+    if scene is None:
+        scene = load_json(scene_file)
+    scene_id = scene['image_id']
+
+    # loop over turns in a single scene
+    idx = 0
+    prev_bow = np.zeros((extracted_coords.bow_dim))
+    description = []
+    for i in range(len(scene['dialog'])):
+        bow, coords = extracted_coords[scene_id, idx]
+        # new objects added in this turn
+        hamming_distance = np.sum(bow - prev_bow)
+        turn = scene['dialog'][i]
+        # messages lowercased, cleared of chitchat, spell-checked and tokenized by the text normalization stage
+        teller = normalized_text[turn['msg_t']]
+        drawer = normalized_text[turn['msg_d']]
+        report.count('turns')
+        if not teller and not drawer:
+            report.count('chitchat_only_turns')
+
+        # add delimiting tokens: <teller>, <drawer>
+        if teller is not None:
+            description += ['<teller>'] + teller
+        if drawer is not None:
+            description += ['<drawer>'] + drawer
+
+        # if there is no image for current turn: merge with next turn
+        if turn['abs_d'] == '':
+            report.count('merged_turns')
+            continue
+
+        # if no new object is added in image for current turn: merge with next turn
+        if hamming_distance < 1:
+            report.count('merged_turns')
+            prev_bow = bow
+            idx += 1
+            continue
+
+        # queue image, instruction, objects bow, object coordinates for saving
+        if len(description) > 0:
+            image_files.append(os.path.join(images_path, 'Scene{}_{}.png'.format(scene_id, idx)))
+            utterences.append(str.join(' ', description))
+            objects.append(bow)
+            coordinates.append(coords)
+
+            description = []
+            idx += 1
+            prev_bow = bow
+        else:
+            # new objects without any instruction: the turn is not saved
+            report.count('dropped_turns')
+
+    return (split, scene_id, utterences, objects, coordinates), image_files
+
+
+def process_scene_with_objects(scene_file):
+    # process a scene for both datasets from a single read of its json
+    scene = load_json(scene_file)
+    return process_scene(scene_file, scene), read_scene(scene_file, scene, scene_context['extracted_coords'])
+
+
+def write_scene(scene, images, utterences, objects, coordinates, scene_id, storage_profile, image_ids=None,
+                vocab=None):
+    # with image_ids (rows of the frames table of the file), the images are not stored in the group; with a
+    # vocabulary, the token ids of the utterances are stored next to them
+    if image_ids is None:
+        create_dataset(scene, 'images', images, storage_profile)
+    else:
+        create_dataset(scene, 'image_ids', image_ids, storage_profile)
+    dt = h5py.special_dtype(vlen=str)
+    create_dataset(scene, 'utterences', np.string_(utterences), storage_profile, dtype=dt)
+    if vocab is not None:
+        token_ids, token_lengths = vocab.encode(utterences)
+        create_dataset(scene, 'token_ids', token_ids, storage_profile)
+        create_dataset(scene, 'token_lengths', token_lengths, storage_profile)
+    create_dataset(scene, 'objects', np.array(objects), storage_profile)
+    create_dataset(scene, 'coords', np.array(coordinates), storage_profile)
+    create_dataset(scene, 'scene_id', scene_id, storage_profile)
+
+
+class SceneWriter:
+    """Writes processed scenes to the train / val / test files, one group per scene or packed.
 
-        images = []
-        utterences = []
-        objects = []
-        coordinates = []
-
-        with open(scene_file, 'r') as f:
-            scene = json.load(f)
-        scene_id = scene['image_id']
-
-        # loop over turns in a single scene
-        idx = 0
-        prev_bow = np.zeros((bow_dim))
-        description = []
-        for i in range(len(scene['dialog'])):
-            bow = GT_BOW['Scene{}_{}'.format(scene_id, idx)]
-            # new objects added in this turn
-            hamming_distance = np.sum(bow - prev_bow)
-            turn = scene['dialog'][i]
-            # lowercase all messages
-            teller = str.lower(turn['msg_t'])
-            drawer = str.lower(turn['msg_d'])
-            # clear chitchat turns
-            if teller in chitchat:
-                teller = ''
-            if drawer in chitchat:
-                drawer = ''
-
-            # replace with spelling suggestions returned by Bing Spell Check API
-            if teller in spell_check and len(spell_check[teller]['flaggedTokens']) != 0:
-                for flagged_token in spell_check[teller]['flaggedTokens']:
-                    tok = flagged_token['token']
-                    tok_offset = flagged_token['offset']
-                    assert len(flagged_token['suggestions']) == 1
-                    tok_replace = flagged_token['suggestions'][0]['suggestion']
-                    teller = replace_at_offset(teller, tok, tok_offset, tok_replace)
-            if drawer in spell_check and len(spell_check[drawer]['flaggedTokens']) != 0:
-                for flagged_token in spell_check[drawer]['flaggedTokens']:
-                    tok = flagged_token['token']
-                    tok_offset = flagged_token['offset']
-                    assert len(flagged_token['suggestions']) == 1
-                    tok_replace = flagged_token['suggestions'][0]['suggestion']
-                    drawer = replace_at_offset(drawer, tok, tok_offset, tok_replace)
-
-            # add delimiting tokens: <teller>, <drawer>
-            if teller != '':
-                description += ['<teller>'] + nltk.word_tokenize(teller)
-            if drawer != '':
-                description += ['<drawer>'] + nltk.word_tokenize(drawer)
-
-            description = [w for w in description if w not in chitchat]
-            description = [w for w in description if w not in string.punctuation]
-
-            bow = GT_BOW['Scene{}_{}'.format(scene_id, idx)]
-            coords = GT_OBJECTS['Scene{}_{}'.format(scene_id, idx)]
-
-            # if there is no image for current turn: merge with next turn
-            if turn['abs_d'] == '':
-                continue
-
-            # if no new object is added in image for current turn: merge with next turn
-            if hamming_distance < 1:
-                prev_bow = bow
-                idx += 1
-                continue
-
-            # queue image, instruction, objects bow, object coordinates for saving
-            if len(description) > 0:
-                image = cv2.imread(os.path.join(images_path, 'Scene{}_{}.png'.format(scene_id, idx)))
-                image = cv2.resize(image, (128, 128))
-
-                images.append(image)
-                utterences.append(str.join(' ', description))
-                objects.append(bow)
-                coordinates.append(coords)
-
-                description = []
-                idx += 1
-                prev_bow = bow
+    With the shards layout, ``h5_files`` holds a ShardWriter per split instead of the HDF5 files. The scenes
+    get the coordinates of output resolution ``size_index`` (the images are already resized).
+    ``scene_groups`` holds the split and group names written for every scene in the groups layout.
+    With ``dedup``, every file stores its distinct images once in a FrameTable, and the scenes hold
+    ``image_ids`` rows of it instead of their ``images``. With a ``vocab`` (Vocabulary), the token ids of the
+    utterances are written as well.
+    """
 
+    def __init__(self, h5_files, layout, storage_profile, size_index=0, dedup=False, vocab=None):
+        self.h5_files = h5_files
+        self.layout = layout
+        self.storage_profile = storage_profile
+        self.size_index = size_index
+        self.vocab = vocab
+        self.counters = {'train': 0, 'val': 0, 'test': 0}
+        self.scene_groups = []
+        self.packed_writers = {}
+        if layout == 'packed':
+            self.packed_writers = {split: PackedWriter(h5, storage_profile) for split, h5 in h5_files.items()}
+        self.frame_tables = {}
+        if dedup:
+            self.frame_tables = {split: FrameTable(h5, storage_profile) for split, h5 in h5_files.items()}
+
+    def write(self, scene_data, images):
+        split, scene_id, utterences, objects, coordinates = scene_data
+        coordinates = [coords[self.size_index] for coords in coordinates]
+        image_ids = self.frame_tables[split].add(images) if self.frame_tables and len(images) > 0 else None
         # add current scene's data to hdf5
-        if len(images) > 0:
-            if split == 'train':
-                scene = h5_train.create_group(str(c_train))
-                c_train += 1
-            elif split == 'val':
-                scene = h5_val.create_group(str(c_val))
-                c_val += 1
-            elif split == 'test':
-                scene = h5_test.create_group(str(c_test))
-                c_test += 1
-
-            scene.create_dataset('images', data=images)
-            dt = h5py.special_dtype(vlen=str)
-            scene.create_dataset('utterences', data=np.string_(utterences), dtype=dt)
-            scene.create_dataset('objects', data=np.array(objects))
-            scene.create_dataset('coords', data=np.array(coordinates))
-            scene.create_dataset('scene_id', data=scene_id)
+        if len(images) > 0 and self.layout == 'packed':
+            # packed layout: turns of all scenes are concatenated, scene_offsets holds (first row, number of turns)
+            packed = self.packed_writers[split]
+            images_name = 'images' if image_ids is None else 'image_ids'
+            packed.append('scene_offsets', [[packed.size(images_name), len(images)]])
+            packed.append('scene_id', [scene_id])
+            packed.append(images_name, images if image_ids is None else image_ids)
+            packed.append('utterences', utterences)
+            if self.vocab is not None:
+                # token ids of all scenes concatenated, token_offsets holds (first token, number of tokens)
+                token_ids, token_lengths = self.vocab.encode(utterences)
+                packed.append('token_offsets', [[packed.size('token_ids'), len(token_ids)]])
+                packed.append('token_ids', token_ids)
+                packed.append('token_lengths', token_lengths)
+            packed.append('objects', objects)
+            packed.append('coords', coordinates)
+        elif len(images) > 0 and self.layout == 'shards':
+            self.h5_files[split].write(scene_id, {'images': np.array(images), 'utterences': np.array(utterences),
+                                                  'objects': np.array(objects), 'coords': np.array(coordinates),
+                                                  'scene_id': scene_id})
+        elif len(images) > 0:
+            name = str(self.counters[split])
+            scene = self.h5_files[split].create_group(name)
+            self.scene_groups.append((split, [name]))
+            self.counters[split] += 1
+            write_scene(scene, images, utterences, objects, coordinates, scene_id, self.storage_profile, image_ids,
+                        self.vocab)
         else:
-            print(scene_id)
+            self.scene_groups.append((split, []))
+            # reported once, by the writer of the first resolution
+            if self.size_index == 0:
+                report.count('dropped_scenes')
+                print(scene_id)
+
+    def close(self):
+        for packed in self.packed_writers.values():
+            packed.close()
+        for frame_table in self.frame_tables.values():
+            frame_table.close()
+
+
+def write_h5(h5_files, processed_scenes, num_scenes, layout, storage_profile, image_loader, dedup=False,
+             vocab=None):
+    # start saving data into hdf5; loop over all scenes. h5_files holds the files of every output
+    # resolution of the loader
+    scene_writers = [SceneWriter(files, layout, storage_profile, k, dedup, vocab) for k, files in enumerate(h5_files)]
+    for scene_data, images in tqdm(image_loader.imap(processed_scenes), total=num_scenes):
+        with report.timer('hdf5_write'):
+            for scene_writer, size_images in zip(scene_writers, images):
+                scene_writer.write(scene_data, size_images)
+    with report.timer('hdf5_write'):
+        for scene_writer in scene_writers:
+            scene_writer.close()
+    return scene_writers[0].scene_groups
+
+
+def write_combined_h5(h5_files, obj_h5_files, processed_scenes, num_scenes, layout, storage_profile, image_loader,
+                      dedup=False, vocab=None):
+    # decode the images of every turn once and write the GeNeVA-GAN and object detection datasets together;
+    # the images of the GeNeVA-GAN turns are a subset of the object detection images
+    scene_writers = [SceneWriter(files, layout, storage_profile, k, dedup, vocab) for k, files in enumerate(h5_files)]
+    sample_writers = [SampleWriter(files, layout, storage_profile, k, dedup) for k, files in enumerate(obj_h5_files)]
+    scene_jobs = (((scene, obj_scene, obj_image_files), obj_image_files)
+                  for scene, (obj_scene, obj_image_files) in processed_scenes)
+    for ((scene_data, image_files), obj_scene_data, obj_image_files), obj_images in tqdm(
+            image_loader.imap(scene_jobs), total=num_scenes):
+        decoded = dict(zip(obj_image_files, zip(*obj_images)))
+        images = image_loader.by_size([decoded[f] if f in decoded else image_loader.load(f) for f in image_files])
+        with report.timer('hdf5_write'):
+            for k in range(len(scene_writers)):
+                scene_writers[k].write(scene_data, images[k])
+                sample_writers[k].write(obj_scene_data, obj_images[k])
+    with report.timer('hdf5_write'):
+        for writer in scene_writers + sample_writers:
+            writer.close()
+    return scene_writers[0].scene_groups, sample_writers[0].scene_groups
+
+
+def update_h5(manifest, h5_files, scene_files, map_scenes, storage_profile, image_loader, vocab=None):
+    # fingerprint every scene; only the scenes whose inputs changed are processed again
+    images_path = keys['codraw_images']
+    fingerprints = {scene_file: manifest.fingerprint(scene_file, scene_image_files(scene_file, images_path))
+                    for scene_file in scene_files}
+    changed = [scene_file for scene_file in scene_files
+               if not manifest.is_current(scene_file, fingerprints[scene_file], h5_files)]
+    processed_scenes = dict(zip(changed, instrumented_map(map_scenes, process_scene, changed)))
+
+    # number the groups as a full build would; scenes without images get no group
+    counters = {'train': 0, 'val': 0, 'test': 0}
+    group_names = {}
+    for scene_file in scene_files:
+        split = scene_file.split('/')[-1].split('_')[0]
+        if scene_file in processed_scenes:
+            num_groups = 1 if len(processed_scenes[scene_file][1]) > 0 else 0
+        else:
+            num_groups = manifest.num_groups(scene_file)
+        group_names[scene_file] = [str(counters[split] + i) for i in range(num_groups)]
+        counters[split] += num_groups
+    manifest.reorganize(h5_files, {scene_file: group_names[scene_file] for scene_file in scene_files
+                                   if scene_file not in processed_scenes})
+
+    # add the changed scenes' data to hdf5; incremental builds write a single resolution
+    scene_jobs = (((scene_file, processed_scenes[scene_file][0]), processed_scenes[scene_file][1])
+                  for scene_file in changed)
+    for (scene_file, scene_data), (images,) in tqdm(image_loader.imap(scene_jobs), total=len(changed)):
+        split, scene_id, utterences, objects, coordinates = scene_data
+        with report.timer('hdf5_write'):
+            if len(images) > 0:
+                scene = h5_files[split].create_group(group_names[scene_file][0])
+                write_scene(scene, images, utterences, objects, [coords[0] for coords in coordinates], scene_id,
+                            storage_profile, vocab=vocab)
+            else:
+                report.count('dropped_scenes')
+                print(scene_id)
+            manifest.record(scene_file, fingerprints[scene_file], split, group_names[scene_file], h5_files)
+    manifest.save(h5_files)
+
+
+def create_h5(workers=1, layout='groups', storage_profile=None, incremental=False, object_detection=False,
+              report_path=None, shard_format='tar', samples_per_shard=1000, num_partitions=1, partition=None,
+              image_sizes=None, image_cache=False, schema=None, dedup_frames=False, token_ids=False,
+              sample_index=False):
+    # load required keys
+    image_sizes = image_sizes or [keys['image_size']]
+    options = {'workers': workers, 'layout': layout, 'storage_profile': storage_profile, 'incremental': incremental,
+               'object_detection': object_detection, 'shard_format': shard_format,
+               'samples_per_shard': samples_per_shard, 'num_partitions': num_partitions, 'partition': partition,
+               'image_sizes': image_sizes, 'image_cache': image_cache, 'schema': schema, 'dedup_frames': dedup_frames,
+               'token_ids': token_ids, 'sample_index': sample_index}
+    storage_profile = load_storage_profile(keys, storage_profile, schema)
+    scenes_path = keys['codraw_scenes']
+    h5_path = keys['codraw_hdf5_folder']
+    load_scene_context(image_sizes=image_sizes)
+
+    # incremental builds keep the groups of unchanged scenes from the previous build
+    file_mode = 'w'
+    suffixes = [size_suffix(image_size, keys['image_size']) for image_size in image_sizes]
+    if incremental and object_detection:
+        raise ValueError('Incremental builds write one dataset at a time')
+    if incremental and len(image_sizes) > 1:
+        raise ValueError('Incremental builds write one resolution at a time')
+    if layout == 'shards' and object_detection:
+        raise ValueError('Shards are only written for the GeNeVA-GAN dataset')
+    if partition is not None and (incremental or layout != 'groups'):
+        raise ValueError('Partitioned builds are only supported for full builds with the groups layout')
+    if dedup_frames and (incremental or partition is not None or layout == 'shards'):
+        raise ValueError('Deduplicated frames are only written by full, unpartitioned HDF5 builds')
+    if (token_ids or sample_index) and layout == 'shards':
+        raise ValueError('Token ids and the sample index are only written to HDF5 files')
+    # token ids are rows of the joint vocabulary of generate_glove_file.py
+    vocab = Vocabulary(vocab_path(keys)) if token_ids else None
+    if incremental:
+        if layout != 'groups':
+            raise ValueError('Incremental builds are only supported for the groups layout')
+        manifest = BuildManifest(os.path.join(h5_path, 'codraw{}_manifest.json'.format(suffixes[0])),
+                                 [keys['codraw_background'], keys['codraw_extracted_coordinates'],
+                                  keys['codraw_spell_check_table']] + ([vocab_path(keys)] if token_ids else []),
+                                 options={'storage_profile': storage_profile, 'image_size': image_sizes[0],
+                                          'layout': layout, 'dedup_frames': dedup_frames, 'token_ids': token_ids})
+        file_mode = manifest.file_mode
+
+    # create hdf5 files for train, val, test of every resolution; the shards layout writes shard folders
+    # instead, without HDF5 files. A partitioned build writes partial files of the scenes of its partition,
+    # see merge_h5
+    splits = ('train', 'val', 'test')
+    h5_files = []
+    obj_paths = []
+    for image_size, suffix in zip(image_sizes, suffixes):
+        background_img = cv2.resize(scene_context['background_img'], (image_size, image_size))
+        h5_paths = {split: os.path.join(h5_path, 'codraw_{}{}.h5'.format(split, suffix)) for split in splits}
+        obj_paths.append({split: os.path.join(h5_path, 'codraw_obj_{}{}.h5'.format(split, suffix))
+                          for split in splits})
+        if partition is not None:
+            h5_paths = {split: partition_path(path, partition, num_partitions) for split, path in h5_paths.items()}
+            obj_paths[-1] = {split: partition_path(path, partition, num_partitions)
+                             for split, path in obj_paths[-1].items()}
+
+        if layout == 'shards':
+            h5_files.append({split: ShardWriter(os.path.join(h5_path, 'codraw_{}{}_shards'.format(split, suffix)),
+                                                shard_format, samples_per_shard, shared={'background': background_img})
+                             for split in splits})
+            continue
+        report.track_outputs(h5_paths.values(), file_mode)
+        h5_train = h5py.File(h5_paths['train'], file_mode)
+        h5_val = h5py.File(h5_paths['val'], file_mode)
+        h5_test = h5py.File(h5_paths['test'], file_mode)
+        for h5 in (h5_train, h5_val, h5_test):
+            if 'background' not in h5:
+                create_dataset(h5, 'background', background_img, storage_profile)
+            if vocab is not None:
+                vocab.write_attrs(h5)
+        h5_files.append({'train': h5_train, 'val': h5_val, 'test': h5_test})
+    image_loader = ImageLoader(image_sizes, ImageCache(keys['image_cache']) if image_cache else None)
+
+    # text normalization stage: every distinct message is normalized once and cached on disk
+    scene_files = sorted(glob('{}/*json'.format(scenes_path)))
+    if partition is not None:
+        scene_files = [f for f in scene_files if partition_of(f, num_partitions) == partition]
+    with report.timer('text_normalization'):
+        scene_context['normalized_text'] = normalize_messages(scene_files, keys['codraw_spell_check_table'],
+                                                              keys['codraw_text_cache'], workers)
+
+    # process scenes in a pool of workers; results come back in scene order, so the
+    # group numbering below is the same as in a serial run. Images of processed scenes
+    # are decoded by the loader threads while earlier scenes are written
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=load_scene_context,
+                                    initargs=(scene_context['normalized_text'], image_sizes))
+        map_scenes = functools.partial(pool.imap, chunksize=8)
+    else:
+        pool = None
+        map_scenes = map
+
+    if incremental:
+        update_h5(manifest, h5_files[0], scene_files, map_scenes, storage_profile, image_loader, vocab)
+    elif object_detection:
+        # object detection files are written in the same pass, see codraw_object_detection.py
+        obj_h5_files = []
+        for paths in obj_paths:
+            report.track_outputs(paths.values())
+            obj_h5_files.append({split: h5py.File(path, 'w') for split, path in paths.items()})
+        processed_scenes = instrumented_map(map_scenes, process_scene_with_objects, scene_files)
+        scene_groups, obj_scene_groups = write_combined_h5(h5_files, obj_h5_files, processed_scenes,
+                                                           len(scene_files), layout, storage_profile, image_loader,
+                                                           dedup_frames, vocab)
+        for files in obj_h5_files:
+            for h5 in files.values():
+                h5.close()
+        if partition is not None:
+            write_partition_log(partition_path(os.path.join(h5_path, 'codraw_obj_scenes.json'), partition,
+                                               num_partitions), scene_files, obj_scene_groups)
+    else:
+        scene_groups = write_h5(h5_files, instrumented_map(map_scenes, process_scene, scene_files), len(scene_files),
+                                layout, storage_profile, image_loader, dedup_frames, vocab)
+    if partition is not None:
+        write_partition_log(partition_path(os.path.join(h5_path, 'codraw_scenes.json'), partition, num_partitions),
+                            scene_files, scene_groups)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    for files in h5_files:
+        for h5 in files.values():
+            if sample_index:
+                # per-turn index of the scenes, read by samplers instead of every group
+                write_index(h5)
+            elif layout != 'shards' and INDEX in h5:
+                # left by an earlier build of an incremental build's files
+                del h5[INDEX]
+            h5.close()
+    report.write(report_path or os.path.join(h5_path, 'codraw_report.json'), 'codraw_raw_to_hdf5', options)
+
+
+def merge_h5(num_partitions, object_detection=False, link=False, report_path=None, image_sizes=None):
+    # combine the partial files of a partitioned build; groups are numbered in the order of the sorted scenes
+    image_sizes = image_sizes or [keys['image_size']]
+    h5_path = keys['codraw_hdf5_folder']
+    scene_files = sorted(glob('{}/*json'.format(keys['codraw_scenes'])))
+    datasets = [('codraw', 'codraw_scenes.json')]
+    if object_detection:
+        datasets.append(('codraw_obj', 'codraw_obj_scenes.json'))
+    # the partition logs are the same for every resolution
+    for image_size in image_sizes:
+        suffix = size_suffix(image_size, keys['image_size'])
+        for prefix, log in datasets:
+            h5_paths = {split: os.path.join(h5_path, '{}_{}{}.h5'.format(prefix, split, suffix))
+                        for split in ('train', 'val', 'test')}
+            report.track_outputs(h5_paths.values())
+            with report.timer('hdf5_write'):
+                merge_partitions(h5_paths, os.path.join(h5_path, log), num_partitions, scene_files, link=link)
+    report.write(report_path or os.path.join(h5_path, 'codraw_report.json'), 'codraw_raw_to_hdf5',
+                 {'num_partitions': num_partitions, 'merge': True, 'object_detection': object_detection,
+                  'link': link, 'image_sizes': image_sizes})
 
 
 if __name__ == '__main__':
-    create_h5()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes used to parse scenes and normalize text')
+    parser.add_argument('--layout', choices=['groups', 'packed', 'shards'], default='groups',
+                        help='one HDF5 group per scene (groups), one contiguous dataset per field (packed), or '
+                             'tar / npz shards of scenes without HDF5 files (shards)')
+    parser.add_argument('--shard-format', choices=['tar', 'npz'], default='tar', help='file format of the shards')
+    parser.add_argument('--samples-per-shard', type=int, default=1000, help='number of scenes of every shard')
+    parser.add_argument('--storage-profile', default=None,
+                        help='HDF5 chunking/compression profile from config.yml (default: hdf5_storage_profile)')
+    parser.add_argument('--schema', choices=SCHEMAS, default=None,
+                        help='dtypes of the HDF5 datasets: default, or compact (bit-packed objects, narrowest exact '
+                             'coordinate type, integer scene ids) (default: schema of the storage profile)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only process scenes whose inputs changed since the last (possibly interrupted) build')
+    parser.add_argument('--object-detection', action='store_true',
+                        help='also write the object detection dataset (codraw_obj_*.h5), reading every scene and '
+                             'image once')
+    parser.add_argument('--report', default=None,
+                        help='JSON run report with the time per stage, bytes read and written, peak memory and '
+                             'turn counts (default: codraw_report.json in the HDF5 folder)')
+    parser.add_argument('--num-partitions', type=int, default=1,
+                        help='number of independent jobs of a partitioned build')
+    parser.add_argument('--partition', type=int, default=None,
+                        help='build the partial files of the scenes of this partition (0 to num-partitions - 1)')
+    parser.add_argument('--merge', action='store_true',
+                        help='combine the partial files of all partitions into the final files')
+    parser.add_argument('--merge-links', action='store_true',
+                        help='merge with external links to the partial files instead of copying their groups')
+    parser.add_argument('--dedup-frames', action='store_true',
+                        help='store identical turn images once per file, in a `frames` table referenced by the '
+                             '`image_ids` of the scenes, and report the deduplication ratio')
+    parser.add_argument('--sample-index', action='store_true',
+                        help='also write the per-turn index table of the scenes (root dataset index) for samplers; '
+                             'readers that count the scenes by the root keys count it as well')
+    parser.add_argument('--token-ids', action='store_true',
+                        help='also store the utterances as token ids of the joint vocabulary written by '
+                             'generate_glove_file.py (token_ids, token_lengths)')
+    parser.add_argument('--image-sizes', type=int, nargs='+', default=None,
+                        help='sides of the square output images, all resized from a single decode of every image '
+                             '(default: image_size from config.yml)')
+    parser.add_argument('--image-cache', action='store_true',
+                        help='keep the resized images in image_cache (config.yml), one uncompressed file per image '
+                             'and size, and read them instead of decoding the images again in later builds')
+    args = parser.parse_args()
+
+    if args.merge:
+        merge_h5(args.num_partitions, object_detection=args.object_detection, link=args.merge_links,
+                 report_path=args.report, image_sizes=args.image_sizes)
+    else:
+        create_h5(workers=args.workers, layout=args.layout, storage_profile=args.storage_profile,
+                  incremental=args.incremental, object_detection=args.object_detection, report_path=args.report,
+                  shard_format=args.shard_format, samples_per_shard=args.samples_per_shard,
+                  num_partitions=args.num_partitions, partition=args.partition, image_sizes=args.image_sizes,
+                  image_cache=args.image_cache, schema=args.schema, dedup_frames=args.dedup_frames,
+                  token_ids=args.token_ids, sample_index=args.sample_index)
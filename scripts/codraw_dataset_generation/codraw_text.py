@@ -0,0 +1,192 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Text normalization of the CoDraw Teller and Drawer messages, cached on disk
+"""
+import argparse
+from glob import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import string
+
+import nltk
+import numpy as np
+from tqdm import tqdm
+import yaml
+
+
+# purely chitchat messages and tokens are removed
+CHITCHAT = {'hi', 'done', 'ok', 'alright', 'okay', 'thanks', 'bye', 'hello'}
+# tokens removed as punctuation: every substring of string.punctuation, as matched by `in string.punctuation`
+PUNCTUATION = {string.punctuation[i:j] for i in range(len(string.punctuation) + 1)
+               for j in range(i, len(string.punctuation) + 1)}
+
+
+def replace_at_offset(msg, tok, offset, tok_replace):
+    before = msg[:offset]
+    after = msg[offset:]
+    after = after.replace(tok, tok_replace, 1)
+    return before + after
+
+
+def message_hash(message):
+    return int.from_bytes(hashlib.blake2b(message.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def convert_spell_check(pickle_path, table_path):
+    """Converts the pickled Bing Spell Check API responses to a flat correction table.
+
+    Only the flagged tokens are kept: for every message with corrections, keyed by the hash of the message,
+    the token, its offset, its first suggestion and the number of suggestions. ``hashes`` is sorted and
+    ``rows`` holds the first correction of every message; tokens and suggestions are stored back to back
+    in one utf-8 buffer delimited by ``string_offsets``.
+    """
+    with open(pickle_path, 'rb') as f:
+        spell_check = pickle.load(f)
+
+    # sorted by hash only: the flagged tokens of messages with the same hash cannot be compared
+    entries = sorted(((message_hash(message), response['flaggedTokens']) for message, response in spell_check.items()
+                      if len(response['flaggedTokens']) != 0), key=lambda entry: entry[0])
+    hashes = np.array([h for h, _ in entries], dtype=np.uint64)
+    if len(np.unique(hashes)) != len(hashes):
+        raise ValueError('Spell check messages with the same hash')
+
+    rows = [0]
+    token_offsets = []
+    num_suggestions = []
+    strings = []
+    for _, flagged in entries:
+        for t in flagged:
+            token_offsets.append(t['offset'])
+            num_suggestions.append(len(t['suggestions']))
+            suggestion = t['suggestions'][0]['suggestion'] if t['suggestions'] else ''
+            strings += [t['token'].encode('utf-8'), suggestion.encode('utf-8')]
+        rows.append(len(token_offsets))
+    string_offsets = np.cumsum([0] + [len(x) for x in strings])
+
+    with open(table_path, 'wb') as f:
+        np.savez(f, hashes=hashes, rows=np.array(rows, dtype=np.int64),
+                 token_offsets=np.array(token_offsets, dtype=np.int32),
+                 num_suggestions=np.array(num_suggestions, dtype=np.int16),
+                 strings=np.frombuffer(b''.join(strings), dtype=np.uint8), string_offsets=string_offsets)
+
+
+class SpellCheckTable:
+    """Spelling corrections of a correction table written by convert_spell_check, loaded on first use"""
+
+    def __init__(self, path):
+        self.path = path
+        self.table = None
+
+    def flagged_tokens(self, message):
+        # corrections of a (lowercased, chitchat cleared) message as (token, offset, suggestion, suggestions)
+        if self.table is None:
+            with np.load(self.path) as data:
+                self.table = {name: data[name] for name in data.files}
+        hashes = self.table['hashes']
+        key = np.uint64(message_hash(message))
+        i = np.searchsorted(hashes, key)
+        if i == len(hashes) or hashes[i] != key:
+            return []
+
+        corrections = []
+        strings = self.table['strings']
+        string_offsets = self.table['string_offsets']
+        for j in range(self.table['rows'][i], self.table['rows'][i + 1]):
+            token, suggestion = [strings[string_offsets[k]:string_offsets[k + 1]].tobytes().decode('utf-8')
+                                 for k in (2 * j, 2 * j + 1)]
+            corrections.append((token, int(self.table['token_offsets'][j]), suggestion,
+                                int(self.table['num_suggestions'][j])))
+        return corrections
+
+
+def clean_message(message):
+    # lowercase all messages and clear chitchat messages
+    message = str.lower(message)
+    return '' if message in CHITCHAT else message
+
+
+def normalize_message(message, corrections):
+    """Returns the tokens of a message, or None for a message that is empty after cleaning.
+
+    ``corrections`` are the flagged tokens of the cleaned message. They are applied in order with the offsets
+    of replace_at_offset, so the output is the same as correcting the message turn by turn.
+    """
+    message = clean_message(message)
+    for tok, tok_offset, tok_replace, num_suggestions in corrections:
+        assert num_suggestions == 1
+        message = replace_at_offset(message, tok, tok_offset, tok_replace)
+    if message == '':
+        return None
+    return [w for w in nltk.word_tokenize(message) if w not in CHITCHAT and w not in PUNCTUATION]
+
+
+def normalize_batch(batch):
+    return [normalize_message(message, corrections) for message, corrections in batch]
+
+
+def read_messages(scene_files):
+    # all distinct Teller and Drawer messages of the scenes
+    messages = set()
+    for scene_file in scene_files:
+        with open(scene_file, 'r') as f:
+            scene = json.load(f)
+        for turn in scene['dialog']:
+            messages.add(turn['msg_t'])
+            messages.add(turn['msg_d'])
+    return messages
+
+
+def normalize_messages(scene_files, spell_check_path, cache_path, workers=1, batch_size=512):
+    """Returns a dict from every message of the scenes to its normalized tokens (None for empty messages).
+
+    Each distinct message is normalized once. Results are kept in ``cache_path`` across runs; only messages
+    missing from the cache are tokenized, in ``workers`` processes. The cache is dropped when the spell check
+    file or the nltk version changes.
+    """
+    stat = os.stat(spell_check_path)
+    inputs = {'spell_check': [stat.st_mtime_ns, stat.st_size], 'nltk': nltk.__version__}
+    normalized = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            cache = pickle.load(f)
+        if cache['inputs'] == inputs:
+            normalized = cache['messages']
+
+    missing = sorted(read_messages(scene_files) - set(normalized))
+    if len(missing) == 0:
+        return normalized
+
+    spell_check = SpellCheckTable(spell_check_path)
+    corrections = [spell_check.flagged_tokens(clean_message(message)) for message in missing]
+    batches = [list(zip(missing[i:i + batch_size], corrections[i:i + batch_size]))
+               for i in range(0, len(missing), batch_size)]
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            results = list(tqdm(pool.imap(normalize_batch, batches), total=len(batches)))
+    else:
+        results = [normalize_batch(batch) for batch in tqdm(batches)]
+    for batch, tokens in zip(batches, results):
+        normalized.update((message, message_tokens) for (message, _), message_tokens in zip(batch, tokens))
+
+    with open(cache_path + '.tmp', 'wb') as f:
+        pickle.dump({'inputs': inputs, 'messages': normalized}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_path + '.tmp', cache_path)
+    return normalized
+
+
+if __name__ == '__main__':
+    # run the text normalization stage on its own, filling the cache used by codraw_raw_to_hdf5.py
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1, help='number of processes used to tokenize messages')
+    args = parser.parse_args()
+
+    with open('config.yml', 'r') as f:
+        keys = yaml.load(f, Loader=yaml.FullLoader)
+    scene_files = sorted(glob('{}/*json'.format(keys['codraw_scenes'])))
+    normalized = normalize_messages(scene_files, keys['codraw_spell_check_table'], keys['codraw_text_cache'],
+                                    args.workers)
+    print('Normalized messages: {}'.format(len(normalized)))
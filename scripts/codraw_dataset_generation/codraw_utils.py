@@ -0,0 +1,109 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Helpers shared by the CoDraw dataset generation scripts
+"""
+import json
+import os
+
+import numpy as np
+
+
+def scene_image_files(scene_file, images_path):
+    # all images that may be used for a scene: one per turn that has a drawing
+    with open(scene_file, 'r') as f:
+        scene = json.load(f)
+    image_files = [os.path.join(images_path, 'Scene{}_{}.png'.format(scene['image_id'], idx))
+                   for idx in range(len(scene['dialog']))]
+    return [image_file for image_file in image_files if os.path.exists(image_file)]
+
+
+# fields of an object in an abs_d clip-art string, in order: png file, local index, type, subtype,
+# x, y, z (depth) and flip
+ABS_D_FIELDS = ['png', 'local_id', 'type_id', 'subtype_id', 'x', 'y', 'z', 'flip']
+CLIPART_DTYPE = np.dtype([('turn', np.int32), ('png_id', np.int16), ('object_id', np.int16),
+                          ('local_id', np.int16), ('type_id', np.int16), ('subtype_id', np.int16),
+                          ('x', np.float64), ('y', np.float64), ('z', np.float64), ('flip', np.int8)])
+
+
+def png_object_ids(png_mapping, objects):
+    # sorted png names and the id of the object drawn by each of them, for vectorized lookups
+    object_ids = {}
+    for object_id, name in enumerate(objects):
+        object_ids.setdefault(name, object_id)
+    png_names = np.array(sorted(png_mapping))
+    png_objects = np.array([object_ids[png_mapping[png]] for png in png_names], dtype=np.int16)
+    return png_names, png_objects
+
+
+def parse_abs_d(abs_d, png_names, png_objects):
+    """Parses a batch of abs_d clip-art strings into a structured array with one row per object.
+
+    ``turn`` is the position of the row's string in ``abs_d``; all fields of the string are kept.
+    ``png_id`` indexes ``png_names``; a png file missing from ``png_names`` raises a KeyError.
+    """
+    turns = []
+    tokens = []
+    for turn, string in enumerate(abs_d):
+        splits = string.split(',')
+        num_objects = int(splits[0])
+        turns.append(np.full(num_objects, turn, dtype=np.int32))
+        tokens += splits[1:1 + len(ABS_D_FIELDS) * num_objects]
+    tokens = np.array(tokens, dtype=str).reshape(-1, len(ABS_D_FIELDS))
+
+    clipart = np.zeros(len(tokens), dtype=CLIPART_DTYPE)
+    clipart['turn'] = np.concatenate(turns + [np.zeros(0, dtype=np.int32)])
+    # png names (without the .png extension) are looked up by binary search in the sorted name array
+    pngs = np.char.rpartition(tokens[:, 0], '.')[:, 0]
+    png_ids = np.minimum(np.searchsorted(png_names, pngs), len(png_names) - 1)
+    missing = png_names[png_ids] != pngs
+    if np.any(missing):
+        raise KeyError(pngs[missing][0])
+    clipart['png_id'] = png_ids
+    clipart['object_id'] = png_objects[png_ids]
+    for column, field in enumerate(ABS_D_FIELDS[1:], 1):
+        clipart[field] = tokens[:, column].astype(np.float64)
+    return clipart
+
+
+def save_extracted_coords(path, scene_ids, turn_ids, objects, clipart=None):
+    # objects holds (bow, x, y, z) of every object for every turn; rows are sorted by (scene id, turn)
+    scene_ids = np.array(scene_ids, dtype=np.int32)
+    turn_ids = np.array(turn_ids, dtype=np.int16)
+    order = np.lexsort((turn_ids, scene_ids))
+    arrays = {}
+    if clipart is not None:
+        # all parsed clip-art fields, with turn renumbered to the sorted rows
+        rank = np.argsort(order)
+        clipart = clipart[np.argsort(rank[clipart['turn']], kind='stable')]
+        clipart['turn'] = rank[clipart['turn']]
+        arrays['clipart'] = clipart
+    with open(path, 'wb') as f:
+        np.savez(f, scene_ids=scene_ids[order], turn_ids=turn_ids[order],
+                 objects=np.array(objects, dtype=np.int16).reshape(len(order), -1, 4)[order], **arrays)
+
+
+class ExtractedCoords:
+    """Bag of words and scaled coordinates of the objects in every CoDraw turn.
+
+    The extracted coordinates file is read once; ``coords[scene_id, turn]`` finds the turn in the
+    sorted key index and returns its bow and its coordinates scaled by each of ``scaling_ratios``
+    (one per output resolution, stacked along the first axis).
+    """
+
+    def __init__(self, path, scaling_ratios):
+        with np.load(path) as data:
+            self.keys = data['scene_ids'].astype(np.int64) << 16 | data['turn_ids']
+            self.objects = data['objects']
+        self.scaling_ratios = np.array(scaling_ratios)
+        self.bow_dim = self.objects.shape[1]
+
+    def __getitem__(self, key):
+        scene_id, turn = key
+        row = np.searchsorted(self.keys, scene_id << 16 | turn)
+        if row == len(self.keys) or self.keys[row] != scene_id << 16 | turn:
+            raise KeyError('Scene{}_{}'.format(scene_id, turn))
+        objects = self.objects[row].astype(int)
+        bow = objects[:, 0]
+        scaling = self.scaling_ratios[:, np.newaxis, :] * np.expand_dims(bow, axis=1).repeat(3, 1)
+        return bow, (objects[:, 1:] * scaling).astype(int)
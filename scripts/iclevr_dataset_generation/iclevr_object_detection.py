@@ -3,9 +3,10 @@
 """
 Script to parse and read i-CLEVR data and save it in HDF5 format for Object Detector & Localizer
 """
-from glob import glob
+import argparse
 import json
 import os
+import sys
 
 import cv2
 import h5py
@@ -13,13 +14,213 @@ import numpy as np
 from tqdm import tqdm
 import yaml
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.iclevr_index import list_scenes, scene_frames  # noqa: E402
+from utils.image_loader import ImageCache, ImageLoader, size_suffix  # noqa: E402
+from utils.instrumentation import load_json, report  # noqa: E402
+from utils.manifest import BuildManifest  # noqa: E402
+from utils.packed_writer import PackedWriter  # noqa: E402
+from utils.partitions import merge_partitions, partition_of, partition_path, write_partition_log  # noqa: E402
+from utils.schema import SCHEMAS, decode_field  # noqa: E402
+from utils.storage import check_virtual_datasets, create_dataset, link_dataset, load_storage_profile  # noqa: E402
+
 
 with open('config.yml', 'r') as f:
     keys = yaml.load(f, Loader=yaml.FullLoader)
 
 
-def create_h5():
+def read_scene(scene_file, scene, OBJECTS, image_sizes=(128,)):
+    # objects and object coordinates (one set per output resolution) of a loaded scene json, and its image files
+    images_path = os.path.join(keys['iclevr_data_source'], 'images')
+
+    # identify if scene belongs to train / val / test
+    filename = os.path.basename(scene_file)
+    split = filename.split('_')[1]
+    scene_id = filename.split('_')[2][:-5]
+
+    # add images
+    images_files = scene_frames(images_path, split, scene_id)
+
+    # add objects and object coordinates
+    agg_object = np.zeros(24)
+    objects = np.zeros((5, 24))
+    agg_object_coords = np.zeros((len(image_sizes), 24, 3))
+    object_coords = np.zeros((len(image_sizes), 5, 24, 3))
+    for t, obj in enumerate(scene['objects']):
+        color = obj['color']
+        shape = obj['shape']
+        index = OBJECTS.index((shape, color))
+        agg_object[index] = 1
+        objects[t] = agg_object
+        for k, image_size in enumerate(image_sizes):
+            agg_object_coords[k, index] = [obj['pixel_coords'][0]/320.*image_size,
+                                           obj['pixel_coords'][1]/240.*image_size, obj['pixel_coords'][2]]
+        object_coords[:, t] = agg_object_coords
+
+    return (split, scene_id, scene, objects, object_coords), images_files
+
+
+def read_scenes(scene_files, OBJECTS, image_sizes=(128,)):
+    # yield the objects and object coordinates of every scene, together with its image files
+    for scene_file in scene_files:
+        scene = load_json(scene_file)
+        yield read_scene(scene_file, scene, OBJECTS, image_sizes)
+
+
+def scene_input_files(scene_file):
+    # images read for a scene
+    images_path = os.path.join(keys['iclevr_data_source'], 'images')
+    filename = os.path.basename(scene_file)
+    split = filename.split('_')[1]
+    scene_id = filename.split('_')[2][:-5]
+    return scene_frames(images_path, split, scene_id)
+
+
+def write_sample(sample, image, objects, coords, scene_id, storage_profile):
+    create_dataset(sample, 'scene_id', scene_id, storage_profile)
+    if image is not None:
+        create_dataset(sample, 'image', image, storage_profile)
+    create_dataset(sample, 'objects', objects, storage_profile)
+    create_dataset(sample, 'coords', coords, storage_profile)
+
+
+class SampleWriter:
+    """Writes the samples of read scenes to the train / val / test files, one group per added object or packed.
+
+    With ``image_sources`` (the GeNeVA-GAN files of the same layout, opened for reading, per split) the
+    images are not stored again: the samples reference the images of the GeNeVA-GAN files through virtual
+    datasets, and ``write`` does not need the decoded images. The samples get the coordinates of output
+    resolution ``size_index``. ``scene_groups`` holds the split and group names written for every scene in the
+    groups layout.
+    """
+
+    def __init__(self, h5_files, layout, storage_profile, image_sources=None, size_index=0):
+        self.h5_files = h5_files
+        self.layout = layout
+        self.storage_profile = storage_profile
+        self.image_sources = image_sources
+        self.size_index = size_index
+        self.counters = {'train': -1, 'val': -1, 'test': -1}
+        self.scene_groups = []
+        self.packed_writers = {}
+        if layout == 'packed':
+            self.packed_writers = {split: PackedWriter(h5, storage_profile) for split, h5 in h5_files.items()}
+        if layout == 'packed' and image_sources is not None:
+            # first row of every scene in the packed GeNeVA-GAN files, and the rows referenced so far
+            self.scene_rows = {split: self.packed_scene_rows(h5) for split, h5 in image_sources.items()}
+            self.image_rows = {split: [] for split in h5_files}
+
+    @staticmethod
+    def packed_scene_rows(h5):
+        if 'scene_id' not in h5:
+            return {}
+        scene_ids = decode_field(h5['scene_id'][()], h5['scene_id'].attrs)
+        scene_ids = [s.decode() if isinstance(s, bytes) else s for s in scene_ids]
+        return dict(zip(scene_ids, h5['scene_offsets'][:, 0]))
+
+    def write(self, scene_data, images):
+        split, scene_id, scene, objects, object_coords = scene_data
+        split = split if split in ('train', 'val') else 'test'
+        object_coords = object_coords[self.size_index]
+        num_turns = len(scene['objects'])
+        # packed layout: row i of every dataset holds the sample of group i of the groups layout
+        if self.layout == 'packed':
+            packed = self.packed_writers[split]
+            if self.image_sources is None:
+                packed.append('images', images[:num_turns])
+            else:
+                first_row = self.scene_rows[split][scene_id]
+                self.image_rows[split].extend(range(first_row, first_row + num_turns))
+            packed.append('objects', objects[:num_turns])
+            packed.append('coords', object_coords[:num_turns])
+            packed.append('scene_id', [scene_id] * num_turns)
+            return
+
+        # stack the scene once; every sample is a row of the stacked arrays
+        images = np.array(images) if self.image_sources is None else None
+        object_coords = np.array(object_coords)
+        names = []
+        for t in range(num_turns):
+            self.counters[split] += 1
+            names.append(str(self.counters[split]))
+            sample = self.h5_files[split].create_group(names[-1])
+            write_sample(sample, None if images is None else images[t], objects[t], object_coords[t], scene_id,
+                         self.storage_profile)
+            if self.image_sources is not None:
+                link_dataset(sample, 'image', self.image_sources[split][scene_id]['images'], t)
+        self.scene_groups.append((split, names))
+
+    def close(self):
+        for packed in self.packed_writers.values():
+            packed.close()
+        if self.layout == 'packed' and self.image_sources is not None:
+            for split, rows in self.image_rows.items():
+                if rows:
+                    link_dataset(self.h5_files[split], 'images', self.image_sources[split]['images'], rows)
+
+
+def write_h5(h5_files, scene_jobs, num_scenes, layout, storage_profile, image_loader, image_sources=None):
+    # start saving data into hdf5; loop over all scenes while the loader decodes their images.
+    # h5_files (and image_sources) hold the files of every output resolution of the loader
+    sample_writers = [SampleWriter(files, layout, storage_profile, None if image_sources is None else image_sources[k],
+                                   k) for k, files in enumerate(h5_files)]
+    if image_sources is not None:
+        # linked images are not decoded
+        scene_jobs = ((scene_data, []) for scene_data, _ in scene_jobs)
+    for scene_data, images in tqdm(image_loader.imap(scene_jobs), total=num_scenes):
+        with report.timer('hdf5_write'):
+            for sample_writer, size_images in zip(sample_writers, images):
+                sample_writer.write(scene_data, size_images)
+    with report.timer('hdf5_write'):
+        for sample_writer in sample_writers:
+            sample_writer.close()
+    return sample_writers[0].scene_groups
+
+
+def update_h5(manifest, h5_files, scene_files, OBJECTS, storage_profile, image_loader):
+    # fingerprint every scene; only the scenes whose inputs changed are read again
+    fingerprints = {scene_file: manifest.fingerprint(scene_file, scene_input_files(scene_file))
+                    for scene_file in scene_files}
+    changed = [scene_file for scene_file in scene_files
+               if not manifest.is_current(scene_file, fingerprints[scene_file], h5_files)]
+    scene_jobs = dict(zip(changed, read_scenes(changed, OBJECTS, image_loader.image_sizes)))
+
+    # number the groups as a full build would: one group per added object
+    counters = {'train': 0, 'val': 0, 'test': 0}
+    group_names = {}
+    for scene_file in scene_files:
+        split = os.path.basename(scene_file).split('_')[1]
+        split = split if split in ('train', 'val') else 'test'
+        if scene_file in scene_jobs:
+            num_groups = len(scene_jobs[scene_file][0][2]['objects'])
+        else:
+            num_groups = manifest.num_groups(scene_file)
+        group_names[scene_file] = [str(counters[split] + i) for i in range(num_groups)]
+        counters[split] += num_groups
+    manifest.reorganize(h5_files, {scene_file: group_names[scene_file] for scene_file in scene_files
+                                   if scene_file not in scene_jobs})
+
+    # add the changed scenes' data to hdf5; incremental builds write a single resolution
+    jobs = (((scene_file, scene_jobs[scene_file][0]), scene_jobs[scene_file][1]) for scene_file in changed)
+    for (scene_file, (split, scene_id, scene, objects, object_coords)), (images,) in tqdm(image_loader.imap(jobs),
+                                                                                            total=len(changed)):
+        split = split if split in ('train', 'val') else 'test'
+        with report.timer('hdf5_write'):
+            for t, name in enumerate(group_names[scene_file]):
+                write_sample(h5_files[split].create_group(name), images[t], objects[t], object_coords[0][t], scene_id,
+                             storage_profile)
+            manifest.record(scene_file, fingerprints[scene_file], split, group_names[scene_file], h5_files)
+    manifest.save(h5_files)
+
+
+def create_h5(layout='groups', storage_profile=None, incremental=False, link_images=False, report_path=None,
+              num_partitions=1, partition=None, image_sizes=None, image_cache=False, schema=None):
     # load required keys
+    image_sizes = image_sizes or [keys['image_size']]
+    options = {'layout': layout, 'storage_profile': storage_profile, 'incremental': incremental,
+               'link_images': link_images, 'num_partitions': num_partitions, 'partition': partition,
+               'image_sizes': image_sizes, 'image_cache': image_cache, 'schema': schema}
+    storage_profile = load_storage_profile(keys, storage_profile, schema)
     data_path = keys['iclevr_data_source']
     output_path = keys['iclevr_hdf5_folder']
     OBJECTS = keys['iclevr_objects']
@@ -28,69 +229,129 @@ def create_h5():
         OBJECTS = [tuple(x.strip().split()) for x in OBJECTS]
     background_path = keys['iclevr_background']
 
-    # create hdf5 files for train, val, test
-    train_h5 = h5py.File(os.path.join(output_path, 'clevr_obj_train.h5'), 'w')
-    val_h5 = h5py.File(os.path.join(output_path, 'clevr_obj_val.h5'), 'w')
-    test_h5 = h5py.File(os.path.join(output_path, 'clevr_obj_test.h5'), 'w')
+    # incremental builds keep the groups of unchanged scenes from the previous build
+    file_mode = 'w'
+    suffixes = [size_suffix(image_size, keys['image_size']) for image_size in image_sizes]
+    if incremental and link_images:
+        raise ValueError('Incremental builds copy the images')
+    if incremental and len(image_sizes) > 1:
+        raise ValueError('Incremental builds write one resolution at a time')
+    if partition is not None and (incremental or link_images or layout != 'groups'):
+        raise ValueError('Partitioned builds are only supported for full builds with the groups layout')
+    if link_images:
+        check_virtual_datasets()
+    if incremental:
+        if layout != 'groups':
+            raise ValueError('Incremental builds are only supported for the groups layout')
+        manifest = BuildManifest(os.path.join(output_path, 'clevr_obj{}_manifest.json'.format(suffixes[0])),
+                                 [keys['iclevr_objects']],
+                                 options={'storage_profile': storage_profile, 'image_size': image_sizes[0],
+                                          'layout': layout, 'link_images': link_images})
+        file_mode = manifest.file_mode
+
+    # create hdf5 files for train, val, test of every resolution; a partitioned build writes partial files,
+    # see merge_h5
+    h5_files = []
+    for suffix in suffixes:
+        h5_paths = {split: os.path.join(output_path, 'clevr_obj_{}{}.h5'.format(split, suffix))
+                    for split in ('train', 'val', 'test')}
+        if partition is not None:
+            h5_paths = {split: partition_path(path, partition, num_partitions) for split, path in h5_paths.items()}
+        report.track_outputs(h5_paths.values(), file_mode)
+        train_h5 = h5py.File(h5_paths['train'], file_mode)
+        val_h5 = h5py.File(h5_paths['val'], file_mode)
+        test_h5 = h5py.File(h5_paths['test'], file_mode)
+        h5_files.append({'train': train_h5, 'val': val_h5, 'test': test_h5})
+    image_loader = ImageLoader(image_sizes, ImageCache(keys['image_cache']) if image_cache else None)
 
     json_path = os.path.join(data_path, 'scenes')
-    images_path = os.path.join(data_path, 'images')
 
     background_image = cv2.imread(background_path)
 
     entites = json.dumps(['{} {}'.format(e[0], e[1]) for e in OBJECTS])
 
-    # start saving data into hdf5; loop over all scenes
-    c_train = -1
-    c_val = -1
-    c_test = -1
-    for scene in tqdm(glob(json_path + '/*.json')):
-        filename = os.path.basename(scene)
-        with open(scene, 'r') as f:
-            scene = json.load(f)
-
-        # identify if scene belongs to train / val / test
-        split = filename.split('_')[1]
-        scene_id = filename.split('_')[2][:-5]
-
-        # add images
-        images_files = sorted(glob(os.path.join(images_path, 'CLEVR_{}_{}_*'.format(split, scene_id))))
-        images = []
-        for t, image_file in enumerate(images_files):
-            image = cv2.imread(image_file)
-            image = cv2.resize(image, (128, 128))
-            images.append(image)
-
-        # add objects and object coordinates
-        agg_object = np.zeros(24)
-        objects = np.zeros((5, 24))
-        agg_object_coords = np.zeros((24, 3))
-        object_coords = np.zeros((5, 24, 3))
-        for t, obj in enumerate(scene['objects']):
-            color = obj['color']
-            shape = obj['shape']
-            index = OBJECTS.index((shape, color))
-            agg_object[index] = 1
-            objects[t] = agg_object
-            agg_object_coords[index] = [obj['pixel_coords'][0]/320.*128, obj['pixel_coords'][1]/240.*128, obj['pixel_coords'][2]]
-            object_coords[t] = agg_object_coords
-
-        for t, obj in enumerate(scene['objects']):
-            if split == 'train':
-                c_train += 1
-                sample = train_h5.create_group(str(c_train))
-            elif split == 'val':
-                c_val += 1
-                sample = val_h5.create_group(str(c_val))
-            else:
-                c_test += 1
-                sample = test_h5.create_group(str(c_test))
+    scene_files = list_scenes(json_path)
+    if partition is not None:
+        scene_files = [f for f in scene_files if partition_of(f, num_partitions) == partition]
+    if incremental:
+        update_h5(manifest, h5_files[0], scene_files, OBJECTS, storage_profile, image_loader)
+    elif link_images:
+        # the GeNeVA-GAN files must be built first, with the same layout and resolutions, and kept next to these
+        image_sources = [{split: h5py.File(os.path.join(output_path, 'clevr_{}{}.h5'.format(split, suffix)), 'r')
+                          for split in ('train', 'val', 'test')} for suffix in suffixes]
+        write_h5(h5_files, read_scenes(scene_files, OBJECTS, image_sizes), len(scene_files), layout,
+                 storage_profile, image_loader, image_sources)
+        for sources in image_sources:
+            for h5 in sources.values():
+                h5.close()
+    else:
+        scene_groups = write_h5(h5_files, read_scenes(scene_files, OBJECTS, image_sizes), len(scene_files), layout,
+                                storage_profile, image_loader)
+        if partition is not None:
+            write_partition_log(partition_path(os.path.join(output_path, 'clevr_obj_scenes.json'), partition,
+                                               num_partitions), scene_files, scene_groups)
 
-            sample.create_dataset('scene_id', data=scene_id)
-            sample.create_dataset('image', data=np.array(images)[t])
-            sample.create_dataset('objects', data=objects[t])
-            sample.create_dataset('coords', data=np.array(object_coords)[t])
+    for files in h5_files:
+        for h5 in files.values():
+            h5.close()
+    report.write(report_path or os.path.join(output_path, 'clevr_obj_report.json'), 'iclevr_object_detection', options)
+
+
+def merge_h5(num_partitions, link=False, report_path=None, image_sizes=None):
+    # combine the partial files of a partitioned build, following the scene order of a serial build
+    image_sizes = image_sizes or [keys['image_size']]
+    output_path = keys['iclevr_hdf5_folder']
+    scene_files = list_scenes(os.path.join(keys['iclevr_data_source'], 'scenes'))
+    # the partition logs are the same for every resolution
+    for image_size in image_sizes:
+        suffix = size_suffix(image_size, keys['image_size'])
+        h5_paths = {split: os.path.join(output_path, 'clevr_obj_{}{}.h5'.format(split, suffix))
+                    for split in ('train', 'val', 'test')}
+        report.track_outputs(h5_paths.values())
+        with report.timer('hdf5_write'):
+            merge_partitions(h5_paths, os.path.join(output_path, 'clevr_obj_scenes.json'), num_partitions,
+                             scene_files, link=link)
+    report.write(report_path or os.path.join(output_path, 'clevr_obj_report.json'), 'iclevr_object_detection',
+                 {'num_partitions': num_partitions, 'merge': True, 'link': link, 'image_sizes': image_sizes})
 
 
 if __name__ == '__main__':
-    create_h5()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--layout', choices=['groups', 'packed'], default='groups',
+                        help='one HDF5 group per sample (groups) or one contiguous dataset per field (packed)')
+    parser.add_argument('--storage-profile', default=None,
+                        help='HDF5 chunking/compression profile from config.yml (default: hdf5_storage_profile)')
+    parser.add_argument('--schema', choices=SCHEMAS, default=None,
+                        help='dtypes of the HDF5 datasets: default, or compact (bit-packed objects, narrowest exact '
+                             'coordinate type, integer scene ids) (default: schema of the storage profile)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only process scenes whose inputs changed since the last (possibly interrupted) build')
+    parser.add_argument('--link-images', action='store_true',
+                        help='reference the images of the GeNeVA-GAN files (clevr_*.h5, built first with the same '
+                             'layout) through virtual datasets instead of storing a copy')
+    parser.add_argument('--report', default=None,
+                        help='JSON run report with the time per stage, bytes read and written and peak memory '
+                             '(default: clevr_obj_report.json in the HDF5 folder)')
+    parser.add_argument('--num-partitions', type=int, default=1,
+                        help='number of independent jobs of a partitioned build')
+    parser.add_argument('--partition', type=int, default=None,
+                        help='build the partial files of the scenes of this partition (0 to num-partitions - 1)')
+    parser.add_argument('--merge', action='store_true',
+                        help='combine the partial files of all partitions into the final files')
+    parser.add_argument('--merge-links', action='store_true',
+                        help='merge with external links to the partial files instead of copying their groups')
+    parser.add_argument('--image-sizes', type=int, nargs='+', default=None,
+                        help='sides of the square output images, all resized from a single decode of every image '
+                             '(default: image_size from config.yml)')
+    parser.add_argument('--image-cache', action='store_true',
+                        help='keep the resized images in image_cache (config.yml), one uncompressed file per image '
+                             'and size, and read them instead of decoding the images again in later builds')
+    args = parser.parse_args()
+
+    if args.merge:
+        merge_h5(args.num_partitions, link=args.merge_links, report_path=args.report, image_sizes=args.image_sizes)
+    else:
+        create_h5(layout=args.layout, storage_profile=args.storage_profile, incremental=args.incremental,
+                  link_images=args.link_images, report_path=args.report, num_partitions=args.num_partitions,
+                  partition=args.partition, image_sizes=args.image_sizes, image_cache=args.image_cache,
+                  schema=args.schema)
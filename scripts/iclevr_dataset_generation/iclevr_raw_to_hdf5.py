@@ -3,9 +3,10 @@
 """
 Script to parse and read raw i-CLEVR data and save it in HDF5 format for GeNeVA-GAN
 """
-from glob import glob
+import argparse
 import json
 import os
+import sys
 
 import cv2
 import h5py
@@ -13,13 +14,230 @@ import numpy as np
 from tqdm import tqdm
 import yaml
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from iclevr_object_detection import read_scene as read_obj_scene, SampleWriter  # noqa: E402
+from utils.iclevr_index import list_scenes, scene_frames  # noqa: E402
+from utils.image_loader import ImageCache, ImageLoader, size_suffix  # noqa: E402
+from utils.instrumentation import load_json, report  # noqa: E402
+from utils.manifest import BuildManifest  # noqa: E402
+from utils.packed_writer import PackedWriter  # noqa: E402
+from utils.partitions import merge_partitions, partition_of, partition_path, write_partition_log  # noqa: E402
+from utils.sample_index import INDEX, write_index  # noqa: E402
+from utils.schema import SCHEMAS  # noqa: E402
+from utils.shard_writer import ShardWriter  # noqa: E402
+from utils.storage import create_dataset, load_storage_profile  # noqa: E402
+from utils.token_ids import Vocabulary, vocab_path  # noqa: E402
+
 
 with open('config.yml', 'r') as f:
     keys = yaml.load(f, Loader=yaml.FullLoader)
 
 
-def create_h5():
+def read_scene(scene_file, scene, OBJECTS, image_sizes=(128,)):
+    # text, objects and object coordinates (one set per output resolution) of a loaded scene json, and its image
+    # files
+    data_path = keys['iclevr_data_source']
+    images_path = os.path.join(data_path, 'images/')
+    text_path = os.path.join(data_path, 'text/')
+
+    # identify if scene belongs to train / val / test
+    filename = os.path.basename(scene_file)
+    split = filename.split('_')[1]
+    scene_id = filename.split('_')[2][:-5]
+
+    # add text
+    text_file = os.path.join(text_path, 'CLEVR_{}_{}.txt'.format(split, scene_id))
+    with open(text_file, 'r') as f:
+        text = [line.strip() for line in f]
+    report.count('bytes_read', os.path.getsize(text_file))
+
+    # add images
+    images_files = scene_frames(images_path, split, scene_id)
+
+    # add objects and object coordinates
+    agg_object = np.zeros(24)
+    objects = np.zeros((5, 24))
+    agg_object_coords = np.zeros((len(image_sizes), 24, 3))
+    object_coords = np.zeros((len(image_sizes), 5, 24, 3))
+    for t, obj in enumerate(scene['objects']):
+        color = obj['color']
+        shape = obj['shape']
+        index = OBJECTS.index((shape, color))
+        agg_object[index] = 1
+        objects[t] = agg_object
+        for k, image_size in enumerate(image_sizes):
+            agg_object_coords[k, index] = [obj['pixel_coords'][0]/320.*image_size,
+                                           obj['pixel_coords'][1]/240.*image_size, obj['pixel_coords'][2]]
+        object_coords[:, t] = agg_object_coords
+
+    return (split, scene_id, text, objects, object_coords), images_files
+
+
+def read_scenes(scene_files, OBJECTS, image_sizes=(128,)):
+    # yield the text, objects and object coordinates of every scene, together with its image files
+    for scene_file in scene_files:
+        scene = load_json(scene_file)
+        yield read_scene(scene_file, scene, OBJECTS, image_sizes)
+
+
+def read_scenes_with_objects(scene_files, OBJECTS, image_sizes=(128,)):
+    # yield every scene for both datasets from a single read of its json
+    for scene_file in scene_files:
+        scene = load_json(scene_file)
+        yield (read_scene(scene_file, scene, OBJECTS, image_sizes),
+               read_obj_scene(scene_file, scene, OBJECTS, image_sizes))
+
+
+def scene_input_files(scene_file):
+    # images and text file read for a scene
+    data_path = keys['iclevr_data_source']
+    filename = os.path.basename(scene_file)
+    split = filename.split('_')[1]
+    scene_id = filename.split('_')[2][:-5]
+    images_files = scene_frames(os.path.join(data_path, 'images/'), split, scene_id)
+    return images_files + [os.path.join(data_path, 'text/', 'CLEVR_{}_{}.txt'.format(split, scene_id))]
+
+
+def write_scene(sample, images, text, objects, object_coords, scene_id, storage_profile, vocab=None):
+    # with a vocabulary, the token ids of the instructions are stored next to the text
+    create_dataset(sample, 'scene_id', scene_id, storage_profile)
+    create_dataset(sample, 'images', np.array(images), storage_profile)
+    create_dataset(sample, 'text', json.dumps(text), storage_profile)
+    if vocab is not None:
+        token_ids, token_lengths = vocab.encode(text)
+        create_dataset(sample, 'token_ids', token_ids, storage_profile)
+        create_dataset(sample, 'token_lengths', token_lengths, storage_profile)
+    create_dataset(sample, 'objects', objects, storage_profile)
+    create_dataset(sample, 'coords', np.array(object_coords), storage_profile)
+
+
+class SceneWriter:
+    """Writes read scenes to the train / val / test files, one group per scene or packed.
+
+    With the shards layout, ``h5_files`` holds a ShardWriter per split instead of the HDF5 files. The scenes
+    get the coordinates of output resolution ``size_index`` (the images are already resized).
+    ``scene_groups`` holds the split and group names written for every scene in the groups layout.
+    With a ``vocab`` (Vocabulary), the token ids of the instructions are written as well.
+    """
+
+    def __init__(self, h5_files, layout, storage_profile, size_index=0, vocab=None):
+        self.h5_files = h5_files
+        self.layout = layout
+        self.storage_profile = storage_profile
+        self.size_index = size_index
+        self.vocab = vocab
+        self.scene_groups = []
+        self.packed_writers = {}
+        if layout == 'packed':
+            self.packed_writers = {split: PackedWriter(h5, storage_profile) for split, h5 in h5_files.items()}
+
+    def write(self, scene_data, images):
+        split, scene_id, text, objects, object_coords = scene_data
+        split = split if split in ('train', 'val') else 'test'
+        object_coords = object_coords[self.size_index]
+        # packed layout: turns of all scenes are concatenated, scene_offsets holds (first row, number of turns)
+        if self.layout == 'packed':
+            packed = self.packed_writers[split]
+            packed.append('scene_offsets', [[packed.size('images'), len(images)]])
+            packed.append('scene_id', [scene_id])
+            packed.append('text', [json.dumps(text)])
+            if self.vocab is not None:
+                # token ids of all scenes concatenated, token_offsets holds (first token, number of tokens);
+                # token_lengths is per turn, cut to the turns with an image like the objects
+                token_ids, token_lengths = self.vocab.encode(text[:len(images)])
+                packed.append('token_offsets', [[packed.size('token_ids'), len(token_ids)]])
+                packed.append('token_ids', token_ids)
+                packed.append('token_lengths', token_lengths)
+            packed.append('images', images)
+            packed.append('objects', objects[:len(images)])
+            packed.append('coords', object_coords[:len(images)])
+            return
+        if self.layout == 'shards':
+            self.h5_files[split].write(scene_id, {'scene_id': scene_id, 'images': np.array(images),
+                                                  'text': json.dumps(text), 'objects': objects,
+                                                  'coords': np.array(object_coords)})
+            return
+
+        sample = self.h5_files[split].create_group(scene_id)
+        self.scene_groups.append((split, [scene_id]))
+        write_scene(sample, images, text, objects, object_coords, scene_id, self.storage_profile, self.vocab)
+
+    def close(self):
+        for packed in self.packed_writers.values():
+            packed.close()
+
+
+def write_h5(h5_files, scene_jobs, num_scenes, layout, storage_profile, image_loader, vocab=None):
+    # start saving data into hdf5; loop over all scenes while the loader decodes their images.
+    # h5_files holds the files of every output resolution of the loader
+    scene_writers = [SceneWriter(files, layout, storage_profile, k, vocab) for k, files in enumerate(h5_files)]
+    for scene_data, images in tqdm(image_loader.imap(scene_jobs), total=num_scenes):
+        with report.timer('hdf5_write'):
+            for scene_writer, size_images in zip(scene_writers, images):
+                scene_writer.write(scene_data, size_images)
+    with report.timer('hdf5_write'):
+        for scene_writer in scene_writers:
+            scene_writer.close()
+    return scene_writers[0].scene_groups
+
+
+def write_combined_h5(h5_files, obj_h5_files, scene_jobs, num_scenes, layout, storage_profile, image_loader,
+                      vocab=None):
+    # decode the images of every scene once and write the GeNeVA-GAN and object detection datasets together
+    scene_writers = [SceneWriter(files, layout, storage_profile, k, vocab) for k, files in enumerate(h5_files)]
+    sample_writers = [SampleWriter(files, layout, storage_profile, size_index=k)
+                      for k, files in enumerate(obj_h5_files)]
+    jobs = (((scene, obj_scene_data, obj_images_files), obj_images_files)
+            for scene, (obj_scene_data, obj_images_files) in scene_jobs)
+    for ((scene_data, images_files), obj_scene_data, obj_images_files), obj_images in tqdm(image_loader.imap(jobs),
+                                                                                            total=num_scenes):
+        decoded = dict(zip(obj_images_files, zip(*obj_images)))
+        images = image_loader.by_size([decoded[f] if f in decoded else image_loader.load(f) for f in images_files])
+        with report.timer('hdf5_write'):
+            for k in range(len(scene_writers)):
+                scene_writers[k].write(scene_data, images[k])
+                sample_writers[k].write(obj_scene_data, obj_images[k])
+    with report.timer('hdf5_write'):
+        for writer in scene_writers + sample_writers:
+            writer.close()
+    return scene_writers[0].scene_groups, sample_writers[0].scene_groups
+
+
+def update_h5(manifest, h5_files, scene_files, OBJECTS, storage_profile, image_loader, vocab=None):
+    # fingerprint every scene; only the scenes whose inputs changed are read again
+    fingerprints = {scene_file: manifest.fingerprint(scene_file, scene_input_files(scene_file))
+                    for scene_file in scene_files}
+    changed = [scene_file for scene_file in scene_files
+               if not manifest.is_current(scene_file, fingerprints[scene_file], h5_files)]
+
+    # groups are named after the scene id, so kept scenes never move
+    manifest.reorganize(h5_files, {scene_file: manifest.scenes[os.path.basename(scene_file)]['groups']
+                                   for scene_file in scene_files if scene_file not in changed})
+
+    # add the changed scenes' data to hdf5; incremental builds write a single resolution
+    scene_jobs = (((scene_file, scene_data), images_files) for scene_file, (scene_data, images_files)
+                  in zip(changed, read_scenes(changed, OBJECTS, image_loader.image_sizes)))
+    for (scene_file, scene_data), (images,) in tqdm(image_loader.imap(scene_jobs), total=len(changed)):
+        split, scene_id, text, objects, object_coords = scene_data
+        split = split if split in ('train', 'val') else 'test'
+        with report.timer('hdf5_write'):
+            write_scene(h5_files[split].create_group(scene_id), images, text, objects, object_coords[0], scene_id,
+                        storage_profile, vocab)
+            manifest.record(scene_file, fingerprints[scene_file], split, [scene_id], h5_files)
+    manifest.save(h5_files)
+
+
+def create_h5(layout='groups', storage_profile=None, incremental=False, object_detection=False, report_path=None,
+              shard_format='tar', samples_per_shard=1000, num_partitions=1, partition=None, image_sizes=None,
+              image_cache=False, schema=None, token_ids=False, sample_index=False):
     # load required keys
+    image_sizes = image_sizes or [keys['image_size']]
+    options = {'layout': layout, 'storage_profile': storage_profile, 'incremental': incremental,
+               'object_detection': object_detection, 'shard_format': shard_format,
+               'samples_per_shard': samples_per_shard, 'num_partitions': num_partitions, 'partition': partition,
+               'image_sizes': image_sizes, 'image_cache': image_cache, 'schema': schema, 'token_ids': token_ids,
+               'sample_index': sample_index}
+    storage_profile = load_storage_profile(keys, storage_profile, schema)
     data_path = keys['iclevr_data_source']
     output_path = keys['iclevr_hdf5_folder']
     OBJECTS = keys['iclevr_objects']
@@ -28,77 +246,182 @@ def create_h5():
         OBJECTS = [tuple(x.strip().split()) for x in OBJECTS]
     background_path = keys['iclevr_background']
 
-    # create hdf5 files for train, val, test
-    train_h5 = h5py.File(os.path.join(output_path, 'clevr_train.h5'), 'w')
-    val_h5 = h5py.File(os.path.join(output_path, 'clevr_val.h5'), 'w')
-    test_h5 = h5py.File(os.path.join(output_path, 'clevr_test.h5'), 'w')
+    # incremental builds keep the groups of unchanged scenes from the previous build
+    file_mode = 'w'
+    suffixes = [size_suffix(image_size, keys['image_size']) for image_size in image_sizes]
+    if incremental and object_detection:
+        raise ValueError('Incremental builds write one dataset at a time')
+    if incremental and len(image_sizes) > 1:
+        raise ValueError('Incremental builds write one resolution at a time')
+    if layout == 'shards' and object_detection:
+        raise ValueError('Shards are only written for the GeNeVA-GAN dataset')
+    if partition is not None and (incremental or layout != 'groups'):
+        raise ValueError('Partitioned builds are only supported for full builds with the groups layout')
+    if (token_ids or sample_index) and layout == 'shards':
+        raise ValueError('Token ids and the sample index are only written to HDF5 files')
+    # token ids are rows of the joint vocabulary of generate_glove_file.py
+    vocab = Vocabulary(vocab_path(keys)) if token_ids else None
+    if incremental:
+        if layout != 'groups':
+            raise ValueError('Incremental builds are only supported for the groups layout')
+        manifest = BuildManifest(os.path.join(output_path, 'clevr{}_manifest.json'.format(suffixes[0])),
+                                 [background_path, keys['iclevr_objects']] + ([vocab_path(keys)] if token_ids else []),
+                                 options={'storage_profile': storage_profile, 'image_size': image_sizes[0],
+                                          'layout': layout, 'token_ids': token_ids})
+        file_mode = manifest.file_mode
 
     json_path = os.path.join(data_path, 'scenes/')
-    images_path = os.path.join(data_path, 'images/')
-    text_path = os.path.join(data_path, 'text/')
-
-    # add background image to hdf5
     background_image = cv2.imread(background_path)
-    train_h5.create_dataset('background', data=background_image)
-    val_h5.create_dataset('background', data=background_image)
-    test_h5.create_dataset('background', data=background_image)
-
-    # add object properties to hdf5
     entites = json.dumps(['{} {}'.format(e[0], e[1]) for e in OBJECTS])
-    train_h5.create_dataset('entities', data=entites)
-    val_h5.create_dataset('entities', data=entites)
-    test_h5.create_dataset('entities', data=entites)
-
-    # start saving data into hdf5; loop over all scenes
-    for scene in tqdm(glob(json_path + '/*.json')):
-        filename = os.path.basename(scene)
-        with open(scene, 'r') as f:
-            scene = json.load(f)
-
-        # identify if scene belongs to train / val / test
-        split = filename.split('_')[1]
-        scene_id = filename.split('_')[2][:-5]
-
-        # add text
-        text_file = os.path.join(text_path, 'CLEVR_{}_{}.txt'.format(split, scene_id))
-        with open(text_file, 'r') as f:
-            text = [line.strip() for line in f]
-
-        # add images
-        images_files = sorted(glob(os.path.join(images_path, 'CLEVR_{}_{}_*'.format(split, scene_id))))
-        images = []
-        for t, image_file in enumerate(images_files):
-            image = cv2.imread(image_file)
-            image = cv2.resize(image, (128, 128))
-            images.append(image)
-
-        # add objects and object coordinates
-        agg_object = np.zeros(24)
-        objects = np.zeros((5, 24))
-        agg_object_coords = np.zeros((24, 3))
-        object_coords = np.zeros((5, 24, 3))
-        for t, obj in enumerate(scene['objects']):
-            color = obj['color']
-            shape = obj['shape']
-            index = OBJECTS.index((shape, color))
-            agg_object[index] = 1
-            objects[t] = agg_object
-            agg_object_coords[index] = [obj['pixel_coords'][0]/320.*128, obj['pixel_coords'][1]/240.*128, obj['pixel_coords'][2]]
-            object_coords[t] = agg_object_coords
-
-        if split == 'train':
-            sample = train_h5.create_group(scene_id)
-        elif split == 'val':
-            sample = val_h5.create_group(scene_id)
-        else:
-            sample = test_h5.create_group(scene_id)
-
-        sample.create_dataset('scene_id', data=scene_id)
-        sample.create_dataset('images', data=np.array(images))
-        sample.create_dataset('text', data=json.dumps(text))
-        sample.create_dataset('objects', data=objects)
-        sample.create_dataset('coords', data=np.array(object_coords))
+
+    # create hdf5 files for train, val, test of every resolution; the shards layout writes shard folders
+    # instead, without HDF5 files. A partitioned build writes partial files of the scenes of its partition,
+    # see merge_h5
+    splits = ('train', 'val', 'test')
+    h5_files = []
+    obj_paths = []
+    for suffix in suffixes:
+        h5_paths = {split: os.path.join(output_path, 'clevr_{}{}.h5'.format(split, suffix)) for split in splits}
+        obj_paths.append({split: os.path.join(output_path, 'clevr_obj_{}{}.h5'.format(split, suffix))
+                          for split in splits})
+        if partition is not None:
+            h5_paths = {split: partition_path(path, partition, num_partitions) for split, path in h5_paths.items()}
+            obj_paths[-1] = {split: partition_path(path, partition, num_partitions)
+                             for split, path in obj_paths[-1].items()}
+
+        if layout == 'shards':
+            h5_files.append({split: ShardWriter(os.path.join(output_path, 'clevr_{}{}_shards'.format(split, suffix)),
+                                                shard_format, samples_per_shard,
+                                                shared={'background': background_image, 'entities': entites})
+                             for split in splits})
+            continue
+        report.track_outputs(h5_paths.values(), file_mode)
+        train_h5 = h5py.File(h5_paths['train'], file_mode)
+        val_h5 = h5py.File(h5_paths['val'], file_mode)
+        test_h5 = h5py.File(h5_paths['test'], file_mode)
+
+        # add background image and object properties to hdf5
+        for h5 in (train_h5, val_h5, test_h5):
+            if 'background' not in h5:
+                create_dataset(h5, 'background', background_image, storage_profile)
+                create_dataset(h5, 'entities', entites, storage_profile)
+            if vocab is not None:
+                vocab.write_attrs(h5)
+        h5_files.append({'train': train_h5, 'val': val_h5, 'test': test_h5})
+    image_loader = ImageLoader(image_sizes, ImageCache(keys['image_cache']) if image_cache else None)
+
+    scene_files = list_scenes(json_path)
+    if partition is not None:
+        scene_files = [f for f in scene_files if partition_of(f, num_partitions) == partition]
+    if incremental:
+        update_h5(manifest, h5_files[0], scene_files, OBJECTS, storage_profile, image_loader, vocab)
+    elif object_detection:
+        # object detection files are written in the same pass, see iclevr_object_detection.py
+        obj_h5_files = []
+        for paths in obj_paths:
+            report.track_outputs(paths.values())
+            obj_h5_files.append({split: h5py.File(path, 'w') for split, path in paths.items()})
+        scene_groups, obj_scene_groups = write_combined_h5(h5_files, obj_h5_files,
+                                                           read_scenes_with_objects(scene_files, OBJECTS, image_sizes),
+                                                           len(scene_files), layout, storage_profile, image_loader,
+                                                           vocab)
+        for files in obj_h5_files:
+            for h5 in files.values():
+                h5.close()
+        if partition is not None:
+            write_partition_log(partition_path(os.path.join(output_path, 'clevr_obj_scenes.json'), partition,
+                                               num_partitions), scene_files, obj_scene_groups)
+    else:
+        scene_groups = write_h5(h5_files, read_scenes(scene_files, OBJECTS, image_sizes), len(scene_files), layout,
+                                storage_profile, image_loader, vocab)
+    if partition is not None:
+        write_partition_log(partition_path(os.path.join(output_path, 'clevr_scenes.json'), partition,
+                                           num_partitions), scene_files, scene_groups)
+
+    for files in h5_files:
+        for h5 in files.values():
+            if sample_index:
+                # per-turn index of the scenes, read by samplers instead of every group
+                write_index(h5)
+            elif layout != 'shards' and INDEX in h5:
+                # left by an earlier build of an incremental build's files
+                del h5[INDEX]
+            h5.close()
+    report.write(report_path or os.path.join(output_path, 'clevr_report.json'), 'iclevr_raw_to_hdf5', options)
+
+
+def merge_h5(num_partitions, object_detection=False, link=False, report_path=None, image_sizes=None):
+    # combine the partial files of a partitioned build, following the scene order of a serial build
+    image_sizes = image_sizes or [keys['image_size']]
+    output_path = keys['iclevr_hdf5_folder']
+    scene_files = list_scenes(os.path.join(keys['iclevr_data_source'], 'scenes/'))
+    # GeNeVA-GAN groups are named after their scene, object detection groups are numbered
+    datasets = [('clevr', 'clevr_scenes.json', False)]
+    if object_detection:
+        datasets.append(('clevr_obj', 'clevr_obj_scenes.json', True))
+    # the partition logs are the same for every resolution
+    for image_size in image_sizes:
+        suffix = size_suffix(image_size, keys['image_size'])
+        for prefix, log, renumber in datasets:
+            h5_paths = {split: os.path.join(output_path, '{}_{}{}.h5'.format(prefix, split, suffix))
+                        for split in ('train', 'val', 'test')}
+            report.track_outputs(h5_paths.values())
+            with report.timer('hdf5_write'):
+                merge_partitions(h5_paths, os.path.join(output_path, log), num_partitions, scene_files, renumber,
+                                 link)
+    report.write(report_path or os.path.join(output_path, 'clevr_report.json'), 'iclevr_raw_to_hdf5',
+                 {'num_partitions': num_partitions, 'merge': True, 'object_detection': object_detection,
+                  'link': link, 'image_sizes': image_sizes})
 
 
 if __name__ == '__main__':
-    create_h5()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--layout', choices=['groups', 'packed', 'shards'], default='groups',
+                        help='one HDF5 group per scene (groups), one contiguous dataset per field (packed), or '
+                             'tar / npz shards of scenes without HDF5 files (shards)')
+    parser.add_argument('--shard-format', choices=['tar', 'npz'], default='tar', help='file format of the shards')
+    parser.add_argument('--samples-per-shard', type=int, default=1000, help='number of scenes of every shard')
+    parser.add_argument('--storage-profile', default=None,
+                        help='HDF5 chunking/compression profile from config.yml (default: hdf5_storage_profile)')
+    parser.add_argument('--schema', choices=SCHEMAS, default=None,
+                        help='dtypes of the HDF5 datasets: default, or compact (bit-packed objects, narrowest exact '
+                             'coordinate type, integer scene ids) (default: schema of the storage profile)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only process scenes whose inputs changed since the last (possibly interrupted) build')
+    parser.add_argument('--object-detection', action='store_true',
+                        help='also write the object detection dataset (clevr_obj_*.h5), reading every scene and '
+                             'image once')
+    parser.add_argument('--report', default=None,
+                        help='JSON run report with the time per stage, bytes read and written and peak memory '
+                             '(default: clevr_report.json in the HDF5 folder)')
+    parser.add_argument('--num-partitions', type=int, default=1,
+                        help='number of independent jobs of a partitioned build')
+    parser.add_argument('--partition', type=int, default=None,
+                        help='build the partial files of the scenes of this partition (0 to num-partitions - 1)')
+    parser.add_argument('--merge', action='store_true',
+                        help='combine the partial files of all partitions into the final files')
+    parser.add_argument('--merge-links', action='store_true',
+                        help='merge with external links to the partial files instead of copying their groups')
+    parser.add_argument('--sample-index', action='store_true',
+                        help='also write the per-turn index table of the scenes (root dataset index) for samplers; '
+                             'readers that count the scenes by the root keys count it as well')
+    parser.add_argument('--token-ids', action='store_true',
+                        help='also store the instructions as token ids of the joint vocabulary written by '
+                             'generate_glove_file.py (token_ids, token_lengths)')
+    parser.add_argument('--image-sizes', type=int, nargs='+', default=None,
+                        help='sides of the square output images, all resized from a single decode of every image '
+                             '(default: image_size from config.yml)')
+    parser.add_argument('--image-cache', action='store_true',
+                        help='keep the resized images in image_cache (config.yml), one uncompressed file per image '
+                             'and size, and read them instead of decoding the images again in later builds')
+    args = parser.parse_args()
+
+    if args.merge:
+        merge_h5(args.num_partitions, object_detection=args.object_detection, link=args.merge_links,
+                 report_path=args.report, image_sizes=args.image_sizes)
+    else:
+        create_h5(layout=args.layout, storage_profile=args.storage_profile, incremental=args.incremental,
+                  object_detection=args.object_detection, report_path=args.report, shard_format=args.shard_format,
+                  samples_per_shard=args.samples_per_shard, num_partitions=args.num_partitions,
+                  partition=args.partition, image_sizes=args.image_sizes, image_cache=args.image_cache,
+                  schema=args.schema, token_ids=args.token_ids, sample_index=args.sample_index)
@@ -0,0 +1,49 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Script to check that two generated files of the same dataset, e.g. built with the groups and the packed layout,
+hold the same samples as read by DatasetReader
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.dataset_reader import DatasetReader  # noqa: E402
+
+
+def same_value(value, other):
+    if isinstance(value, np.ndarray) or isinstance(other, np.ndarray):
+        value, other = np.asarray(value), np.asarray(other)
+        return value.shape == other.shape and np.array_equal(value, other)
+    return value == other
+
+
+def compare_files(path, other_path, batch_size=64):
+    # raises a ValueError at the first sample whose fields or values differ; returns the number of samples
+    reader, other = DatasetReader(path), DatasetReader(other_path)
+    if len(reader) != len(other):
+        raise ValueError('{} has {} samples, {} has {}'.format(path, len(reader), other_path, len(other)))
+    for batch, other_batch in zip(reader.iter_batches(batch_size), other.iter_batches(batch_size)):
+        for sample, other_sample in zip(batch, other_batch):
+            if sorted(sample) != sorted(other_sample):
+                raise ValueError('Sample {} has the fields {} in {} and {} in {}'.format(
+                    sample.get('scene_id'), sorted(sample), path, sorted(other_sample), other_path))
+            for name, value in sample.items():
+                if not same_value(value, other_sample[name]):
+                    raise ValueError('Sample {} has another {} in {} and {}'.format(sample.get('scene_id'), name,
+                                                                                     path, other_path))
+    reader.close()
+    other.close()
+    return len(reader)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('h5_file', help='generated file, e.g. data/CoDraw/codraw_train.h5')
+    parser.add_argument('other_h5_file', help='file of the same dataset in another layout, schema or profile')
+    args = parser.parse_args()
+
+    print('{} samples are the same'.format(compare_files(args.h5_file, args.other_h5_file)))
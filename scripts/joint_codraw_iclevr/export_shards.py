@@ -0,0 +1,45 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Script to export GeNeVA-GAN HDF5 files to sequential tar or npz shards for streaming to training nodes
+"""
+import argparse
+import os
+import sys
+
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.dataset_reader import DatasetReader  # noqa: E402
+from utils.shard_writer import ShardWriter  # noqa: E402
+
+
+def export_shards(h5_file, output_dir, shard_format='tar', samples_per_shard=1000, batch_size=64):
+    # read the scenes of the file in order, in either layout, and write them to shards keyed by scene id
+    reader = DatasetReader(h5_file)
+    if (reader.packed and reader.scene_offsets is None) or (not reader.packed and len(reader) > 0
+                                                            and 'images' not in reader[0]):
+        raise ValueError('{} is not a GeNeVA-GAN file: only files of scenes can be exported'.format(h5_file))
+
+    writer = ShardWriter(output_dir, shard_format, samples_per_shard, reader.shared)
+    for batch in tqdm(reader.iter_batches(batch_size), total=(len(reader) + batch_size - 1) // batch_size):
+        for sample in batch:
+            writer.write(sample['scene_id'], sample)
+    writer.close()
+    reader.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('h5_files', nargs='+', help='codraw_*.h5 / clevr_*.h5 files')
+    parser.add_argument('--output-dir', default=None,
+                        help='folder of the shard folders (default: next to each file, as <file>_shards)')
+    parser.add_argument('--format', choices=['tar', 'npz'], default='tar',
+                        help='tar of per-scene records with PNG images, or npz of concatenated arrays')
+    parser.add_argument('--samples-per-shard', type=int, default=1000, help='number of scenes of every shard')
+    args = parser.parse_args()
+
+    for h5_file in args.h5_files:
+        name = os.path.splitext(os.path.basename(h5_file))[0] + '_shards'
+        output_dir = os.path.join(args.output_dir or os.path.dirname(h5_file), name)
+        export_shards(h5_file, output_dir, args.format, args.samples_per_shard)
@@ -3,6 +3,10 @@
 """
 Script to generate the GloVe embedding file for the CoDraw and i-CLEVR dataset vocabularies
 """
+import argparse
+import os
+
+import numpy as np
 from tqdm import tqdm
 import yaml
 
@@ -11,62 +15,131 @@ with open('config.yml', 'r') as f:
     keys = yaml.load(f, Loader=yaml.FullLoader)
 
 
-def generate_glove_file():
-    codraw_vocab = keys['codraw_vocab']
-    clevr_vocab = keys['iclevr_vocab']
-    output_file = keys['glove_output']
-    original_glove = keys['glove_source']
-
+def read_vocab():
     # read CoDraw vocabulary
-    with open(codraw_vocab, 'r') as f:
+    with open(keys['codraw_vocab'], 'r') as f:
         codraw_vocab = f.readlines()
         codraw_vocab = [x.strip().rsplit(' ', 1)[0] for x in codraw_vocab]
 
     # read i-CLEVR vocabulary
-    with open(clevr_vocab, 'r') as f:
+    with open(keys['iclevr_vocab'], 'r') as f:
         clevr_vocab = f.readlines()
         clevr_vocab = [x.strip().rsplit(' ', 1)[0] for x in clevr_vocab]
 
     # combine vocabularies and add special tokens for CoDraw Drawer and Teller
-    codraw_vocab += clevr_vocab + ['<drawer>', '<teller>']
-    codraw_vocab = list(set(codraw_vocab))
-    codraw_vocab.sort()
-
-    print('Loading GloVe file. This might take a few minutes.')
-    with open(original_glove, 'r') as f:
-        original_glove = f.readlines()
-        tok_glove_pairs = [x.strip().split(' ', 1) for x in original_glove]
-
-    # extract GloVe vectors for vocabulary tokens
-    for token, glove_emb in tqdm(tok_glove_pairs):
-        if token == 'unk':
-            unk_embedding = glove_emb
-        try:
-            token_idx = codraw_vocab.index(token)
-        except ValueError:
-            continue
-        else:
-            codraw_vocab[token_idx] = ' '.join([token, glove_emb])
+    vocab = set(codraw_vocab + clevr_vocab + ['<drawer>', '<teller>'])
+    return sorted(vocab)
+
+
+def extract_glove_vectors(glove_path, vocab):
+    # stream the GloVe file line by line and keep only the vocabulary tokens (and `unk`);
+    # stop reading as soon as every token has been found
+    wanted = set(vocab) | {'unk'}
+    glove_vectors = {}
+    with open(glove_path, 'r') as f:
+        for line in tqdm(f):
+            token, glove_emb = line.strip().split(' ', 1)
+            if token in wanted and token not in glove_vectors:
+                glove_vectors[token] = np.array(glove_emb.split(' '), dtype=np.float32)
+                if len(glove_vectors) == len(wanted):
+                    break
+    return glove_vectors
+
+
+def tokens_file(matrix_path):
+    # token list stored next to a GloVe matrix, one token per line in row order
+    return os.path.splitext(matrix_path)[0] + '_tokens.txt'
+
+
+def convert_glove_to_npy(glove_path, matrix_path):
+    # one-time conversion of the GloVe text file to a float32 .npy matrix and a token index
+    with open(glove_path, 'rb') as f:
+        num_rows = sum(1 for _ in f)
+    with open(glove_path, 'r', newline='\n') as f:
+        dim = len(f.readline().rstrip('\n').split(' ')) - 1
+
+    print('Converting GloVe file to {}. This might take a few minutes.'.format(matrix_path))
+    matrix = np.lib.format.open_memmap(matrix_path, mode='w+', dtype=np.float32, shape=(num_rows, dim))
+    with open(glove_path, 'r', newline='\n') as f, open(tokens_file(matrix_path), 'w', newline='\n') as t:
+        for row, line in enumerate(tqdm(f, total=num_rows)):
+            splits = line.rstrip('\n').split(' ')
+            # a few GloVe tokens contain spaces, so the vector is taken from the end of the line
+            t.write('%s\n' % ' '.join(splits[:-dim]))
+            matrix[row] = np.array(splits[-dim:], dtype=np.float32)
+    matrix.flush()
+
+
+def gather_glove_vectors(matrix_path, vocab):
+    # look up the vocabulary tokens (and `unk`) in the token index and gather their rows from the memmap
+    token_index = {}
+    with open(tokens_file(matrix_path), 'r', newline='\n') as f:
+        for row, token in enumerate(f):
+            token_index.setdefault(token[:-1], row)
+    matrix = np.load(matrix_path, mmap_mode='r')
+
+    found = [token for token in vocab + ['unk'] if token in token_index]
+    rows = np.array([token_index[token] for token in found], dtype=np.int64)
+    order = np.argsort(rows)
+    glove_vectors = np.empty((len(rows), matrix.shape[1]), dtype=np.float32)
+    glove_vectors[order] = matrix[rows[order]]
+    return dict(zip(found, glove_vectors))
+
+
+def format_vector(glove_emb):
+    # shortest text of every float32 value that reads back to it, the same for the text file and the cache
+    return ' '.join(np.format_float_positional(x, unique=True, trim='-') for x in glove_emb)
+
+
+def generate_glove_file(build_cache=False):
+    output_file = keys['glove_output']
+    output_matrix = keys['glove_output_matrix']
+    glove_matrix = keys['glove_matrix']
+    vocab = read_vocab()
+
+    if build_cache:
+        convert_glove_to_npy(keys['glove_source'], glove_matrix)
+
+    if os.path.exists(glove_matrix) and os.path.exists(tokens_file(glove_matrix)):
+        glove_vectors = gather_glove_vectors(glove_matrix, vocab)
+    else:
+        print('Loading GloVe file. This might take a few minutes.')
+        glove_vectors = extract_glove_vectors(keys['glove_source'], vocab)
+    glove_vectors = {token: format_vector(glove_emb) for token, glove_emb in glove_vectors.items()}
+    unk_embedding = glove_vectors['unk']
 
     # set Drawer and Teller token vectors; assign 'unk' GloVe embedding to unknown words
     unk_count = 0
-    for itidx, item in enumerate(codraw_vocab):
-        if len(item.split(' ')) == 1:
-            if item == '<drawer>':
-                codraw_vocab[itidx] = ' '.join(['<drawer>', ('0.1 ' * 150 + '0.0 ' * 150)[:-1]])
-            elif item == '<teller>':
-                codraw_vocab[itidx] = ' '.join(['<teller>', ('0.0 ' * 150 + '0.1 ' * 150)[:-1]])
-            else:
-                unk_count += 1
-                codraw_vocab[itidx] = ' '.join([item, unk_embedding])
+    lines = []
+    for item in vocab:
+        if item in glove_vectors:
+            lines.append(' '.join([item, glove_vectors[item]]))
+        elif item == '<drawer>':
+            lines.append(' '.join(['<drawer>', ('0.1 ' * 150 + '0.0 ' * 150)[:-1]]))
+        elif item == '<teller>':
+            lines.append(' '.join(['<teller>', ('0.0 ' * 150 + '0.1 ' * 150)[:-1]]))
+        else:
+            unk_count += 1
+            lines.append(' '.join([item, unk_embedding]))
 
     # write GloVe vector file for the CoDraw and i-CLEVR datasets combined
     with open(output_file, 'w') as f:
-        for item in codraw_vocab:
+        for item in lines:
             f.write('%s\n' % item)
 
-    print('Total words in vocab: {}\n`unk` embedding words: {}'.format(len(codraw_vocab), unk_count))
+    # write the same vectors as a float32 matrix (rows in vocabulary order) with its token list
+    matrix = np.array([line.split(' ')[1:] for line in lines], dtype=np.float32)
+    np.save(output_matrix, matrix)
+    with open(tokens_file(output_matrix), 'w', newline='\n') as f:
+        for item in vocab:
+            f.write('%s\n' % item)
+
+    print('Total words in vocab: {}\n`unk` embedding words: {}'.format(len(vocab), unk_count))
 
 
 if __name__ == '__main__':
-    generate_glove_file()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--build-cache', action='store_true',
+                        help='convert glove_source to the binary glove_matrix cache before extracting vectors')
+    args = parser.parse_args()
+
+    generate_glove_file(build_cache=args.build_cache)
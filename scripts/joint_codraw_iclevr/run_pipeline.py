@@ -0,0 +1,301 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Script to run all dataset generation stages in dependency order: stages whose outputs are newer than their inputs
+are skipped, independent stages run concurrently within a CPU budget, and the critical path is timed
+"""
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.image_loader import available_cpus  # noqa: E402
+from utils.token_ids import vocab_path  # noqa: E402
+
+
+with open('config.yml', 'r') as f:
+    keys = yaml.load(f, Loader=yaml.FullLoader)
+
+SCRIPTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SPLITS = ('train', 'val', 'test')
+
+
+def h5_outputs(folder_key, prefix):
+    return [os.path.join(keys[folder_key], '{}_{}.h5'.format(prefix, split)) for split in SPLITS]
+
+
+# stage name, script, input and output paths (files or folders), and whether the stage decodes images in a
+# thread pool; a stage depends on the stages whose outputs it reads
+STAGES = [
+    ('generate_glove_file', 'joint_codraw_iclevr/generate_glove_file.py',
+     [keys['codraw_vocab'], keys['iclevr_vocab'], keys['glove_source'], keys['glove_matrix']],
+     [keys['glove_output'], keys['glove_output_matrix'], vocab_path(keys)], False),
+    ('codraw_add_data_to_raw', 'codraw_dataset_generation/codraw_add_data_to_raw.py',
+     [keys['codraw_objects_source'], keys['codraw_png_to_object'], keys['codraw_scenes'], keys['codraw_spell_check']],
+     [keys['codraw_objects'], keys['codraw_extracted_coordinates'], keys['codraw_spell_check_table']], False),
+    ('codraw_raw_to_hdf5', 'codraw_dataset_generation/codraw_raw_to_hdf5.py',
+     [keys['codraw_scenes'], keys['codraw_images'], keys['codraw_background'], keys['codraw_extracted_coordinates'],
+      keys['codraw_spell_check_table']],
+     h5_outputs('codraw_hdf5_folder', 'codraw'), True),
+    ('codraw_object_detection', 'codraw_dataset_generation/codraw_object_detection.py',
+     [keys['codraw_scenes'], keys['codraw_images'], keys['codraw_background'], keys['codraw_extracted_coordinates']],
+     h5_outputs('codraw_hdf5_folder', 'codraw_obj'), True),
+    ('iclevr_add_data_to_raw', 'iclevr_dataset_generation/iclevr_add_data_to_raw.py',
+     [], [keys['iclevr_objects']], False),
+    ('iclevr_raw_to_hdf5', 'iclevr_dataset_generation/iclevr_raw_to_hdf5.py',
+     [keys['iclevr_data_source'], keys['iclevr_background'], keys['iclevr_objects']],
+     h5_outputs('iclevr_hdf5_folder', 'clevr'), True),
+    ('iclevr_object_detection', 'iclevr_dataset_generation/iclevr_object_detection.py',
+     [keys['iclevr_data_source'], keys['iclevr_background'], keys['iclevr_objects']],
+     h5_outputs('iclevr_hdf5_folder', 'clevr_obj'), True),
+]
+GAN_STAGES = ('codraw_raw_to_hdf5', 'iclevr_raw_to_hdf5')
+
+
+def newest_mtime(path):
+    # latest modification time of a file, or of a folder and the files below it (added, removed or changed)
+    newest = os.path.getmtime(path)
+    for folder, _, files in os.walk(path):
+        newest = max([newest, os.path.getmtime(folder)] + [os.path.getmtime(os.path.join(folder, name))
+                                                           for name in files])
+    return newest
+
+
+def read_stamp(stamp_path):
+    # arguments of the last successful run of a stage, or None
+    if not os.path.exists(stamp_path):
+        return None
+    with open(stamp_path, 'r') as f:
+        return json.load(f)['args']
+
+
+def write_stamp(stamp_path, args):
+    with open(stamp_path, 'w') as f:
+        json.dump({'args': args}, f)
+
+
+def is_current(script, inputs, outputs, stamp_path, args):
+    # the last run of the stage succeeded with the same arguments, and every output exists and is newer than the
+    # stage script and its existing inputs; a missing input is left to the stage to report when it has to run.
+    # The builders create their outputs before writing them, so the outputs of a failed run are not enough
+    if read_stamp(stamp_path) != args:
+        return False
+    if not all(os.path.exists(path) for path in outputs):
+        return False
+    oldest_output = min(newest_mtime(path) for path in outputs)
+    return all(newest_mtime(path) <= oldest_output for path in [script] + inputs if os.path.exists(path))
+
+
+def stage_inputs(name, inputs, args):
+    # GeNeVA-GAN builds with token ids also read the vocabulary of generate_glove_file.py
+    return inputs + [vocab_path(keys)] if name in GAN_STAGES and '--token-ids' in args else inputs
+
+
+def stage_cpus(threaded, args, build_cpus, cpus):
+    # single-threaded stages use one CPU; image decoding stages use build_cpus, or more with --workers
+    if not threaded:
+        return 1
+    workers = int(args[args.index('--workers') + 1]) if '--workers' in args else 1
+    return min(max(build_cpus, workers), cpus)
+
+
+def dependencies(stages):
+    """Returns the stages each stage depends on, and the stages in an order that runs the dependencies first.
+
+    A stage depends on every other selected stage that writes one of its inputs. Raises a ValueError if the
+    stages depend on each other in a cycle.
+    """
+    producers = {os.path.normpath(path): name for name, _, _, outputs, _ in stages for path in outputs}
+    deps = {name: sorted({producers[os.path.normpath(path)] for path in inputs
+                          if os.path.normpath(path) in producers} - {name})
+            for name, _, inputs, _, _ in stages}
+    order = []
+    while len(order) < len(stages):
+        ready = [name for name, _, _, _, _ in stages if name not in order and all(d in order for d in deps[name])]
+        if not ready:
+            raise ValueError('Stages {} depend on each other'.format(sorted(set(deps) - set(order))))
+        order.append(ready[0])
+    return deps, order
+
+
+def start_stage(script, args, slots, log_path):
+    # run a stage in its own process, pinned to the CPUs of its slots of the budget, with its output in a log file;
+    # a budget larger than the CPUs of the process shares them round-robin
+    command = [sys.executable, os.path.join(SCRIPTS_PATH, script)] + args
+    cpu_ids = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_setaffinity') else None
+
+    def pin():
+        os.sched_setaffinity(0, {cpu_ids[slot % len(cpu_ids)] for slot in slots})
+    with open(log_path, 'w') as log:
+        return subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, preexec_fn=pin if cpu_ids else None)
+
+
+def log_tail(log_path, num_lines=20):
+    with open(log_path, 'r', errors='replace') as f:
+        # progress bars rewrite their line with carriage returns
+        lines = [line.rsplit('\r', 1)[-1] for line in f.read().splitlines()]
+    return '\n'.join(lines[-num_lines:])
+
+
+def run_pipeline(stage_names, stage_args, cpus, build_cpus, log_dir, force=False, dry_run=False):
+    """Runs the selected stages as soon as the stages they depend on are done and enough CPUs are free.
+
+    ``stage_args`` holds extra command line arguments per stage. A stage that succeeded writes a
+    ``<log_dir>/<stage>.done`` stamp with its arguments; stages with a stamp of the same arguments whose outputs
+    are newer than their script and inputs are skipped, unless ``force``. Every stage gets its share of the
+    ``cpus`` CPUs (one, or ``build_cpus`` for the stages decoding images) and writes its output to
+    ``<log_dir>/<stage>.log``.
+    Returns the results of the stages in order, or None for a dry run.
+    """
+    stages = [(name, script, stage_inputs(name, inputs, stage_args.get(name, [])), outputs, threaded)
+              for name, script, inputs, outputs, threaded in STAGES if name in stage_names]
+    deps, order = dependencies(stages)
+    stages = {stage[0]: stage for stage in stages}
+
+    def stamp_path(name):
+        # written when a stage succeeds, with its arguments
+        return os.path.join(log_dir, name + '.done')
+
+    def current(name):
+        _, script, inputs, outputs, _ = stages[name]
+        return not force and is_current(os.path.join(SCRIPTS_PATH, script), inputs, outputs, stamp_path(name),
+                                        stage_args.get(name, []))
+
+    if dry_run:
+        # a stage runs if it is not current or if a stage it depends on runs
+        runs = set()
+        for name in order:
+            if not current(name) or any(dep in runs for dep in deps[name]):
+                runs.add(name)
+            print('{:<26} {}'.format(name, 'run' if name in runs else 'current'))
+        return None
+
+    free_slots = list(range(cpus))
+    os.makedirs(log_dir, exist_ok=True)
+    start = time.time()
+    results = {}
+    pending = list(order)
+    running = {}
+    # whether a stage is current, checked once when its dependencies are done: it walks the input folders
+    checked = {}
+    failed = False
+    while (pending and not failed) or running:
+        # start every stage whose dependencies are done, in order, while CPUs are free
+        for name in list(pending):
+            if failed or not all(dep in results for dep in deps[name]):
+                continue
+            if name not in checked:
+                checked[name] = current(name)
+            if checked[name]:
+                pending.remove(name)
+                results[name] = {'status': 'current', 'start': time.time() - start, 'seconds': 0., 'cpus': 0}
+                print('[current] {}'.format(name))
+                continue
+            _, script, _, _, threaded = stages[name]
+            args = stage_args.get(name, [])
+            num_cpus = stage_cpus(threaded, args, build_cpus, cpus)
+            if num_cpus > len(free_slots):
+                continue
+            slots, free_slots = free_slots[:num_cpus], free_slots[num_cpus:]
+            pending.remove(name)
+            if os.path.exists(stamp_path(name)):
+                os.remove(stamp_path(name))
+            process = start_stage(script, args, slots, os.path.join(log_dir, name + '.log'))
+            running[name] = (process, time.time(), slots)
+            print('[start] {} on {} CPU{}'.format(name, num_cpus, 's' if num_cpus > 1 else ''))
+
+        if not running:
+            break
+        time.sleep(0.1)
+        for name, (process, stage_start, slots) in list(running.items()):
+            if process.poll() is None:
+                continue
+            del running[name]
+            free_slots = sorted(free_slots + slots)
+            status = 'done' if process.returncode == 0 else 'failed'
+            results[name] = {'status': status, 'start': stage_start - start, 'seconds': time.time() - stage_start,
+                             'cpus': len(slots)}
+            print('[{}] {} in {:.1f}s'.format(status, name, results[name]['seconds']))
+            if process.returncode == 0:
+                write_stamp(stamp_path(name), stage_args.get(name, []))
+            else:
+                # no further stages are started; the running ones are finished
+                failed = True
+                print(log_tail(os.path.join(log_dir, name + '.log')))
+
+    summary(order, deps, results, time.time() - start)
+    for name in pending:
+        results[name] = {'status': 'not run', 'start': None, 'seconds': 0., 'cpus': 0}
+    return [(name, results[name]) for name in order]
+
+
+def critical_path(order, deps, results):
+    # longest chain of dependent stages by elapsed time; current stages take no time
+    finish = {}
+    previous = {}
+    for name in order:
+        if name not in results:
+            continue
+        previous[name] = max([dep for dep in deps[name] if dep in finish], key=finish.get, default=None)
+        finish[name] = results[name]['seconds'] + (finish[previous[name]] if previous[name] else 0.)
+    path = []
+    name = max(finish, key=finish.get, default=None)
+    while name is not None:
+        path.append(name)
+        name = previous[name]
+    return path[::-1], finish[path[0]] if path else 0.
+
+
+def summary(order, deps, results, wall_time):
+    print('{:<26} {:>8} {:>10} {:>10} {:>6}'.format('stage', 'status', 'start (s)', 'time (s)', 'CPUs'))
+    for name in order:
+        if name in results:
+            result = results[name]
+            print('{:<26} {:>8} {:>10.1f} {:>10.1f} {:>6}'.format(name, result['status'], result['start'],
+                                                                   result['seconds'], result['cpus']))
+    path, path_time = critical_path(order, deps, results)
+    # current stages on the path are not shown
+    path = [name for name in path if results[name]['status'] != 'current']
+    if not path:
+        print('all stages are current')
+        return
+    print('critical path: {} = {:.1f}s'.format(
+        ' -> '.join('{} ({:.1f}s)'.format(name, results[name]['seconds']) for name in path), path_time))
+    stage_time = sum(result['seconds'] for result in results.values())
+    print('wall time {:.1f}s, stage time {:.1f}s ({:.2f}x parallel)'.format(wall_time, stage_time,
+                                                                           stage_time / wall_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stages', nargs='+', default=[name for name, _, _, _, _ in STAGES],
+                        choices=[name for name, _, _, _, _ in STAGES],
+                        help='stages to run (default: all); stages that are not selected are not run for the others')
+    parser.add_argument('--stage-args', nargs='+', default=[], metavar='STAGE=ARGS',
+                        help='extra command line arguments of a stage, e.g. codraw_raw_to_hdf5="--workers 4"')
+    parser.add_argument('--cpus', type=int, default=None,
+                        help='CPUs shared by the concurrent stages (default: all CPUs of the process)')
+    parser.add_argument('--build-cpus', type=int, default=None,
+                        help='CPUs of every image decoding stage (default: half of --cpus, so that the CoDraw and '
+                             'i-CLEVR builds run side by side)')
+    parser.add_argument('--log-dir', default='data/pipeline_logs', help='folder of the output of every stage')
+    parser.add_argument('--force', action='store_true', help='run the stages even if their outputs are current')
+    parser.add_argument('--dry-run', action='store_true', help='only print which stages would run')
+    args = parser.parse_args()
+
+    stage_args = {}
+    for item in args.stage_args:
+        name, arguments = item.split('=', 1)
+        stage_args[name] = shlex.split(arguments)
+    cpus = args.cpus or available_cpus()
+    build_cpus = args.build_cpus or max(1, cpus // 2)
+
+    results = run_pipeline(args.stages, stage_args, cpus, build_cpus, args.log_dir, args.force, args.dry_run)
+    if results is not None and any(result['status'] not in ('done', 'current') for _, result in results):
+        sys.exit(1)
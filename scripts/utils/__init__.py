@@ -0,0 +1,5 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Helpers shared by the CoDraw and i-CLEVR dataset generation scripts
+"""
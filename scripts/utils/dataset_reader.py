@@ -0,0 +1,241 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Random-access reader of the generated GeNeVA-GAN and object detection HDF5 files
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+
+import h5py
+import numpy as np
+
+from .frame_table import FRAME_REFERENCES, FRAMES, read_frames
+from .sample_index import INDEX
+from .schema import decode_field
+
+
+# datasets of the whole file, next to the samples
+SHARED_FIELDS = ('background', 'entities')
+# per-scene datasets of the packed GeNeVA-GAN files; all other datasets but token_ids hold one row per turn
+SCENE_FIELDS = ('scene_offsets', 'scene_id', 'text', 'token_offsets')
+# offsets of the packed GeNeVA-GAN files, not returned with the samples
+OFFSET_FIELDS = ('scene_offsets', 'token_offsets')
+# fields of the packed object detection files, returned under the names of the groups layout
+ROW_FIELDS = {'images': 'image'}
+
+
+def decode(value):
+    # vlen strings are read as bytes by newer h5py versions
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    if isinstance(value, np.ndarray) and value.dtype == object:
+        return np.array([decode(v) for v in value.flat], dtype=object).reshape(value.shape)
+    return value
+
+
+class DatasetReader:
+    """Reads samples of a ``codraw_*.h5``, ``clevr_*.h5`` or ``*_obj_*.h5`` file by index.
+
+    A sample is a dict of field name to value: a scene with one row per turn in the GeNeVA-GAN files, a
+    single turn in the object detection files. Both the groups layout (sample ``i`` is group ``i`` in
+    numeric order of the group keys) and the packed layout are supported; file-level datasets such as
+    ``background`` are read once into ``shared``; a sample has the same fields in both layouts. Files of the
+    compact schema are decoded to the values of the default schema, and the images of files with deduplicated
+    frames are read from their ``frames`` table.
+    ``index()`` returns the per-turn index table of the GeNeVA-GAN files (see utils/sample_index.py).
+
+    The file is opened lazily, once per process: a reader created before the workers of a data loader are
+    forked (or pickled to them) reopens the file in every worker. Samples are kept in an LRU cache of
+    ``cache_size`` entries, and ``prefetch`` / ``iter_batches`` read the next samples in a background thread.
+    """
+
+    def __init__(self, path, cache_size=256, prefetch_threads=1):
+        self.path = path
+        self.cache_size = cache_size
+        self.prefetch_threads = prefetch_threads
+        self._h5 = None
+        self._pid = None
+        self._build_index()
+
+    def _build_index(self):
+        h5 = self._file()
+        self.packed = h5.attrs.get('layout') == 'packed'
+        self.deduplicated = FRAMES in h5
+        self.shared = {}
+        self.keys = None
+        self.scene_offsets = None
+        if self.packed:
+            self.shared = {name: decode(h5[name][()]) for name in SHARED_FIELDS if name in h5}
+            self.fields = [name for name in h5 if name not in SHARED_FIELDS and name not in (FRAMES, INDEX)]
+            self.encodings = {name: dict(h5[name].attrs) for name in self.fields}
+            if 'scene_offsets' in h5:
+                self.scene_offsets = h5['scene_offsets'][()]
+                self.num_samples = len(self.scene_offsets)
+            else:
+                self.num_samples = len(h5['scene_id']) if 'scene_id' in h5 else 0
+            return
+
+        keys = []
+        for name in h5:
+            if h5.get(name, getclass=True) is h5py.Group:
+                keys.append(name)
+            elif name not in (FRAMES, INDEX):
+                self.shared[name] = decode(h5[name][()])
+        self.keys = sorted(keys, key=int) if all(k.isdigit() for k in keys) else sorted(keys)
+        self.num_samples = len(self.keys)
+
+    def _file(self):
+        # one handle per process: a forked worker must not use the handle of its parent
+        if self._h5 is None or self._pid != os.getpid():
+            self._h5 = h5py.File(self.path, 'r')
+            self._pid = os.getpid()
+            self._cache = OrderedDict()
+            self._lock = threading.Lock()
+            self._executor = None
+            self._pending = {}
+        return self._h5
+
+    def __getstate__(self):
+        # handles, cache and threads are not sent to the workers
+        state = self.__dict__.copy()
+        for name in ('_h5', '_pid', '_cache', '_lock', '_executor', '_pending'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._h5 = None
+        self._pid = None
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, index):
+        return self.read_batch([index])[0]
+
+    def _read(self, indices):
+        # samples of the given indices, read from the file
+        samples = self._read_fields(indices)
+        if self.deduplicated:
+            frames = self._file()[FRAMES]
+            for sample in samples:
+                for name, images_name in FRAME_REFERENCES.items():
+                    if name in sample:
+                        sample[images_name] = read_frames(frames, sample.pop(name))
+        if self.packed and self.scene_offsets is None:
+            samples = [{ROW_FIELDS.get(name, name): value for name, value in sample.items()} for sample in samples]
+        return samples
+
+    def _read_fields(self, indices):
+        h5 = self._file()
+        if not self.packed:
+            samples = []
+            for i in indices:
+                group = h5[self.keys[i]]
+                sample = {name: decode(decode_field(dataset[()], dataset.attrs)) for name, dataset in group.items()}
+                if 'scene_id' in group.attrs:
+                    # compact schema
+                    sample['scene_id'] = decode(group.attrs['scene_id'])
+                samples.append(sample)
+            return samples
+
+        if self.scene_offsets is None:
+            # one fancy-indexed read per field; h5py needs increasing, unique indices
+            rows = np.unique(indices)
+            position = {row: j for j, row in enumerate(rows)}
+            fields = {name: decode(decode_field(h5[name][rows], self.encodings[name])) for name in self.fields}
+            return [{name: values[position[i]] for name, values in fields.items()} for i in indices]
+
+        samples = []
+        for i in indices:
+            first, num_turns = self.scene_offsets[i]
+            sample = {name: decode(decode_field(h5[name][i] if name in SCENE_FIELDS else
+                                                h5[name][first:first + num_turns], self.encodings[name]))
+                      for name in self.fields if name != 'token_ids'}
+            if 'token_offsets' in sample:
+                # token ids are concatenated per token, not per turn
+                first_token, num_tokens = sample['token_offsets']
+                sample['token_ids'] = h5['token_ids'][first_token:first_token + num_tokens]
+            samples.append({name: value for name, value in sample.items() if name not in OFFSET_FIELDS})
+        return samples
+
+    def index(self):
+        # per-turn index table (key, turn, num_turns, tokens, objects, objects_added, image_offset), or None
+        h5 = self._file()
+        return h5[INDEX][()] if INDEX in h5 else None
+
+    def read_batch(self, indices):
+        """Returns the samples of ``indices``, from the cache, a pending prefetch or a single read of the rest"""
+        indices = [int(i) for i in indices]
+        for i in indices:
+            if not -self.num_samples <= i < self.num_samples:
+                raise IndexError('Sample {} out of range for {} samples'.format(i, self.num_samples))
+        indices = [i % self.num_samples for i in indices]
+
+        self._file()
+        found = {}
+        for i in indices:
+            future = self._pending.pop(i, None)
+            if future is not None:
+                future.result()
+        with self._lock:
+            for i in indices:
+                if i in self._cache:
+                    self._cache.move_to_end(i)
+                    found[i] = self._cache[i]
+        missing = sorted(set(indices) - set(found))
+        if missing:
+            found.update(self._store(missing))
+        return [found[i] for i in indices]
+
+    def _store(self, indices):
+        samples = dict(zip(indices, self._read(indices)))
+        with self._lock:
+            for i, sample in samples.items():
+                self._cache[i] = sample
+                self._cache.move_to_end(i)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return samples
+
+    def prefetch(self, indices):
+        # read samples in a background thread; read_batch waits for them instead of reading them again
+        self._file()
+        indices = [int(i) % self.num_samples for i in indices]
+        self._pending = {i: future for i, future in self._pending.items() if not future.done()}
+        with self._lock:
+            indices = sorted({i for i in indices if i not in self._cache and i not in self._pending})
+        if not indices:
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.prefetch_threads)
+        future = self._executor.submit(self._store, indices)
+        for i in indices:
+            self._pending[i] = future
+
+    def iter_batches(self, batch_size, indices=None):
+        """Yields the samples of ``indices`` (default: all, in order) in lists of ``batch_size``.
+
+        The next batch is prefetched while the current one is used.
+        """
+        indices = list(range(self.num_samples)) if indices is None else list(indices)
+        batches = [indices[i:i + batch_size] for i in range(0, len(indices), batch_size)]
+        for j, batch in enumerate(batches):
+            if j + 1 < len(batches):
+                self.prefetch(batches[j + 1])
+            yield self.read_batch(batch)
+
+    def close(self):
+        if self._h5 is not None and self._pid == os.getpid():
+            if self._executor is not None:
+                self._executor.shutdown()
+            self._h5.close()
+        self._h5 = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,83 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Content-addressed table of the images of an HDF5 file, storing identical frames once
+"""
+import hashlib
+import os
+
+import numpy as np
+
+from .instrumentation import report
+from .storage import dataset_options
+
+
+# dataset of the deduplicated images, and the per-sample datasets of their rows that replace the images
+FRAMES = 'frames'
+FRAME_REFERENCES = {'image_ids': 'images', 'image_id': 'image'}
+
+
+class FrameTable:
+    """Appends the distinct images of a file to its resizable ``frames`` dataset.
+
+    ``add`` returns the row of every image: an image whose bytes were seen before gets the row of its first
+    occurrence instead of being stored again. New frames are buffered and written in blocks of ``flush_rows``,
+    with the compression (and ``chunk_rows``) the storage profile sets for ``images``.
+    """
+
+    def __init__(self, h5, storage_profile, flush_rows=64):
+        self.h5 = h5
+        self.storage_profile = storage_profile
+        self.flush_rows = flush_rows
+        self.rows = {}
+        self.pending = []
+        self.num_images = 0
+
+    def add(self, images):
+        ids = []
+        with report.timer('frame_dedup'):
+            for image in images:
+                image = np.ascontiguousarray(image)
+                key = hashlib.sha1(image.tobytes()).digest()
+                if key not in self.rows:
+                    self.rows[key] = len(self.rows)
+                    self.pending.append(image)
+                ids.append(self.rows[key])
+        self.num_images += len(ids)
+        if len(self.pending) >= self.flush_rows:
+            self.flush()
+        return np.array(ids, dtype=np.int64)
+
+    def flush(self):
+        if not self.pending:
+            return
+        data = np.array(self.pending)
+        if FRAMES not in self.h5:
+            shape = (0,) + data.shape[1:]
+            # frames are read by row, in any order: one frame per chunk unless the profile sets chunk_rows
+            options = dict(chunks=(1,) + data.shape[1:])
+            options.update(dataset_options(self.storage_profile, 'images', shape, resizable=True))
+            self.h5.create_dataset(FRAMES, shape=shape, maxshape=(None,) + data.shape[1:], dtype=data.dtype,
+                                   **options)
+        frames = self.h5[FRAMES]
+        start = frames.shape[0]
+        frames.resize(start + len(data), axis=0)
+        frames[start:] = data
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        report.count('dedup_images', self.num_images)
+        report.count('dedup_frames_stored', len(self.rows))
+        ratio = self.num_images / len(self.rows) if self.rows else 1.
+        print('{}: {} frames stored for {} images ({:.2f}x)'.format(os.path.basename(self.h5.filename),
+                                                                     len(self.rows), self.num_images, ratio))
+
+
+def read_frames(frames, ids):
+    # images of the given frame rows; h5py needs increasing, unique indices
+    ids = np.asarray(ids)
+    if ids.ndim == 0:
+        return frames[int(ids)]
+    rows = np.unique(ids)
+    return frames[rows][np.searchsorted(rows, ids)]
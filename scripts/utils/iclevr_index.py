@@ -0,0 +1,44 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Index of the i-CLEVR scene jsons and image frames, built with a single scan of their folders
+"""
+from collections import defaultdict
+import os
+
+from .instrumentation import report
+
+
+# frame file names per scene of every scanned images folder, shared by the builders of a process
+_frame_names = {}
+
+
+def list_scenes(json_path):
+    # scene json files in a deterministic (sorted) order
+    with report.timer('directory_scan'):
+        names = sorted(entry.name for entry in os.scandir(json_path)
+                       if entry.name.endswith('.json') and not entry.name.startswith('.'))
+    return [os.path.join(json_path, name) for name in names]
+
+
+def _index(images_path):
+    key = os.path.normpath(images_path)
+    if key not in _frame_names:
+        # CLEVR_<split>_<scene id>_<frame>.png, grouped by (split, scene id)
+        frames = defaultdict(list)
+        with report.timer('directory_scan'):
+            for entry in os.scandir(images_path):
+                parts = entry.name.split('_', 3)
+                if len(parts) == 4 and parts[0] == 'CLEVR':
+                    frames[(parts[1], parts[2])].append(entry.name)
+        _frame_names[key] = {scene: sorted(names) for scene, names in frames.items()}
+    return _frame_names[key]
+
+
+def scene_frames(images_path, split, scene_id):
+    """Returns the sorted paths of the frames of a scene in ``images_path``.
+
+    The folder is scanned once per process, on the first call, instead of once per scene; the paths are those
+    ``sorted(glob(os.path.join(images_path, 'CLEVR_<split>_<scene id>_*')))`` returns.
+    """
+    return [os.path.join(images_path, name) for name in _index(images_path).get((split, scene_id), [])]
@@ -0,0 +1,145 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Threaded image decoding and resizing shared by the HDF5 dataset builders
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from .instrumentation import report
+
+
+def available_cpus():
+    # CPUs this process may run on: a stage of run_pipeline.py is pinned to its share of the CPUs
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+
+def size_suffix(image_size, default_size):
+    # files of the default resolution keep their names, others are e.g. codraw_train_64px.h5
+    return '' if image_size == default_size else '_{}px'.format(image_size)
+
+
+class ImageCache:
+    """Persistent cache of resized images, one ``.npy`` file per image and output size in ``path``.
+
+    Entries are keyed by the absolute path, modification time and size of the source image and by the output
+    size, so a changed or replaced image is decoded again; stale entries are never read and can be removed by
+    deleting the folder.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _entry(self, source, stat, image_size):
+        key = json.dumps([os.path.abspath(source), stat.st_mtime_ns, stat.st_size, image_size])
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest[:2], digest + '.npy')
+
+    def get(self, source, stat, image_size):
+        try:
+            return np.load(self._entry(source, stat, image_size), allow_pickle=False)
+        except (OSError, ValueError):
+            # missing, or partly written by an interrupted build
+            return None
+
+    def put(self, source, stat, image_size, image):
+        path = self._entry(source, stat, image_size)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written under a name of its own and renamed, so concurrent builds never read a partial entry
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, image, allow_pickle=False)
+        os.replace(tmp_path, path)
+
+
+class ImageLoader:
+    """Decodes and resizes images in a thread pool while the caller writes HDF5.
+
+    Jobs are ``(item, image_paths)`` pairs; ``imap`` yields ``(item, images)`` in job order and keeps at
+    most ``prefetch`` jobs in flight, so memory stays bounded. cv2 releases the GIL while decoding and
+    resizing, so the threads run in parallel.
+
+    Every image is decoded once and resized to each of the square ``image_sizes``; ``images`` holds one list
+    of images per size. With a ``cache`` (ImageCache), images found in the cache in every size are not
+    decoded at all.
+    """
+
+    def __init__(self, image_sizes=(128,), cache=None, num_threads=None, prefetch=64):
+        self.image_sizes = list(image_sizes)
+        self.cache = cache
+        self.num_threads = num_threads or available_cpus()
+        self.prefetch = prefetch
+        # images decoded and read from the cache, and the decoding and resizing time summed over the threads
+        self.num_decoded = 0
+        self.num_cached = 0
+        self.decode_seconds = 0.
+        self.lock = threading.Lock()
+
+    def load(self, path):
+        # the image resized to every output size
+        stat = os.stat(path)
+        images = [None] * len(self.image_sizes)
+        if self.cache is not None:
+            with report.timer('image_cache'):
+                images = [self.cache.get(path, stat, image_size) for image_size in self.image_sizes]
+            if all(image is not None for image in images):
+                report.count('image_cache_hits')
+                with self.lock:
+                    self.num_cached += 1
+                return images
+
+        start = time.time()
+        with report.timer('image_decode'):
+            image = cv2.imread(path)
+        if image is None:
+            raise IOError('Could not read image {}'.format(path))
+        report.count('bytes_read', stat.st_size)
+        decode_seconds = time.time() - start
+        for k, image_size in enumerate(self.image_sizes):
+            if images[k] is None:
+                start = time.time()
+                with report.timer('resize'):
+                    images[k] = cv2.resize(image, (image_size, image_size))
+                decode_seconds += time.time() - start
+                if self.cache is not None:
+                    with report.timer('image_cache'):
+                        self.cache.put(path, stat, image_size, images[k])
+        with self.lock:
+            self.num_decoded += 1
+            self.decode_seconds += decode_seconds
+        return images
+
+    def by_size(self, loaded):
+        # images returned by load, regrouped into one list per output size
+        return [[images[k] for images in loaded] for k in range(len(self.image_sizes))]
+
+    def imap(self, jobs):
+        pending = deque()
+        with ThreadPoolExecutor(self.num_threads) as executor:
+            for item, paths in jobs:
+                pending.append((item, [executor.submit(self.load, path) for path in paths]))
+                if len(pending) >= self.prefetch:
+                    yield self._collect(pending.popleft())
+            while pending:
+                yield self._collect(pending.popleft())
+        self.report()
+
+    def _collect(self, job):
+        item, futures = job
+        loaded = [future.result() for future in futures]
+        return item, self.by_size(loaded)
+
+    def report(self):
+        # decoding throughput of a single thread, without the cache reads and the time the caller spends writing
+        rate = self.num_decoded / self.decode_seconds if self.decode_seconds > 0 else 0.
+        print('Decoded {} images ({:.1f} images/s per thread, {} threads), {} read from the image cache'.format(
+            self.num_decoded, rate, self.num_threads, self.num_cached))
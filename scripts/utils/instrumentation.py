@@ -0,0 +1,127 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Per-stage timings, byte counts and event counts of a dataset build, written as a JSON run report
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+
+class BuildReport:
+    """Accumulates the instrumentation of a build in the current process.
+
+    ``timer(stage)`` adds the time spent in a block to a stage (``json_parse``, ``image_decode``, ``resize``,
+    ``text_normalization``, ``hdf5_write``) and ``count(name, n)`` adds to a counter (bytes read, merged
+    turns, ...). Stage times are summed over the loader threads and worker processes, so they can exceed the
+    wall time of the build. Records are thread-safe; a forked worker starts from an empty report and sends its
+    records back to the main process through ``instrumented_map``.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.outputs = {}
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    def _lock(self):
+        if self.pid != os.getpid():
+            self.reset()
+        return self.lock
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock():
+                self.seconds[stage] += elapsed
+                self.calls[stage] += 1
+
+    def count(self, name, n=1):
+        with self._lock():
+            self.counters[name] += n
+
+    def drain(self):
+        # the records so far as plain dicts; the report starts again from zero
+        with self._lock():
+            stats = {'seconds': dict(self.seconds), 'calls': dict(self.calls), 'counters': dict(self.counters)}
+            self.seconds, self.calls, self.counters = defaultdict(float), defaultdict(int), defaultdict(int)
+        return stats
+
+    def merge(self, stats):
+        with self._lock():
+            for name, seconds in stats['seconds'].items():
+                self.seconds[name] += seconds
+            for name, calls in stats['calls'].items():
+                self.calls[name] += calls
+            for name, n in stats['counters'].items():
+                self.counters[name] += n
+
+    def track_outputs(self, paths, file_mode='w'):
+        # bytes written to HDF5 files are measured as the growth of the files, which are appended to in mode 'a'
+        for path in paths:
+            self.outputs[path] = os.path.getsize(path) if file_mode == 'a' and os.path.exists(path) else 0
+
+    def write(self, path, build, options=None):
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS; children are finished subprocesses
+        unit = 1 if sys.platform == 'darwin' else 1024
+        counters = dict(self.counters)
+        bytes_written = counters.pop('bytes_written', 0)
+        bytes_written += sum(max(0, os.path.getsize(p) - size) for p, size in self.outputs.items() if os.path.exists(p))
+        run_report = {
+            'build': build,
+            'options': options or {},
+            'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+            'wall_seconds': time.time() - self.started,
+            'stages': {stage: {'seconds': self.seconds[stage], 'calls': self.calls[stage]}
+                       for stage in sorted(self.seconds)},
+            'bytes_read': counters.pop('bytes_read', 0),
+            'bytes_written': bytes_written,
+            'peak_rss_mb': {'main': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 2 ** 20,
+                            'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 2 ** 20},
+            'counters': dict(sorted(counters.items())),
+        }
+        if counters.get('dedup_frames_stored'):
+            # images written per frame stored by deduplicated builds
+            run_report['dedup_ratio'] = counters['dedup_images'] / counters['dedup_frames_stored']
+        with open(path, 'w') as f:
+            json.dump(run_report, f, indent=2)
+        print('Run report written to {}'.format(path))
+
+
+# report of the current process, shared by the builders and the image loader
+report = BuildReport()
+
+
+def load_json(path):
+    # json.load of a file, recording its parse time and size
+    with report.timer('json_parse'), open(path, 'r') as f:
+        report.count('bytes_read', os.fstat(f.fileno()).st_size)
+        return json.load(f)
+
+
+def _collect(func, item):
+    result = func(item)
+    return result, report.drain()
+
+
+def instrumented_map(map_func, func, items):
+    """``map_func(func, items)`` (``map`` or ``Pool.imap``) with the records of every call merged into ``report``"""
+    for result, stats in map_func(functools.partial(_collect, func), items):
+        report.merge(stats)
+        yield result
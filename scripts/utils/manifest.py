@@ -0,0 +1,113 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Scene manifest for incremental and resumable HDF5 dataset builds
+"""
+import hashlib
+import json
+import os
+
+import h5py
+
+
+def file_stat(path):
+    # inputs are compared by modification time and size instead of by content
+    stat = os.stat(path)
+    return [os.path.basename(path), stat.st_mtime_ns, stat.st_size]
+
+
+def fingerprint_digest(fingerprint):
+    return hashlib.sha1(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+
+class BuildManifest:
+    """Records the inputs and the output groups of every scene of a dataset build.
+
+    A scene is current when the hash of its json file and the modification times and sizes of its
+    other input files (images, text) match the manifest, and its groups still exist in the output file
+    with the same fingerprint attribute. Only the remaining scenes are processed again. The shared
+    inputs (e.g. extracted coordinates, background image) and the build options are recorded as well;
+    when any of them changes, the whole dataset is rebuilt.
+
+    The manifest is saved every ``save_every`` processed scenes, so an interrupted build resumes from
+    the last saved scene.
+    """
+
+    def __init__(self, path, input_files, options=None, save_every=100):
+        self.path = path
+        self.inputs = {'files': [file_stat(p) for p in input_files], 'options': options or {}}
+        self.inputs = json.loads(json.dumps(self.inputs))
+        self.save_every = save_every
+        self.scenes = {}
+        self._unsaved = 0
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                manifest = json.load(f)
+            if manifest['inputs'] == self.inputs:
+                self.scenes = manifest['scenes']
+
+    @property
+    def file_mode(self):
+        # output files are only reused when some of their scenes can be kept
+        return 'a' if self.scenes else 'w'
+
+    @staticmethod
+    def fingerprint(scene_file, input_files):
+        with open(scene_file, 'rb') as f:
+            json_hash = hashlib.sha1(f.read()).hexdigest()
+        return {'json': json_hash, 'files': [file_stat(p) for p in input_files]}
+
+    def is_current(self, scene_file, fingerprint, h5_files):
+        entry = self.scenes.get(os.path.basename(scene_file))
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return False
+        h5 = h5_files[entry['split']]
+        digest = fingerprint_digest(fingerprint)
+        return all(name in h5 and h5[name].attrs.get('fingerprint') == digest for name in entry['groups'])
+
+    def num_groups(self, scene_file):
+        return len(self.scenes[os.path.basename(scene_file)]['groups'])
+
+    def reorganize(self, h5_files, kept_scenes):
+        """Keeps the groups of the unchanged scenes under their new names and deletes all other groups.
+
+        ``kept_scenes`` maps every unchanged scene file to its group names in a full build. Groups are
+        renamed in two steps through temporary names, so the new names may overlap with the old ones.
+        """
+        kept = {os.path.basename(scene_file): names for scene_file, names in kept_scenes.items()}
+        for split, h5 in h5_files.items():
+            keep = {name for scene, entry in self.scenes.items() if scene in kept and entry['split'] == split
+                    for name in entry['groups']}
+            for name in list(h5):
+                if isinstance(h5[name], h5py.Group) and name not in keep:
+                    del h5[name]
+
+        moves = [(self.scenes[scene]['split'], old, new) for scene, names in kept.items()
+                 for old, new in zip(self.scenes[scene]['groups'], names) if old != new]
+        for split, old, new in moves:
+            h5_files[split].move(old, '_tmp_' + new)
+        for split, old, new in moves:
+            h5_files[split].move('_tmp_' + new, new)
+
+        self.scenes = {scene: dict(self.scenes[scene], groups=names) for scene, names in kept.items()}
+        self.save(h5_files)
+
+    def record(self, scene_file, fingerprint, split, group_names, h5_files):
+        # mark the groups written for a scene and add the scene to the manifest
+        digest = fingerprint_digest(fingerprint)
+        for name in group_names:
+            h5_files[split][name].attrs['fingerprint'] = digest
+        self.scenes[os.path.basename(scene_file)] = {'fingerprint': fingerprint, 'split': split,
+                                                     'groups': group_names}
+        self._unsaved += 1
+        if self._unsaved >= self.save_every:
+            self.save(h5_files)
+
+    def save(self, h5_files):
+        # flush the output files first, so the manifest never lists groups that are not on disk
+        for h5 in h5_files.values():
+            h5.flush()
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'inputs': self.inputs, 'scenes': self.scenes}, f)
+        os.replace(self.path + '.tmp', self.path)
+        self._unsaved = 0
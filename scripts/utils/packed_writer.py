@@ -0,0 +1,81 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Writer for the packed HDF5 layout: one resizable dataset per field instead of one group per sample
+"""
+import h5py
+import numpy as np
+
+from .schema import NARROW_DTYPES, encode_field, field_encoding
+from .storage import dataset_options, row_chunks
+
+
+class PackedWriter:
+    """Appends rows to resizable datasets of an HDF5 file.
+
+    Rows are buffered per dataset and written in blocks of ``flush_rows``, so a training epoch over the
+    packed file is a sequence of chunked reads instead of a walk over one group per sample.
+
+    With the compact schema of the storage profile, the fields it narrows (``objects``, ``coords`` and
+    ``scene_id``) are kept in memory until ``close`` and written at once, in the encoding that holds all of
+    their rows; the other fields are written block by block.
+    """
+
+    def __init__(self, h5, storage_profile=None, flush_rows=256):
+        self.h5 = h5
+        self.storage_profile = storage_profile or {}
+        self.h5.attrs['layout'] = 'packed'
+        self.flush_rows = flush_rows
+        self.buffers = {}
+        self.sizes = {}
+
+    def size(self, name):
+        # number of rows appended so far, including the buffered ones
+        return self.sizes.get(name, 0)
+
+    def append(self, name, rows):
+        buffer = self.buffers.setdefault(name, [])
+        buffer.extend(rows)
+        self.sizes[name] = self.size(name) + len(rows)
+        if len(buffer) >= self.flush_rows:
+            self.flush(name)
+
+    def flush(self, name, last=False):
+        rows = self.buffers.get(name)
+        if not rows:
+            return
+        if not last and self.storage_profile.get('schema') == 'compact' and name in NARROW_DTYPES:
+            # the encoding of the first block may not hold the later ones
+            return
+        if isinstance(rows[0], str):
+            data = np.array(rows, dtype=object)
+            dtype = h5py.special_dtype(vlen=str)
+        else:
+            data = np.array(rows)
+            dtype = data.dtype
+
+        attrs = {}
+        if name in self.h5:
+            attrs, dtype = self.h5[name].attrs, self.h5[name].dtype
+        elif self.storage_profile.get('schema') == 'compact':
+            attrs, compact_dtype = field_encoding(name, data)
+            dtype = compact_dtype if attrs else dtype
+        if attrs:
+            data = encode_field(data, attrs, dtype)
+
+        if name not in self.h5:
+            shape = (0,) + data.shape[1:]
+            # whole rows per chunk, so reading a sample touches one chunk, unless the profile sets chunk_rows
+            options = dict(chunks=row_chunks(data.shape[1:], dtype))
+            options.update(dataset_options(self.storage_profile, name, shape, resizable=True))
+            self.h5.create_dataset(name, shape=shape, maxshape=(None,) + data.shape[1:], dtype=dtype, **options)
+            self.h5[name].attrs.update(attrs)
+        dataset = self.h5[name]
+        start = dataset.shape[0]
+        dataset.resize(start + len(data), axis=0)
+        dataset[start:] = data
+        self.buffers[name] = []
+
+    def close(self):
+        for name in self.buffers:
+            self.flush(name, last=True)
@@ -0,0 +1,85 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Partitioned dataset builds: scene assignment to independent jobs and the merge of their partial HDF5 files
+"""
+import hashlib
+import json
+import os
+
+import h5py
+
+from .sample_index import INDEX, index_table, write_index
+
+
+def partition_of(scene_file, num_partitions):
+    # stable across processes, hosts and Python versions, unlike hash()
+    digest = hashlib.sha1(os.path.basename(scene_file).encode('utf-8')).hexdigest()
+    return int(digest, 16) % num_partitions
+
+
+def partition_path(path, partition, num_partitions):
+    # e.g. codraw_train.h5 -> codraw_train.part-00001-of-00004.h5
+    root, ext = os.path.splitext(path)
+    return '{}.part-{:05d}-of-{:05d}{}'.format(root, partition, num_partitions, ext)
+
+
+def write_partition_log(path, scene_files, scene_groups):
+    # split and group names written for every scene of a partition, in build order
+    with open(path + '.tmp', 'w') as f:
+        json.dump([[os.path.basename(scene_file), split, names]
+                   for scene_file, (split, names) in zip(scene_files, scene_groups)], f)
+    os.replace(path + '.tmp', path)
+
+
+def merge_partitions(h5_paths, log_path, num_partitions, scene_files, renumber=True, link=False):
+    """Combines the partial files of ``num_partitions`` partitioned builds into the files of ``h5_paths`` (per split).
+
+    ``scene_files`` are all scenes in the order of a serial build. The groups of every scene are taken from the
+    partition that built it, following the partition logs, and renamed to the running group counter of their
+    split (or kept, without ``renumber``), so the group ids are those of the serial build. Groups are copied
+    with H5Ocopy, which does not decompress the data; with ``link`` the merged files hold external links to
+    the partial files instead, which then have to be kept next to them.
+    """
+    scenes = {}
+    for partition in range(num_partitions):
+        with open(partition_path(log_path, partition, num_partitions), 'r') as f:
+            for scene, split, names in json.load(f):
+                scenes[scene] = (partition, split, names)
+    missing = [scene_file for scene_file in scene_files if os.path.basename(scene_file) not in scenes]
+    if missing:
+        raise ValueError('{} scenes were not built by any partition, e.g. {}'.format(len(missing), missing[0]))
+
+    for split, path in h5_paths.items():
+        partials = [h5py.File(partition_path(path, partition, num_partitions), 'r')
+                    for partition in range(num_partitions)]
+        with h5py.File(path, 'w') as h5:
+            # file-level datasets (background, entities) and attributes (vocab_sha1) are the same in every
+            # partition; the index of the scenes is written again for the merged file
+            h5.attrs.update(partials[0].attrs)
+            for name in partials[0]:
+                if partials[0].get(name, getclass=True) is not h5py.Group and name != INDEX:
+                    partials[0].copy(name, h5)
+
+            counter = 0
+            for scene_file in scene_files:
+                partition, scene_split, names = scenes[os.path.basename(scene_file)]
+                if scene_split != split:
+                    continue
+                for name in names:
+                    new_name = str(counter) if renumber else name
+                    counter += 1
+                    if link:
+                        source = os.path.relpath(partials[partition].filename, os.path.dirname(os.path.abspath(path)))
+                        h5[new_name] = h5py.ExternalLink(source, name)
+                    else:
+                        partials[partition].copy(name, h5, new_name)
+        has_index = INDEX in partials[0]
+        for partial in partials:
+            partial.close()
+        if has_index:
+            # read-only, so that external links open the partial files read-only as well
+            with h5py.File(path, 'r') as h5:
+                table = index_table(h5)
+            with h5py.File(path, 'a') as h5:
+                write_index(h5, table)
@@ -0,0 +1,91 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Per-turn index table of the GeNeVA-GAN HDF5 files, for length-bucketed sampling without opening every scene
+"""
+import json
+
+import h5py
+import numpy as np
+
+from .instrumentation import report
+from .schema import decode_field
+
+
+# root-level dataset of the index table
+INDEX = 'index'
+# per-turn columns next to the key of the scene (its group name, or its number in the packed layout)
+INDEX_COLUMNS = [('turn', np.int32), ('num_turns', np.int32), ('tokens', np.int32), ('objects', np.int32),
+                 ('objects_added', np.int32), ('image_offset', np.int64)]
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _image_offset(h5, dataset):
+    # file offset of the first image of a contiguous images dataset, or -1 when the images are chunked,
+    # virtual, referenced through a frames table or in another file (external links of merged partitions)
+    if dataset is None or dataset.file.filename != h5.filename:
+        return -1
+    offset = dataset.id.get_offset()
+    return -1 if offset is None else offset
+
+
+def _scene_rows(key, texts, objects, image_offset, image_bytes):
+    # one row per turn; texts and objects hold one entry per turn
+    present = objects > 0
+    added = present & ~np.vstack([np.zeros_like(present[:1]), present[:-1]])
+    return [(key, t, len(objects), len(texts[t].split()), present[t].sum(), added[t].sum(),
+             image_offset + t * image_bytes if image_offset >= 0 else -1) for t in range(len(objects))]
+
+
+def index_table(h5):
+    """Returns the index table of an open GeNeVA-GAN file, one row per turn, in sample order.
+
+    Every row holds the key of its scene, the turn number and number of turns of the scene, the number of
+    tokens of the utterance (CoDraw) or instruction (i-CLEVR), the number of objects present and added at the
+    turn, and the byte offset of the image of the turn in the file (-1 if the images are not stored
+    contiguously in the file, as in the packed layout or with compression).
+    """
+    rows = []
+    if h5.attrs.get('layout') == 'packed':
+        if 'scene_offsets' in h5:
+            objects = decode_field(h5['objects'][()], h5['objects'].attrs)
+            utterences = [_text(u) for u in h5['utterences'][()]] if 'utterences' in h5 else None
+            for i, (first, num_turns) in enumerate(h5['scene_offsets'][()]):
+                texts = utterences[first:first + num_turns] if utterences else json.loads(_text(h5['text'][i]))
+                rows.extend(_scene_rows(str(i), texts, objects[first:first + num_turns], -1, 0))
+    else:
+        keys = [name for name in h5 if h5.get(name, getclass=True) is h5py.Group]
+        keys = sorted(keys, key=int) if all(k.isdigit() for k in keys) else sorted(keys)
+        for key in keys:
+            group = h5[key]
+            images = group.get('images')
+            num_turns = len(images if images is not None else group['image_ids'])
+            objects = decode_field(group['objects'][()], group['objects'].attrs)
+            if 'utterences' in group:
+                texts = [_text(u) for u in group['utterences'][()]]
+            else:
+                texts = json.loads(_text(group['text'][()]))
+            image_bytes = images.dtype.itemsize * int(np.prod(images.shape[1:])) if images is not None else 0
+            rows.extend(_scene_rows(key, texts, objects[:num_turns], _image_offset(h5, images), image_bytes))
+
+    width = max([len(row[0]) for row in rows] + [1])
+    dtype = np.dtype([('key', 'S{}'.format(width))] + INDEX_COLUMNS)
+    return np.array([(row[0].encode('utf-8'),) + row[1:] for row in rows], dtype=dtype)
+
+
+def write_index(h5, table=None):
+    # (re)writes the index table of an open GeNeVA-GAN file, after all of its scenes are written
+    with report.timer('index'):
+        table = index_table(h5) if table is None else table
+        if INDEX in h5:
+            del h5[INDEX]
+        h5.create_dataset(INDEX, data=table)
+
+
+def read_index(path):
+    # the index table of a GeNeVA-GAN file, in a single read
+    with h5py.File(path, 'r') as h5:
+        return h5[INDEX][()]
@@ -0,0 +1,93 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Compact storage schema: narrower encodings of the objects, coords and scene_id datasets that decode to the
+exact values of the default schema
+"""
+import numpy as np
+
+
+SCHEMAS = ('default', 'compact')
+# narrower types tried in order for numeric fields; the first one that holds every value exactly is used
+NARROW_DTYPES = {'objects': (np.uint8,), 'coords': (np.int16, np.float16, np.float32), 'scene_id': (np.int32,)}
+# widest zero-padded scene id stored as an int32
+MAX_DIGITS = 9
+
+
+def _strings(data):
+    # str / bytes scalar or array as an object array of str
+    values = np.asarray(data, dtype=object)
+    return np.vectorize(lambda v: v.decode('utf-8') if isinstance(v, bytes) else v, otypes=[object])(values)
+
+
+def _is_binary(data):
+    return data.ndim > 0 and data.dtype.kind in 'biuf' and bool(((data == 0) | (data == 1)).all())
+
+
+def _holds(data, dtype):
+    # whether every value of data survives a round trip through dtype
+    with np.errstate(invalid='ignore', over='ignore'):
+        return np.array_equal(data.astype(dtype).astype(data.dtype), data)
+
+
+def field_encoding(name, data):
+    """Returns ``(attrs, dtype)``: the encoding of ``data`` of field ``name`` in the compact schema, as the
+    attributes of the stored dataset, and the stored dtype. Empty ``attrs`` leave the data as is.
+
+    ``objects`` of 0/1 flags are bit-packed along the last axis, zero-padded numeric scene ids are stored as
+    integers, and other numeric fields get the narrowest type of ``NARROW_DTYPES`` that holds them exactly.
+    """
+    if isinstance(data, (str, bytes)) or np.asarray(data).dtype.kind in 'OSU':
+        if name != 'scene_id':
+            return {}, None
+        strings = _strings(data).ravel()
+        width = len(strings[0]) if len(strings) else 0
+        if 0 < width <= MAX_DIGITS and all(s.isdigit() and len(s) == width for s in strings):
+            return {'encoding': 'digits', 'width': width}, np.dtype(np.int32)
+        return {}, None
+
+    data = np.asarray(data)
+    if name == 'objects' and _is_binary(data):
+        return {'encoding': 'packbits', 'length': data.shape[-1], 'dtype': data.dtype.str}, np.dtype(np.uint8)
+    for dtype in NARROW_DTYPES.get(name, ()):
+        if np.dtype(dtype).itemsize < data.dtype.itemsize and _holds(data, dtype):
+            return {'encoding': 'cast', 'dtype': data.dtype.str}, np.dtype(dtype)
+    return {}, None
+
+
+def encode_field(data, attrs, dtype):
+    # data in the encoding of attrs, stored as dtype; raises ValueError if a value cannot be stored exactly
+    encoding = attrs.get('encoding')
+    if encoding is None:
+        return data
+    if encoding == 'digits':
+        strings = _strings(data)
+        if not all(s.isdigit() and len(s) == attrs['width'] for s in strings.ravel()):
+            raise ValueError('Scene ids are not numbers of {} digits'.format(attrs['width']))
+        return np.array([int(s) for s in strings.ravel()], dtype=dtype).reshape(strings.shape)
+
+    data = np.asarray(data)
+    if data.dtype != np.dtype(attrs['dtype']):
+        raise ValueError('Expected {} data, got {}'.format(np.dtype(attrs['dtype']), data.dtype))
+    if encoding == 'packbits':
+        if data.shape[-1:] != (attrs['length'],) or not _is_binary(data):
+            raise ValueError('Only flags of length {} can be bit-packed'.format(attrs['length']))
+        return np.packbits(data.astype(np.uint8), axis=-1)
+    if not _holds(data, dtype):
+        raise ValueError('Values do not fit in {}'.format(np.dtype(dtype)))
+    return data.astype(dtype)
+
+
+def decode_field(value, attrs):
+    # value read from a dataset with the given attributes, in the type of the default schema
+    encoding = attrs.get('encoding')
+    if encoding == 'packbits':
+        return np.unpackbits(value, axis=-1)[..., :attrs['length']].astype(attrs['dtype'])
+    if encoding == 'digits':
+        if np.ndim(value) == 0:
+            return '{:0{}d}'.format(int(value), attrs['width'])
+        return np.array(['{:0{}d}'.format(int(v), attrs['width']) for v in np.ravel(value)],
+                        dtype=object).reshape(np.shape(value))
+    if encoding == 'cast':
+        return np.asarray(value).astype(attrs['dtype'])[()]
+    return value
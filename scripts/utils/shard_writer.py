@@ -0,0 +1,176 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Sequential tar / npz shards of scenes, with an index, for streaming the datasets to many training nodes
+"""
+import io
+import json
+import os
+import tarfile
+
+import cv2
+import numpy as np
+
+from .dataset_reader import SCENE_FIELDS
+from .instrumentation import report
+from .token_ids import TOKEN_FIELDS
+
+
+def _tar_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _npy_bytes(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def _json_value(value):
+    if isinstance(value, np.ndarray):
+        return [_json_value(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class ShardWriter:
+    """Writes scenes to fixed-size shards of ``samples_per_shard`` scenes in ``output_dir``.
+
+    A scene is a dict of field name to value, as read by DatasetReader from a GeNeVA-GAN file: ``images``
+    and the other per-turn fields have one row per turn, ``scene_id`` and ``text`` one value per scene.
+
+    - ``tar``: every scene is a record of members named after its key: ``<key>.<turn>.png`` for the
+      PNG-encoded images, ``<key>.<field>.npy`` for the numeric fields and ``<key>.json`` for the strings.
+    - ``npz``: the per-turn fields of all scenes of a shard are concatenated, as in the packed HDF5
+      layout, with a ``scene_offsets`` table of (first row, number of turns) and a ``key`` per scene.
+
+    ``index.json`` lists every shard with its number of scenes and turns, size and scene keys, so training
+    nodes can each stream a disjoint set of shards; ``shared.npz`` holds the file-level datasets.
+    """
+
+    def __init__(self, output_dir, shard_format='tar', samples_per_shard=1000, shared=None):
+        if shard_format not in ('tar', 'npz'):
+            raise ValueError('Unknown shard format {}'.format(shard_format))
+        self.output_dir = output_dir
+        self.shard_format = shard_format
+        self.samples_per_shard = samples_per_shard
+        self.shards = []
+        self.records = []
+        os.makedirs(output_dir, exist_ok=True)
+        # shards of a previous export that this one may not overwrite
+        index_path = os.path.join(output_dir, 'index.json')
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                for shard in json.load(f)['shards']:
+                    if os.path.exists(os.path.join(output_dir, shard['file'])):
+                        os.remove(os.path.join(output_dir, shard['file']))
+            os.remove(index_path)
+        if shared:
+            np.savez(os.path.join(output_dir, 'shared.npz'),
+                     **{name: np.array(value) for name, value in shared.items()})
+
+    def write(self, key, sample):
+        # the scene offsets of a packed file are rebuilt for every shard; token ids are not per-turn rows, so
+        # shards keep the utterances and instructions as strings only
+        sample = {field: value for field, value in sample.items()
+                  if field not in ('scene_offsets', 'token_offsets') + TOKEN_FIELDS}
+        self.records.append((str(key), sample))
+        if len(self.records) >= self.samples_per_shard:
+            self.flush()
+
+    def flush(self):
+        if not self.records:
+            return
+        name = 'shard-{:06d}.{}'.format(len(self.shards), self.shard_format)
+        path = os.path.join(self.output_dir, name)
+        if self.shard_format == 'tar':
+            self._write_tar(path + '.tmp')
+        else:
+            self._write_npz(path + '.tmp')
+        os.replace(path + '.tmp', path)
+        report.count('bytes_written', os.path.getsize(path))
+
+        first_sample = sum(shard['num_samples'] for shard in self.shards)
+        self.shards.append({'file': name, 'first_sample': first_sample, 'num_samples': len(self.records),
+                            'num_turns': sum(len(sample['images']) for _, sample in self.records),
+                            'bytes': os.path.getsize(path), 'keys': [key for key, _ in self.records]})
+        self.records = []
+
+    def _write_tar(self, path):
+        with tarfile.open(path, 'w', format=tarfile.PAX_FORMAT) as tar:
+            for key, sample in self.records:
+                strings = {}
+                for field, value in sorted(sample.items()):
+                    if field == 'images':
+                        for t, image in enumerate(value):
+                            data = cv2.imencode('.png', image)[1].tobytes()
+                            _tar_member(tar, '{}.{:03d}.png'.format(key, t), data)
+                    elif isinstance(value, np.ndarray) and value.dtype != object and value.dtype.kind not in 'SU':
+                        _tar_member(tar, '{}.{}.npy'.format(key, field), _npy_bytes(value))
+                    else:
+                        strings[field] = _json_value(value)
+                _tar_member(tar, '{}.json'.format(key), json.dumps(strings, sort_keys=True).encode('utf-8'))
+
+    def _write_npz(self, path):
+        arrays = {'key': np.array([key for key, _ in self.records])}
+        num_turns = [len(sample['images']) for _, sample in self.records]
+        arrays['scene_offsets'] = np.stack([np.cumsum([0] + num_turns[:-1]), num_turns], axis=1)
+        for field in self.records[0][1]:
+            if field in SCENE_FIELDS:
+                values = [sample[field] for _, sample in self.records]
+                arrays[field] = np.array([str(v) for v in values] if isinstance(values[0], str) else values)
+            else:
+                # per-turn fields are cut to the turns with an image, as in the packed layout
+                values = [np.asarray(sample[field])[:n] for (_, sample), n in zip(self.records, num_turns)]
+                if values[0].dtype == object:
+                    values = [v.astype(str) for v in values]
+                arrays[field] = np.concatenate(values)
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    def close(self):
+        self.flush()
+        index = {'format': self.shard_format, 'num_samples': sum(shard['num_samples'] for shard in self.shards),
+                 'num_turns': sum(shard['num_turns'] for shard in self.shards), 'shards': self.shards}
+        with open(os.path.join(self.output_dir, 'index.json'), 'w') as f:
+            json.dump(index, f, indent=1)
+
+
+def select_shards(output_dir, rank, world_size):
+    # shard files read by node ``rank`` of ``world_size``: every world_size-th shard, so the sets are disjoint
+    with open(os.path.join(output_dir, 'index.json'), 'r') as f:
+        index = json.load(f)
+    return [os.path.join(output_dir, shard['file']) for shard in index['shards'][rank::world_size]]
+
+
+def iter_shard(path):
+    """Yields the ``(key, scene)`` records of a shard file in order, reading it sequentially"""
+    if path.endswith('.npz'):
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files}
+        for i, key in enumerate(arrays['key']):
+            first, num_turns = arrays['scene_offsets'][i]
+            yield str(key), {name: values[i] if name in SCENE_FIELDS else values[first:first + num_turns]
+                             for name, values in arrays.items() if name not in ('key', 'scene_offsets')}
+        return
+
+    key, sample, images = None, {}, []
+    with tarfile.open(path, 'r|') as tar:
+        for member in tar:
+            record_key, rest = member.name.split('.', 1)
+            if key is not None and record_key != key:
+                yield key, dict(sample, images=np.array(images))
+                sample, images = {}, []
+            key = record_key
+            data = tar.extractfile(member).read()
+            if rest.endswith('.png'):
+                images.append(cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR))
+            elif rest.endswith('.npy'):
+                sample[rest[:-4]] = np.load(io.BytesIO(data), allow_pickle=False)
+            else:
+                sample.update(json.loads(data.decode('utf-8')))
+    if key is not None:
+        yield key, dict(sample, images=np.array(images))
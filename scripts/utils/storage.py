@@ -0,0 +1,136 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+HDF5 chunking and compression profiles, configured per dataset name in config.yml
+"""
+import os
+
+import h5py
+import numpy as np
+
+from .schema import SCHEMAS, encode_field, field_encoding
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+# rows per chunk of the resizable datasets of the packed layout unless the profile sets chunk_rows
+CHUNK_ROWS = 64
+# size of the chunk cache of HDF5 per dataset
+CHUNK_CACHE_BYTES = 2 ** 20
+
+
+def load_storage_profile(keys, name=None, schema=None):
+    # profile selected on the command line, or the one set by `hdf5_storage_profile` in config.yml; a schema
+    # given on the command line overrides the `schema` of the profile
+    name = name or keys['hdf5_storage_profile']
+    profiles = keys['hdf5_storage_profiles']
+    if name not in profiles:
+        raise ValueError('Unknown HDF5 storage profile {}; choose one of {}'.format(name, sorted(profiles)))
+    profile = dict(profiles[name] or {})
+    if schema is not None:
+        profile['schema'] = schema
+    if profile.get('schema', 'default') not in SCHEMAS:
+        raise ValueError('Unknown storage schema {}; choose one of {}'.format(profile['schema'], list(SCHEMAS)))
+    if any(isinstance(options, dict) and options.get('compression') == 'blosc_lz4' for options in profile.values()):
+        # fail before the build starts instead of at the first dataset
+        check_hdf5plugin(name)
+    return profile
+
+
+def check_hdf5plugin(name='blosc_lz4'):
+    if hdf5plugin is None:
+        raise ImportError('The {} storage profile uses the blosc_lz4 filter of the hdf5plugin package, which is not '
+                          'installed; install it (pip install hdf5plugin, also listed in environment.yml) or use the '
+                          'built-in lzf profile (--storage-profile lzf)'.format(name))
+
+
+def dataset_options(profile, name, shape, resizable=False):
+    """Returns the create_dataset keyword arguments of dataset ``name`` for the given profile.
+
+    Fixed-size datasets (one per scene or sample group) are stored as a single chunk, so reading a group
+    decompresses exactly its own data. Resizable datasets of the packed layout are chunked every
+    ``chunk_rows`` samples along the first axis. Scalar datasets cannot be chunked and are left as is.
+    """
+    options = profile.get(name, profile.get('default')) or {}
+    if not options or len(shape) == 0:
+        return {}
+
+    kwargs = {}
+    compression = options.get('compression')
+    shuffle = options.get('shuffle', False)
+    if compression == 'blosc_lz4':
+        check_hdf5plugin()
+        kwargs.update(hdf5plugin.Blosc(cname='lz4', clevel=options.get('compression_opts', 5),
+                                       shuffle=hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE))
+    else:
+        if compression is not None:
+            kwargs['compression'] = compression
+            if 'compression_opts' in options:
+                kwargs['compression_opts'] = options['compression_opts']
+        kwargs['shuffle'] = shuffle
+
+    if resizable:
+        kwargs['chunks'] = (options.get('chunk_rows', CHUNK_ROWS),) + tuple(shape[1:])
+    else:
+        kwargs['chunks'] = tuple(max(1, s) for s in shape)
+    return kwargs
+
+
+def row_chunks(row_shape, dtype):
+    # chunks of whole rows for datasets without options: up to CHUNK_ROWS rows, as many as fit in the chunk cache
+    row_bytes = max(1, int(np.prod(row_shape)) * np.dtype(dtype).itemsize)
+    return (max(1, min(CHUNK_ROWS, CHUNK_CACHE_BYTES // row_bytes)),) + tuple(row_shape)
+
+
+def create_dataset(group, name, data, profile, **kwargs):
+    """create_dataset with the chunking and compression options and the schema of the storage profile.
+
+    With the compact schema the data is stored in the encoding of ``schema.field_encoding``, described by the
+    attributes of the dataset, and the scene id is an attribute of the group instead of a dataset of its own;
+    nothing is returned then.
+    """
+    attrs = {}
+    if profile.get('schema') == 'compact':
+        if name == 'scene_id':
+            group.attrs[name] = data
+            return None
+        attrs, dtype = field_encoding(name, data)
+        if attrs:
+            data = encode_field(data, attrs, dtype)
+            kwargs.pop('dtype', None)
+    kwargs.update(dataset_options(profile, name, np.shape(data)))
+    dataset = group.create_dataset(name, data=data, **kwargs)
+    dataset.attrs.update(attrs)
+    return dataset
+
+
+def check_virtual_datasets():
+    # virtual datasets need h5py 2.9 and HDF5 1.10; older versions only fail at the first linked dataset
+    if h5py.version.version_tuple[:2] < (2, 9) or h5py.version.hdf5_version_tuple[:2] < (1, 10):
+        raise ImportError('Linked images are HDF5 virtual datasets, which need h5py 2.9 and HDF5 1.10 or newer; '
+                          'found h5py {} with HDF5 {}'.format(h5py.version.version, h5py.version.hdf5_version))
+
+
+def link_dataset(group, name, source, rows):
+    """Creates ``name`` as a virtual dataset made of rows of ``source``, a dataset of another file, without copying.
+
+    ``rows`` is a single row index, which drops the first axis, or a list of row indices; runs of consecutive
+    rows are mapped together. The source file is referenced relative to the file of ``group``, so both files
+    have to be kept in the same relative location.
+    """
+    source_file = os.path.relpath(source.file.filename, os.path.dirname(os.path.abspath(group.file.filename)))
+    vsource = h5py.VirtualSource(source_file, source.name, shape=source.shape, dtype=source.dtype)
+    if np.isscalar(rows):
+        layout = h5py.VirtualLayout(shape=source.shape[1:], dtype=source.dtype)
+        layout[...] = vsource[rows]
+        return group.create_virtual_dataset(name, layout)
+
+    rows = np.asarray(rows, dtype=np.int64)
+    layout = h5py.VirtualLayout(shape=(len(rows),) + source.shape[1:], dtype=source.dtype)
+    run_starts = np.flatnonzero(np.diff(rows, prepend=-2) != 1)
+    run_ends = np.append(run_starts[1:], len(rows))
+    for start, end in zip(run_starts, run_ends):
+        layout[start:end] = vsource[rows[start]:rows[start] + end - start]
+    return group.create_virtual_dataset(name, layout)
@@ -0,0 +1,67 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+"""
+Token ids of the GeNeVA-GAN utterances and instructions, in the row order of the joint GloVe vocabulary
+"""
+import hashlib
+import os
+
+import h5py
+import numpy as np
+
+from .instrumentation import report
+
+
+# ragged token ids of a scene and the number of tokens of every turn
+TOKEN_FIELDS = ('token_ids', 'token_lengths')
+# id of the tokens missing from the vocabulary
+UNKNOWN_ID = -1
+
+
+def vocab_path(keys):
+    # token list written by generate_glove_file.py next to the GloVe matrix, one token per line in row order
+    return os.path.splitext(keys['glove_output_matrix'])[0] + '_tokens.txt'
+
+
+class Vocabulary:
+    """Maps the whitespace-separated, lowercased tokens of a text to the rows of the joint GloVe matrix.
+
+    ``sha1`` identifies the vocabulary; it is stored in the attributes of the files with token ids, and
+    ``check`` compares it with the vocabulary a training run embeds the ids with.
+    """
+
+    def __init__(self, path):
+        with open(path, 'r', newline='\n') as f:
+            self.tokens = [line[:-1] for line in f]
+        self.ids = {token: i for i, token in enumerate(self.tokens)}
+        self.sha1 = hashlib.sha1('\n'.join(self.tokens).encode('utf-8')).hexdigest()
+
+    def encode(self, texts):
+        # token ids of all texts concatenated, and the number of tokens of every text
+        with report.timer('token_ids'):
+            tokens = [text.lower().split() for text in texts]
+            ids = np.array([self.ids.get(token, UNKNOWN_ID) for turn in tokens for token in turn], dtype=np.int32)
+            lengths = np.array([len(turn) for turn in tokens], dtype=np.int32)
+        report.count('unknown_tokens', int((ids == UNKNOWN_ID).sum()))
+        return ids, lengths
+
+    def write_attrs(self, h5):
+        h5.attrs['vocab_sha1'] = self.sha1
+        h5.attrs['vocab_size'] = len(self.tokens)
+
+    def check(self, h5):
+        # raises a ValueError unless the token ids of the file (an open file or a path) are rows of this vocabulary
+        if not isinstance(h5, h5py.File):
+            with h5py.File(h5, 'r') as f:
+                return self.check(f)
+        sha1 = h5.attrs.get('vocab_sha1')
+        if sha1 is None:
+            raise ValueError('{} has no token ids'.format(h5.filename))
+        if sha1 != self.sha1:
+            raise ValueError('The token ids of {} were built with another vocabulary (sha1 {}, expected {})'
+                             .format(h5.filename, sha1, self.sha1))
+
+
+def split_turns(token_ids, token_lengths):
+    # the token ids of a scene as one array per turn
+    return np.split(np.asarray(token_ids), np.cumsum(token_lengths)[:-1])